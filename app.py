@@ -1,55 +1,684 @@
-import os, json, sqlite3
-from contextlib import closing
-from flask import Flask, request, jsonify, abort, redirect, url_for, render_template_string
+import os, csv, io, json, queue, random, re, sqlite3, sys, threading, time
+import atexit, codecs, contextvars, cProfile
+from bisect import bisect_left
+from collections import OrderedDict, deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from contextlib import closing, contextmanager
+from flask import Flask, Response, g, request, jsonify, abort, redirect, url_for
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.exceptions import NewConnectionError
 
 DB = os.getenv("DB_PATH", "store.db")
 ADMIN_SECRET = os.getenv("ADMIN_SECRET", "CHANGE_ME")
 DEFAULT_TIMEOUT = int(os.getenv("DEFAULT_TIMEOUT", "3"))
+# SQLite: chờ khoá tối đa bao nhiêu giây, mmap bao nhiêu byte, cache bao nhiêu câu lệnh đã prepare
+DB_BUSY_TIMEOUT = float(os.getenv("DB_BUSY_TIMEOUT", "5"))
+DB_MMAP_SIZE = int(os.getenv("DB_MMAP_SIZE", str(64 * 1024 * 1024)))
+DB_STMT_CACHE = int(os.getenv("DB_STMT_CACHE", "256"))
+# Cache keymap trong RAM: bao lâu (giây) kiểm tra version trong SQLite 1 lần
+KEYMAP_CACHE_CHECK = float(os.getenv("KEYMAP_CACHE_CHECK", "1"))
+KEYMAP_CACHE_MAX = int(os.getenv("KEYMAP_CACHE_MAX", "50000"))
+KEYMAP_NEG_CACHE_MAX = int(os.getenv("KEYMAP_NEG_CACHE_MAX", "10000"))
+# Refresher nền: chu kỳ tải lại catalog (giây, 0 = tắt), độ lệch ngẫu nhiên (tỉ lệ),
+# và độ cũ tối đa được phục vụ trước khi buộc phải tải đồng bộ
+STOCK_REFRESH_INTERVAL = float(os.getenv("STOCK_REFRESH_INTERVAL", "0"))
+STOCK_REFRESH_JITTER = float(os.getenv("STOCK_REFRESH_JITTER", "0.2"))
+STOCK_REFRESH_WORKERS = int(os.getenv("STOCK_REFRESH_WORKERS", "4"))
+CATALOG_MAX_STALENESS = float(os.getenv("CATALOG_MAX_STALENESS", "120"))
+# Chỉ 1 process (giữ lease trong SQLite) chạy refresher khi đã có snapshot dùng chung
+STOCK_REFRESH_LEADER = os.getenv("STOCK_REFRESH_LEADER", "1") == "1"
+# Lưu catalog đã index vào bảng catalog_snapshots để mọi worker dùng chung
+CATALOG_SNAPSHOTS = os.getenv("CATALOG_SNAPSHOTS", "1") == "1"
+# /stock/batch: tối đa bao nhiêu key mỗi lần, bao nhiêu NCC tải song song
+BATCH_MAX_KEYS = int(os.getenv("BATCH_MAX_KEYS", "500"))
+BATCH_MAX_WORKERS = int(os.getenv("BATCH_MAX_WORKERS", "8"))
+# /fetch số lượng lớn: chia thành các lần buyProduct FETCH_CHUNK_SIZE (0 = tắt), chạy song song
+# tối đa FETCH_CHUNK_CONCURRENCY phần / request, response stream dần về client
+FETCH_CHUNK_SIZE = int(os.getenv("FETCH_CHUNK_SIZE", "0"))
+FETCH_CHUNK_CONCURRENCY = int(os.getenv("FETCH_CHUNK_CONCURRENCY", "4"))
+FETCH_POOL_WORKERS = int(os.getenv("FETCH_POOL_WORKERS", "16"))
+# Circuit breaker theo base_url: mở sau CB_FAILURE_THRESHOLD lỗi liên tiếp (0 = tắt),
+# sau CB_RESET_TIMEOUT giây cho 1 request thử (half-open)
+CB_FAILURE_THRESHOLD = int(os.getenv("CB_FAILURE_THRESHOLD", "5"))
+CB_RESET_TIMEOUT = float(os.getenv("CB_RESET_TIMEOUT", "30"))
+# Hedged request cho /api/products.php: gửi lần 2 nếu lần 1 chậm hơn percentile HEDGE_PERCENTILE
+HEDGE_CATALOG = os.getenv("HEDGE_CATALOG", "0") == "1"
+HEDGE_PERCENTILE = float(os.getenv("HEDGE_PERCENTILE", "95"))
+HEDGE_MIN_SAMPLES = int(os.getenv("HEDGE_MIN_SAMPLES", "20"))
+HEDGE_MIN_DELAY = float(os.getenv("HEDGE_MIN_DELAY", "0.05"))
+# Rate limit token bucket (dùng chung mọi worker qua SQLite, 0 = tắt): RATE_PROVIDER_RPS request/giây
+# tới mỗi (base_url, api_key), RATE_KEY_RPS request/giây mỗi input_key. Request vượt burst xếp hàng
+# chờ tới lượt, nhưng tối đa RATE_MAX_WAIT giây; hàng chờ dài hơn thì request bị từ chối
+RATE_PROVIDER_RPS = float(os.getenv("RATE_PROVIDER_RPS", "0"))
+RATE_PROVIDER_BURST = float(os.getenv("RATE_PROVIDER_BURST", "10"))
+RATE_KEY_RPS = float(os.getenv("RATE_KEY_RPS", "0"))
+RATE_KEY_BURST = float(os.getenv("RATE_KEY_BURST", "5"))
+RATE_MAX_WAIT = float(os.getenv("RATE_MAX_WAIT", "2"))
+# Kho đệm: mỗi INVENTORY_INTERVAL giây (0 = tắt) mua trước hàng cho các key có buffer_high > 0,
+# tối đa INVENTORY_BUY_MAX đơn vị mỗi lần buyProduct. buffer_low = 0 nghĩa là mua bù khi kho hết.
+INVENTORY_INTERVAL = float(os.getenv("INVENTORY_INTERVAL", "0"))
+INVENTORY_BUY_MAX = int(os.getenv("INVENTORY_BUY_MAX", "50"))
+# Trang admin: số folder mỗi trang, số key mỗi lần tải (khi mở 1 provider)
+ADMIN_FOLDERS_PER_PAGE = int(os.getenv("ADMIN_FOLDERS_PER_PAGE", "50"))
+ADMIN_KEYS_PER_PAGE = int(os.getenv("ADMIN_KEYS_PER_PAGE", "100"))
+# /fetch?order_id=...: request trùng order_id đang được xử lý ở nơi khác thì chờ tối đa ORDER_WAIT giây
+# (phải nhỏ hơn nhiều so với timeout worker của gunicorn, mặc định 30s)
+ORDER_WAIT = float(os.getenv("ORDER_WAIT", "5"))
+# Đơn 'pending' quá ORDER_PENDING_TTL giây (worker chết giữa lúc mua...) -> 'expired': không chờ nữa
+ORDER_PENDING_TTL = float(os.getenv("ORDER_PENDING_TTL", "300"))
+# Metrics: mỗi worker ghi số liệu ra METRICS_DIR/metrics-<pid>.json mỗi METRICS_FLUSH_INTERVAL giây,
+# /metrics cộng dồn tất cả các file
+METRICS_DIR = os.getenv("METRICS_DIR", DB + ".metrics")
+METRICS_FLUSH_INTERVAL = float(os.getenv("METRICS_FLUSH_INTERVAL", "5"))
+# Profiling lấy mẫu: cProfile 1/PROFILE_SAMPLE_N request (0 = tắt), giữ PROFILE_KEEP file mới nhất (tối thiểu 1).
+# PROFILE_SAMPLE_N chỉ là mặc định: đổi lúc đang chạy ở trang admin (runtime_setting).
+PROFILE_SAMPLE_N = int(os.getenv("PROFILE_SAMPLE_N", "0"))
+PROFILE_DIR = os.getenv("PROFILE_DIR", DB + ".profiles")
+PROFILE_KEEP = int(os.getenv("PROFILE_KEEP", "50"))
+# Pool HTTP keep-alive tới NCC (mỗi worker, mỗi base_url một Session)
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", "10"))
+HTTP_KEEPALIVE = os.getenv("HTTP_KEEPALIVE", "1") == "1"
+CONNECT_TIMEOUT = float(os.getenv("CONNECT_TIMEOUT", str(DEFAULT_TIMEOUT)))
+READ_TIMEOUT = float(os.getenv("READ_TIMEOUT", str(DEFAULT_TIMEOUT)))
+# Retry chỉ áp dụng cho GET /api/products.php, KHÔNG BAO GIỜ cho buyProduct
+CATALOG_RETRIES = int(os.getenv("CATALOG_RETRIES", "0"))
+CATALOG_RETRY_BACKOFF = float(os.getenv("CATALOG_RETRY_BACKOFF", "0.2"))
+# Số giây giữ catalog /api/products.php trong cache (0 = tắt cache)
+CATALOG_TTL = float(os.getenv("CATALOG_TTL", "15"))
+# Đọc catalog dạng stream (chỉ giữ id/amount, không dựng cả cây JSON); lỗi thì parse toàn bộ như cũ
+CATALOG_STREAM = os.getenv("CATALOG_STREAM", "1") == "1"
+CATALOG_STREAM_CHUNK = int(os.getenv("CATALOG_STREAM_CHUNK", "65536"))
+# Log JSON lines, ghi ở thread nền. LOG_FILE rỗng = stdout.
+# LOG_DEDUP_WINDOW: cùng (loại, nội dung) trong cửa sổ này chỉ ghi 1 lần, sau đó ghi 1 dòng "suppressed": n.
+# LOG_SAMPLE: tỉ lệ giữ theo loại, vd. "STOCK_DEBUG=0.01,STOCK_ERROR=0.2,*=1".
+# Loại trong LOG_KEEP_ALL (ORDER_ERROR, INVENTORY_ERROR) không bị gộp/sample.
+LOG_FILE = os.getenv("LOG_FILE", "")
+LOG_QUEUE_MAX = int(os.getenv("LOG_QUEUE_MAX", "10000"))
+LOG_DEDUP_WINDOW = float(os.getenv("LOG_DEDUP_WINDOW", "10"))
+LOG_DEDUP_MAX = int(os.getenv("LOG_DEDUP_MAX", "10000"))
+LOG_SAMPLE = os.getenv("LOG_SAMPLE", "")
 
 app = Flask(__name__)
 
+# ========= Log (JSON lines, không chặn request) =========
+def _parse_log_sample(spec: str) -> dict:
+    rates = {}
+    for part in spec.split(","):
+        cat, _, rate = part.partition("=")
+        if cat.strip() and rate.strip():
+            rates[cat.strip().upper()] = min(max(float(rate), 0.0), 1.0)
+    return rates
+
+_log_sample = _parse_log_sample(LOG_SAMPLE)
+_log_queue = queue.Queue(LOG_QUEUE_MAX)
+_log_seen = {}    # (cat, msg) -> [bắt đầu cửa sổ, số dòng bị gộp, fields của dòng đầu]
+_log_lock = threading.Lock()
+_log_dropped = 0
+_log_pid = None
+_LOG_STOP = object()
+# Dòng đối soát (đơn giao thiếu, hàng đã mua chưa ghi được...): mỗi dòng là 1 sự kiện riêng
+# mang dữ liệu hàng/đơn, nên không bao giờ bị gộp, bị sample hay bị bỏ khi hàng đợi đầy.
+LOG_KEEP_ALL = frozenset({"ORDER_ERROR", "INVENTORY_ERROR"})
+
+def log(cat: str, msg: str, **fields):
+    """
+    Ghi 1 dòng log loại `cat` (vd. "STOCK_ERROR"). `msg` nên cố định, phần thay đổi (key, ID, lỗi...)
+    truyền qua fields để các dòng lặp gộp được. Chỉ đưa vào hàng đợi; serialize và ghi ở thread nền.
+    """
+    if _log_pid != os.getpid():
+        _start_log_writer()
+    now = time.time()
+    if cat in LOG_KEEP_ALL:
+        _log_put((now, cat, msg, fields), keep=True)
+        return
+    rate = _log_sample.get(cat, _log_sample.get("*", 1.0))
+    if rate < 1.0 and random.random() >= rate:
+        return
+    summary = None
+    if LOG_DEDUP_WINDOW > 0:
+        k = (cat, msg)
+        with _log_lock:
+            s = _log_seen.get(k)
+            if s is not None and now - s[0] < LOG_DEDUP_WINDOW:
+                s[1] += 1
+                return
+            if s is not None:
+                del _log_seen[k]
+                if s[1]:
+                    summary = (now, cat, msg, {**s[2], "suppressed": s[1], "window": round(now - s[0], 3)})
+            if len(_log_seen) < LOG_DEDUP_MAX:
+                _log_seen[k] = [now, 0, fields]
+    if summary is not None:
+        _log_put(summary)
+    _log_put((now, cat, msg, fields))
+
+def _log_put(rec, keep=False):
+    global _log_dropped
+    try:
+        if keep:
+            _log_queue.put(rec, timeout=1)
+        else:
+            _log_queue.put_nowait(rec)
+    except queue.Full:
+        if keep:
+            # Thread ghi bị kẹt: ghi thẳng ra stderr còn hơn mất dòng đối soát
+            sys.stderr.write(_log_line(rec, os.getpid()))
+            return
+        with _log_lock:
+            _log_dropped += 1
+
+def _log_sweep(force=False) -> list:
+    """Lấy ra các cửa sổ gộp đã hết hạn (hoặc tất cả khi force) thành dòng "suppressed"."""
+    global _log_dropped
+    now = time.time()
+    out = []
+    with _log_lock:
+        for k, s in list(_log_seen.items()):
+            if force or now - s[0] >= LOG_DEDUP_WINDOW:
+                del _log_seen[k]
+                if s[1]:
+                    out.append((now, k[0], k[1], {**s[2], "suppressed": s[1], "window": round(now - s[0], 3)}))
+        dropped, _log_dropped = _log_dropped, 0
+    if dropped:
+        out.append((now, "LOG_WARNING", "log queue full, lines dropped", {"dropped": dropped}))
+        metric_inc("log_dropped_total", dropped)
+    return out
+
+def _log_level(cat: str) -> str:
+    for suffix, level in (("_ERROR", "error"), ("_WARNING", "warning"), ("_DEBUG", "debug")):
+        if cat.endswith(suffix):
+            return level
+    return "info"
+
+def _log_line(rec, pid: int) -> str:
+    ts, cat, msg, fields = rec
+    stamp = time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(ts)) + f".{int(ts % 1 * 1000):03d}Z"
+    line = {"ts": stamp, "pid": pid, "level": _log_level(cat), "cat": cat, "msg": msg}
+    line.update(fields)
+    return json.dumps(line, ensure_ascii=False, default=str) + "\n"
+
+def _log_writer(q):
+    out = open(LOG_FILE, "a", encoding="utf-8") if LOG_FILE else sys.stdout
+    pid = os.getpid()
+    next_sweep = time.monotonic() + 1
+    stop = False
+    while not stop:
+        batch = []
+        try:
+            batch.append(q.get(timeout=1))
+            while len(batch) < 1000:
+                batch.append(q.get_nowait())
+        except queue.Empty:
+            pass
+        if _LOG_STOP in batch:
+            batch.remove(_LOG_STOP)
+            stop = True
+        if stop or time.monotonic() >= next_sweep:
+            batch += _log_sweep(force=stop)
+            next_sweep = time.monotonic() + 1
+        if not batch:
+            continue
+        try:
+            out.write("".join(_log_line(rec, pid) for rec in batch))
+            out.flush()
+        except Exception as e:
+            sys.stderr.write(f"LOG_ERROR: {e}\n")
+
+def _start_log_writer():
+    global _log_pid, _log_queue, _log_dropped
+    with _log_lock:
+        if _log_pid == os.getpid():
+            return
+        if _log_pid is not None:
+            # Process con sau fork: thread ghi của process cha không còn, bỏ hàng đợi/bảng gộp cũ
+            _log_queue = queue.Queue(LOG_QUEUE_MAX)
+            _log_seen.clear()
+            _log_dropped = 0
+        _log_pid = os.getpid()
+        t = threading.Thread(target=_log_writer, args=(_log_queue,), name="log-writer", daemon=True)
+        t.start()
+    atexit.register(_stop_log_writer, _log_queue, t)
+
+def _stop_log_writer(q, t):
+    """Lúc thoát process: ghi nốt hàng đợi và các dòng "suppressed" còn treo."""
+    if t.is_alive():
+        try:
+            q.put(_LOG_STOP, timeout=1)
+        except queue.Full:
+            return
+        t.join(timeout=2)
+
+_db_local = threading.local()
+
 def db():
-    con = sqlite3.connect(DB)
-    con.row_factory = sqlite3.Row
+    """
+    Kết nối SQLite dùng lại theo từng thread (mở lại nếu process đã fork).
+    `with db() as con:` vẫn commit/rollback như cũ, chỉ không mở kết nối mới mỗi request;
+    nhờ vậy cache prepared statement của sqlite3 (cached_statements) có tác dụng.
+    """
+    con = getattr(_db_local, "con", None)
+    if con is None or _db_local.pid != os.getpid():
+        con = sqlite3.connect(DB, timeout=DB_BUSY_TIMEOUT, cached_statements=DB_STMT_CACHE)
+        con.row_factory = sqlite3.Row
+        # WAL: admin ghi không chặn các worker đang đọc
+        con.execute("PRAGMA journal_mode=WAL")
+        con.execute("PRAGMA synchronous=NORMAL")
+        con.execute(f"PRAGMA mmap_size={DB_MMAP_SIZE}")
+        con.execute(f"PRAGMA busy_timeout={int(DB_BUSY_TIMEOUT * 1000)}")
+        _db_local.con = con
+        _db_local.pid = os.getpid()
     return con
 
+def _has_col(con, table, col) -> bool:
+    return any(r[1] == col for r in con.execute(f"PRAGMA table_info({table})"))
+
 def _ensure_col(con, table, col, decl):
-    try:
+    if not _has_col(con, table, col):
         con.execute(f"ALTER TABLE {table} ADD COLUMN {col} {decl}")
-    except Exception:
-        pass
 
-def init_db():
+# ========= Schema: migration theo PRAGMA user_version =========
+# Mỗi phần tử là 1 version (version = vị trí + 1). Chỉ THÊM migration mới vào cuối, không sửa cái cũ.
+# DB tạo trước khi có migration (user_version = 0) có thể đã có sẵn một phần schema, nên các bước
+# đầu dùng IF NOT EXISTS / _ensure_col.
+def _m1_keymaps(con):
+    con.execute("""
+    CREATE TABLE IF NOT EXISTS keymaps(
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        sku TEXT NOT NULL,
+        input_key TEXT NOT NULL UNIQUE,
+        product_id INTEGER NOT NULL,
+        is_active INTEGER DEFAULT 1,
+        group_name TEXT,
+        provider_type TEXT NOT NULL DEFAULT 'mail72h',
+        base_url TEXT
+    )""")
+    _ensure_col(con, "keymaps", "group_name", "TEXT")
+    _ensure_col(con, "keymaps", "provider_type", "TEXT NOT NULL DEFAULT 'mail72h'")
+    _ensure_col(con, "keymaps", "base_url", "TEXT")
+    for old in ("provider_api_key", "mail72h_api_key"):
+        if _has_col(con, "keymaps", old) and not _has_col(con, "keymaps", "api_key"):
+            con.execute(f"ALTER TABLE keymaps RENAME COLUMN {old} TO api_key")
+    _ensure_col(con, "keymaps", "api_key", "TEXT")
+    if _has_col(con, "keymaps", "note"):
+        con.execute("ALTER TABLE keymaps DROP COLUMN note")
+
+def _m2_shared_state(con):
+    # Bảng meta: keymap_version tăng mỗi khi admin sửa keymaps -> các worker xoá cache
+    con.execute("CREATE TABLE IF NOT EXISTS app_meta(name TEXT PRIMARY KEY, value INTEGER NOT NULL DEFAULT 0)")
+    con.execute("INSERT OR IGNORE INTO app_meta(name, value) VALUES('keymap_version', 0)")
+    # Snapshot catalog dùng chung cho mọi worker (và còn lại sau khi restart)
+    con.execute("""
+    CREATE TABLE IF NOT EXISTS catalog_snapshots(
+        base_url TEXT NOT NULL,
+        api_key TEXT NOT NULL,
+        fetched_at REAL NOT NULL,
+        product_count INTEGER NOT NULL,
+        amounts TEXT NOT NULL,
+        raw TEXT NOT NULL DEFAULT '',
+        PRIMARY KEY(base_url, api_key)
+    )""")
+    # Lease: chỉ 1 process giữ vai trò leader cho việc chạy nền (vd. refresher)
+    con.execute("""
+    CREATE TABLE IF NOT EXISTS leases(
+        name TEXT PRIMARY KEY,
+        owner TEXT NOT NULL,
+        expires_at REAL NOT NULL
+    )""")
+
+def _m3_rate_buckets(con):
+    # Token bucket cho rate limit: tokens < 0 nghĩa là đang có request xếp hàng
+    con.execute("""
+    CREATE TABLE IF NOT EXISTS rate_buckets(
+        name TEXT PRIMARY KEY,
+        tokens REAL NOT NULL,
+        updated_at REAL NOT NULL
+    )""")
+
+def _m4_inventory(con):
+    # Kho đệm: mua bù khi còn < buffer_low, lên tới buffer_high (0 = không dùng kho)
+    _ensure_col(con, "keymaps", "buffer_low", "INTEGER NOT NULL DEFAULT 0")
+    _ensure_col(con, "keymaps", "buffer_high", "INTEGER NOT NULL DEFAULT 0")
+    # Hàng đã mua trước, mỗi dòng 1 đơn vị (chuỗi "product" trả cho Tạp Hóa)
+    con.execute("""
+    CREATE TABLE IF NOT EXISTS inventory(
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        input_key TEXT NOT NULL,
+        product_id INTEGER NOT NULL,
+        item TEXT NOT NULL,
+        bought_at REAL NOT NULL
+    )""")
+    con.execute("CREATE INDEX IF NOT EXISTS idx_inventory_key ON inventory(input_key, product_id, id)")
+
+def _m5_orders(con):
+    # Nhật ký đơn /fetch theo order_id (idempotency): gửi lại cùng order_id -> trả hàng đã giao
+    con.execute("""
+    CREATE TABLE IF NOT EXISTS orders(
+        input_key TEXT NOT NULL,
+        order_id TEXT NOT NULL,
+        quantity INTEGER NOT NULL,
+        status TEXT NOT NULL,
+        created_at REAL NOT NULL,
+        PRIMARY KEY(input_key, order_id)
+    )""")
+    con.execute("""
+    CREATE TABLE IF NOT EXISTS order_journal(
+        input_key TEXT NOT NULL,
+        order_id TEXT NOT NULL,
+        seq INTEGER NOT NULL,
+        item TEXT NOT NULL,
+        PRIMARY KEY(input_key, order_id, seq)
+    )""")
+
+def _m6_keymap_indexes(con):
+    # find_map_by_key(s): input_key + is_active đọc được từ index, không cần mở row
+    con.execute("CREATE INDEX IF NOT EXISTS idx_keymaps_key_active ON keymaps(input_key, is_active)")
+    # Trang admin: lọc/nhóm theo folder, provider, sắp xếp theo sku
+    con.execute("CREATE INDEX IF NOT EXISTS idx_keymaps_group ON keymaps(group_name, provider_type, sku)")
+    con.execute("ANALYZE keymaps")
+
+MIGRATIONS = [_m1_keymaps, _m2_shared_state, _m3_rate_buckets, _m4_inventory, _m5_orders, _m6_keymap_indexes]
+SCHEMA_VERSION = len(MIGRATIONS)
+
+def migrate() -> int:
+    """
+    Chạy các migration còn thiếu trong 1 transaction BEGIN IMMEDIATE (khoá ghi của SQLite:
+    nhiều process cùng gọi thì chỉ 1 process chạy, các process khác chờ rồi thấy đã xong).
+    Trả về user_version sau khi chạy.
+    """
+    with closing(sqlite3.connect(DB, timeout=max(DB_BUSY_TIMEOUT, 30), isolation_level=None)) as con:
+        con.execute("PRAGMA journal_mode=WAL")
+        con.execute("BEGIN IMMEDIATE")
+        try:
+            version = con.execute("PRAGMA user_version").fetchone()[0]
+            for i in range(version, SCHEMA_VERSION):
+                MIGRATIONS[i](con)
+                log("MIGRATE", f"{DB} -> version {i + 1} ({MIGRATIONS[i].__name__})")
+            if version < SCHEMA_VERSION:
+                con.execute(f"PRAGMA user_version={SCHEMA_VERSION}")
+            con.execute("COMMIT")
+        except BaseException:
+            con.execute("ROLLBACK")
+            raise
+    return max(version, SCHEMA_VERSION)
+
+def check_schema():
+    """
+    Lúc import (mỗi worker): chỉ đọc PRAGMA user_version. Migration bình thường đã chạy 1 lần
+    trước đó (`python app.py migrate` hoặc hook on_starting trong gunicorn.conf.py); nếu chưa
+    (chạy dev, DB mới) thì tự migrate.
+    """
+    with db() as con:
+        version = con.execute("PRAGMA user_version").fetchone()[0]
+    if version < SCHEMA_VERSION:
+        migrate()
+    elif version > SCHEMA_VERSION:
+        log("MIGRATE_WARNING", "schema version newer than this code", db=DB, version=version, code_version=SCHEMA_VERSION)
+
+check_schema()
+
+def try_lease(name: str, ttl: float) -> bool:
+    """Giành/gia hạn lease `name` cho process này; True nếu đang là leader."""
+    owner = f"{os.uname().nodename}:{os.getpid()}"
+    now = time.time()
     with db() as con:
         con.execute("""
-        CREATE TABLE IF NOT EXISTS keymaps(
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            sku TEXT NOT NULL,
-            input_key TEXT NOT NULL UNIQUE,
-            product_id INTEGER NOT NULL,
-            is_active INTEGER DEFAULT 1,
-            group_name TEXT,
-            provider_type TEXT NOT NULL DEFAULT 'mail72h',
-            base_url TEXT
-        )""")
-        _ensure_col(con, "keymaps", "group_name", "TEXT")
-        _ensure_col(con, "keymaps", "provider_type", "TEXT NOT NULL DEFAULT 'mail72h'")
-        _ensure_col(con, "keymaps", "base_url", "TEXT")
-        try:
-            con.execute("ALTER TABLE keymaps RENAME COLUMN provider_api_key TO api_key")
-        except: pass
+            INSERT INTO leases(name, owner, expires_at) VALUES(?,?,?)
+            ON CONFLICT(name) DO UPDATE SET owner=excluded.owner, expires_at=excluded.expires_at
+            WHERE leases.owner=excluded.owner OR leases.expires_at < ?
+        """, (name, owner, now + ttl, now))
+        con.commit()
+        row = con.execute("SELECT owner FROM leases WHERE name=?", (name,)).fetchone()
+    return row is not None and row["owner"] == owner
+
+# ========= Metrics (Prometheus text format, cộng dồn giữa các worker) =========
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_counters = {}    # (name, labels) -> giá trị
+_histograms = {}  # (name, labels) -> [đếm theo bucket..., +Inf, sum, count]
+_metrics_lock = threading.Lock()
+_metrics_pid = None
+
+def metric_inc(name: str, value=1, **labels):
+    key = (name, tuple(sorted(labels.items())))
+    with _metrics_lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+def metric_observe(name: str, seconds: float, **labels):
+    key = (name, tuple(sorted(labels.items())))
+    i = bisect_left(LATENCY_BUCKETS, seconds)
+    with _metrics_lock:
+        h = _histograms.get(key)
+        if h is None:
+            h = _histograms[key] = [0] * (len(LATENCY_BUCKETS) + 1) + [0.0, 0]
+        h[i] += 1
+        h[-2] += seconds
+        h[-1] += 1
+
+def metric_error(scope: str, cls: str):
+    metric_inc("app_errors_total", scope=scope, error=cls)
+
+def metric_cache(cache: str, result: str):
+    metric_inc("cache_requests_total", cache=cache, result=result)
+
+def _metrics_snapshot() -> dict:
+    with _metrics_lock:
+        return {"counters": [[n, l, v] for (n, l), v in _counters.items()],
+                "histograms": [[n, l, list(h)] for (n, l), h in _histograms.items()]}
+
+def flush_metrics():
+    """Ghi số liệu của process này ra file để các worker khác đọc được."""
+    os.makedirs(METRICS_DIR, exist_ok=True)
+    path = os.path.join(METRICS_DIR, f"metrics-{os.getpid()}.json")
+    with open(path + ".tmp", "w") as f:
+        json.dump(_metrics_snapshot(), f)
+    os.replace(path + ".tmp", path)
+
+def _metrics_loop():
+    while True:
+        time.sleep(METRICS_FLUSH_INTERVAL)
         try:
-            con.execute("ALTER TABLE keymaps RENAME COLUMN mail72h_api_key TO api_key")
-        except: pass
-        _ensure_col(con, "keymaps", "api_key", "TEXT")
+            flush_metrics()
+        except Exception as e:
+            log("METRICS_ERROR", "flush failed", error=str(e))
+
+def start_metrics():
+    global _metrics_pid
+    if METRICS_FLUSH_INTERVAL <= 0 or _metrics_pid == os.getpid():
+        return
+    with _metrics_lock:
+        if _metrics_pid == os.getpid():
+            return
+        if _metrics_pid is not None:
+            # Process con sau fork: không cộng lại số liệu của process cha
+            _counters.clear()
+            _histograms.clear()
+        _metrics_pid = os.getpid()
+    threading.Thread(target=_metrics_loop, name="metrics-flush", daemon=True).start()
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def collect_metrics():
+    """Cộng số liệu của process này với file của các worker khác (file của worker đã chết bị xoá)."""
+    snaps = [_metrics_snapshot()]
+    if os.path.isdir(METRICS_DIR):
+        for fn in os.listdir(METRICS_DIR):
+            if not (fn.startswith("metrics-") and fn.endswith(".json")):
+                continue
+            pid = int(fn[len("metrics-"):-len(".json")])
+            path = os.path.join(METRICS_DIR, fn)
+            if pid == os.getpid():
+                continue
+            if not _pid_alive(pid):
+                os.remove(path)
+                continue
+            try:
+                with open(path) as f:
+                    snaps.append(json.load(f))
+            except (OSError, ValueError):
+                continue
+
+    counters, hists = {}, {}
+    for snap in snaps:
+        for n, l, v in snap["counters"]:
+            key = (n, tuple(map(tuple, l)))
+            counters[key] = counters.get(key, 0) + v
+        for n, l, h in snap["histograms"]:
+            key = (n, tuple(map(tuple, l)))
+            cur = hists.get(key)
+            hists[key] = list(h) if cur is None else [a + b for a, b in zip(cur, h)]
+    return counters, hists
+
+def _fmt_labels(labels, extra=()) -> str:
+    items = list(labels) + list(extra)
+    if not items:
+        return ""
+    esc = lambda v: str(v).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+    return "{" + ",".join(f'{k}="{esc(v)}"' for k, v in items) + "}"
+
+def render_metrics(counters: dict, hists: dict) -> str:
+    out = []
+    for name in sorted({n for n, _ in counters}):
+        out.append(f"# TYPE {name} counter")
+        for (n, l), v in sorted(counters.items()):
+            if n == name:
+                out.append(f"{name}{_fmt_labels(l)} {v}")
+    for name in sorted({n for n, _ in hists}):
+        out.append(f"# TYPE {name} histogram")
+        for (n, l), h in sorted(hists.items()):
+            if n != name:
+                continue
+            cum = 0
+            for bound, c in zip(list(LATENCY_BUCKETS) + ["+Inf"], h[:-2]):
+                cum += c
+                out.append(f"{name}_bucket{_fmt_labels(l, [('le', bound)])} {cum}")
+            out.append(f"{name}_sum{_fmt_labels(l)} {h[-2]}")
+            out.append(f"{name}_count{_fmt_labels(l)} {h[-1]}")
+    return "\n".join(out) + "\n"
+
+def exception_class(e: Exception) -> str:
+    """Nhóm lỗi cho metrics: connect / circuit_open / rate_limited / parse / other."""
+    if isinstance(e, (requests.ConnectionError, requests.Timeout)):
+        return "connect"
+    if isinstance(e, CircuitOpenError):
+        return "circuit_open"
+    if isinstance(e, RateLimitedError):
+        return "rate_limited"
+    if isinstance(e, ValueError):  # gồm cả JSONDecodeError khi NCC trả về không phải JSON
+        return "parse"
+    return "other"
+
+
+# ========= Tracing: thời gian từng phase -> header Server-Timing =========
+_timings = contextvars.ContextVar("timings", default=None)
+
+def trace_start() -> dict:
+    """Bắt đầu ghi phase cho request hiện tại (thread/task hiện tại)."""
+    t = {}
+    _timings.set(t)
+    return t
+
+def trace_add(name: str, seconds: float):
+    t = _timings.get()
+    if t is not None:
+        t[name] = t.get(name, 0.0) + seconds
+
+@contextmanager
+def phase(name: str):
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace_add(name, time.perf_counter() - t0)
+
+def server_timing(timings: dict) -> str:
+    return ", ".join(f"{k};dur={v * 1000:.2f}" for k, v in timings.items())
+
+# Kết nối urllib3 có đo thời gian connect (TCP + TLS) -> phase upstream_connect
+class _TimedHTTPConnection(HTTPConnection):
+    def connect(self):
+        with phase("upstream_connect"):
+            super().connect()
+
+class _TimedHTTPSConnection(HTTPSConnection):
+    def connect(self):
+        with phase("upstream_connect"):
+            super().connect()
+
+class _TimedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = _TimedHTTPConnection
+
+class _TimedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = _TimedHTTPSConnection
+
+# ========= Cấu hình đổi lúc đang chạy (app_meta "setting:<tên>", dùng chung mọi worker) =========
+_settings = {}
+_settings_checked_at = 0.0
+
+def runtime_setting(name: str, default: int) -> int:
+    """Giá trị admin đã đặt cho `name` (mọi worker thấy sau tối đa KEYMAP_CACHE_CHECK giây) hoặc default."""
+    global _settings, _settings_checked_at
+    now = time.monotonic()
+    if now - _settings_checked_at >= KEYMAP_CACHE_CHECK:
+        _settings_checked_at = now
         try:
-            con.execute("ALTER TABLE keymaps DROP COLUMN note")
-        except:
-            pass 
+            with db() as con:
+                _settings = {r["name"]: r["value"] for r in con.execute(
+                    "SELECT name, value FROM app_meta WHERE name LIKE 'setting:%'")}
+        except Exception as e:
+            log("SETTINGS_ERROR", "load failed", error=str(e))
+    return _settings.get(f"setting:{name}", default)
+
+def set_runtime_setting(name: str, value):
+    """Đặt `name` = value (int) cho mọi worker; None = quay về giá trị mặc định (biến môi trường)."""
+    global _settings_checked_at
+    with db() as con:
+        if value is None:
+            con.execute("DELETE FROM app_meta WHERE name=?", (f"setting:{name}",))
+        else:
+            con.execute("INSERT OR REPLACE INTO app_meta(name, value) VALUES(?,?)", (f"setting:{name}", int(value)))
         con.commit()
+    _settings_checked_at = 0.0
+
+_profile_lock = threading.Lock()  # cProfile: mỗi process chỉ 1 profile cùng lúc
+
+def profile_start():
+    """Bật cProfile cho request này với xác suất 1/N (N = profile_sample_n); trả về profiler hoặc None."""
+    n = runtime_setting("profile_sample_n", PROFILE_SAMPLE_N)
+    if n <= 0 or random.randrange(n):
+        return None
+    if not _profile_lock.acquire(blocking=False):
+        return None
+    prof = cProfile.Profile()
+    prof.enable()
+    return prof
+
+def profile_finish(prof, route: str):
+    try:
+        prof.disable()
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        name = route.strip("/").replace("/", "_").replace("<", "").replace(">", "") or "root"
+        prof.dump_stats(os.path.join(PROFILE_DIR, f"{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}-{time.time_ns() % 10**9}-{name}.pstats"))
+        # Xoay vòng: chỉ giữ PROFILE_KEEP file mới nhất; PROFILE_KEEP <= 0 vẫn giữ file vừa ghi
+        # (files[:-0] là rỗng: không clamp thì không bao giờ xoá gì)
+        files = sorted((os.path.join(PROFILE_DIR, f) for f in os.listdir(PROFILE_DIR) if f.endswith(".pstats")),
+                       key=os.path.getmtime)
+        for old in files[:-max(PROFILE_KEEP, 1)]:
+            os.remove(old)
+    except Exception as e:
+        log("PROFILE_ERROR", "profile dump failed", error=str(e))
+    finally:
+        _profile_lock.release()
 
-init_db()
 
 # ==========================================================
 # === SỬA LỖI 6: Thu thập TẤT CẢ sản phẩm từ TẤT CẢ danh mục ===
@@ -61,12 +690,12 @@ def _collect_all_products(obj):
     """
     all_products = []
     if not isinstance(obj, dict):
-        print(f"DEBUG: API response is not a dict: {str(obj)[:200]}")
+        log("STOCK_DEBUG", "API response is not a dict", raw=str(obj)[:200])
         return None
 
     categories = obj.get('categories')
     if not isinstance(categories, list):
-        print(f"DEBUG: 'categories' key not found or is not a list in API response.")
+        log("STOCK_DEBUG", "'categories' key not found or is not a list in API response")
         return None # Không tìm thấy list 'categories'
 
     for category in categories:
@@ -76,7 +705,7 @@ def _collect_all_products(obj):
                 all_products.extend(products_in_category) # Thêm tất cả sản phẩm vào list chung
     
     if not all_products: # Nếu không tìm thấy gì
-        print(f"DEBUG: Found 'categories' list, but no 'products' lists were found inside them.")
+        log("STOCK_DEBUG", "found 'categories' list, but no 'products' lists inside them")
         return None
         
     return all_products
@@ -87,117 +716,969 @@ def _collect_all_products(obj):
 
 # ========= Helpers cho Provider 'mail72h' (Vẫn dùng tên này, nhưng nó dùng chung) =========
 
+_sessions = {}        # base_url -> requests.Session (giữ kết nối TCP+TLS)
+_sessions_pid = None
+_sessions_lock = threading.Lock()
+
+def http_session(base_url: str) -> requests.Session:
+    """Session keep-alive dùng lại cho mọi request tới cùng base_url trong worker này."""
+    global _sessions_pid
+    with _sessions_lock:
+        if _sessions_pid != os.getpid():
+            # Sau khi gunicorn fork, không dùng chung socket với process cha
+            _sessions.clear()
+            _sessions_pid = os.getpid()
+        s = _sessions.get(base_url)
+        if s is None:
+            s = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=HTTP_POOL_SIZE, max_retries=0)
+            adapter.poolmanager.pool_classes_by_scheme = {"http": _TimedHTTPConnectionPool,
+                                                          "https": _TimedHTTPSConnectionPool}
+            s.mount("http://", adapter)
+            s.mount("https://", adapter)
+            if not HTTP_KEEPALIVE:
+                s.headers["Connection"] = "close"
+            _sessions[base_url] = s
+        return s
+
+_pools = {}  # tên -> ThreadPoolExecutor của process hiện tại
+_pools_pid = None
+_pools_lock = threading.Lock()
+
+def worker_pool(name: str, max_workers: int) -> ThreadPoolExecutor:
+    """Thread pool dùng chung theo tên, tạo lại sau khi fork (thread không sống qua fork)."""
+    global _pools_pid
+    with _pools_lock:
+        if _pools_pid != os.getpid():
+            _pools.clear()
+            _pools_pid = os.getpid()
+        pool = _pools.get(name)
+        if pool is None:
+            pool = _pools[name] = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=name)
+        return pool
+
+# ========= Sức khoẻ NCC: circuit breaker + hedged request theo base_url =========
+class CircuitOpenError(Exception):
+    """NCC đang được coi là sập: báo lỗi ngay thay vì chờ hết timeout."""
+
+_health = {}  # base_url -> {"state", "failures", "opened_at", "probe_at", "latencies"}
+_health_lock = threading.Lock()
+
+def _provider_health(base_url: str) -> dict:
+    h = _health.get(base_url)
+    if h is None:
+        h = _health[base_url] = {"state": "closed", "failures": 0, "opened_at": 0.0, "probe_at": 0.0,
+                                 "latencies": deque(maxlen=200)}
+    return h
+
+def circuit_allow(base_url: str, probe=True):
+    """
+    Ném CircuitOpenError nếu circuit của base_url đang mở. probe=False: chỉ kiểm tra, không giữ
+    lượt thử half-open (gọi trước khi xếp hàng rate limit để circuit mở thì báo lỗi ngay).
+    """
+    if CB_FAILURE_THRESHOLD <= 0:
+        return
+    now = time.monotonic()
+    with _health_lock:
+        h = _provider_health(base_url)
+        if h["state"] == "closed":
+            return
+        if h["state"] == "open" and now - h["opened_at"] >= CB_RESET_TIMEOUT:
+            if not probe:
+                return
+            h["state"] = "half_open"
+            h["probe_at"] = 0.0
+        if h["state"] == "half_open" and now - h["probe_at"] >= CB_RESET_TIMEOUT:
+            # Chỉ 1 request thử; nếu nó treo quá CB_RESET_TIMEOUT thì cho request khác thử
+            if probe:
+                h["probe_at"] = now
+            return
+    raise CircuitOpenError(f"circuit open for {base_url}")
+
+def circuit_record(base_url: str, ok: bool, latency: float = None):
+    with _health_lock:
+        h = _provider_health(base_url)
+        if ok:
+            if h["state"] != "closed":
+                log("CIRCUIT_CLOSED", base_url)
+            h["state"] = "closed"
+            h["failures"] = 0
+            if latency is not None:
+                h["latencies"].append(latency)
+            return
+        h["failures"] += 1
+        if h["state"] == "half_open" or (CB_FAILURE_THRESHOLD > 0 and h["failures"] >= CB_FAILURE_THRESHOLD):
+            if h["state"] != "open":
+                log("CIRCUIT_OPEN", base_url, failures=h["failures"])
+                metric_inc("circuit_open_total", base_url=base_url)
+            h["state"] = "open"
+            h["opened_at"] = time.monotonic()
+
+def hedge_delay(base_url: str):
+    """Sau bao nhiêu giây thì gửi request catalog thứ 2, hoặc None nếu không hedge."""
+    if not HEDGE_CATALOG:
+        return None
+    with _health_lock:
+        lat = sorted(_provider_health(base_url)["latencies"])
+    if len(lat) < HEDGE_MIN_SAMPLES:
+        return None
+    return max(lat[min(int(len(lat) * HEDGE_PERCENTILE / 100), len(lat) - 1)], HEDGE_MIN_DELAY)
+
+def provider_request(base_url: str, action: str, send, track_latency=False):
+    """Gọi send() qua circuit breaker; lỗi kết nối, timeout và HTTP 5xx được tính là lỗi."""
+    circuit_allow(base_url)
+    timings = _timings.get()
+    connect0 = timings.get("upstream_connect", 0.0) if timings is not None else 0.0
+    t0 = time.monotonic()
+    try:
+        r = send()
+    except (requests.ConnectionError, requests.Timeout):
+        circuit_record(base_url, False)
+        metric_observe("upstream_request_duration_seconds", time.monotonic() - t0, base_url=base_url, action=action)
+        raise
+    dt = time.monotonic() - t0
+    metric_observe("upstream_request_duration_seconds", dt, base_url=base_url, action=action)
+    circuit_record(base_url, r.status_code < 500, dt if track_latency else None)
+    if timings is not None:
+        # r.elapsed: gửi request -> nhận xong header (gồm cả connect); phần còn lại là tải body
+        # (stream=True: body chưa đọc ở đây, load_catalog_index tự cộng thời gian đọc body)
+        ttfb = r.elapsed.total_seconds()
+        trace_add("upstream_wait", max(ttfb - (timings.get("upstream_connect", 0.0) - connect0), 0.0))
+        trace_add("upstream_transfer", max(dt - ttfb, 0.0))
+    return r
+
+def _close_loser(f):
+    if not f.cancelled() and f.exception() is None:
+        f.result().close()
+
+def hedged_request(base_url: str, send):
+    """
+    Chỉ dùng cho request đọc (products.php): nếu lần 1 chưa xong sau hedge_delay() thì gửi
+    thêm lần 2, lấy kết quả thành công (HTTP < 500) về trước. 5xx/lỗi về sớm không thắng:
+    vẫn chờ lần còn lại, chỉ khi cả 2 đều hỏng mới trả 5xx (hoặc ném lỗi của lần đầu).
+    """
+    delay = hedge_delay(base_url)
+    if delay is None:
+        return provider_request(base_url, "products", send, True)
+
+    pool = worker_pool("catalog-hedge", 2 * HTTP_POOL_SIZE)
+    # copy_context: phase của thread trong pool vẫn được cộng vào Server-Timing của request
+    futs = [pool.submit(contextvars.copy_context().run, provider_request, base_url, "products", send, True)]
+    if not wait(futs, timeout=delay).done:
+        metric_inc("upstream_hedged_total", base_url=base_url)
+        futs.append(pool.submit(contextvars.copy_context().run, provider_request, base_url, "products", send, True))
+    pending = set(futs)
+    rejected = []  # lần đã về nhưng là 5xx
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for f in done:
+            if f.exception() is None and f.result().status_code < 500:
+                for other in pending:
+                    other.add_done_callback(_close_loser)
+                for other in rejected:
+                    other.result().close()
+                return f.result()
+        rejected += [f for f in done if f.exception() is None]
+    if rejected:
+        for other in rejected[1:]:
+            other.result().close()
+        return rejected[0].result()
+    return futs[0].result()  # cả 2 lần đều lỗi: ném lỗi của lần đầu
+
+# ========= Rate limit: token bucket theo tài khoản NCC và theo input_key =========
+class RateLimitedError(Exception):
+    """Hàng chờ của token bucket đã đầy: bỏ request thay vì dồn thêm vào NCC."""
+
+def rate_reserve(buckets) -> float:
+    """
+    Lấy 1 token từ mỗi bucket (name, rps, burst) trong cùng 1 transaction (mọi worker dùng chung).
+    Token được phép âm = request đang xếp hàng; trả về số giây phải chờ tới lượt. Nếu phải chờ
+    quá RATE_MAX_WAIT thì không lấy token nào và ném RateLimitedError.
+    """
+    con = db()
+    with con:
+        con.execute("BEGIN IMMEDIATE")
+        now = time.time()
+        wait_s, full, updates = 0.0, None, []
+        for name, rps, burst in buckets:
+            row = con.execute("SELECT tokens, updated_at FROM rate_buckets WHERE name=?", (name,)).fetchone()
+            tokens = burst if row is None else min(burst, row["tokens"] + max(now - row["updated_at"], 0.0) * rps)
+            tokens -= 1
+            if -tokens / rps > wait_s:
+                wait_s, full = -tokens / rps, name
+            updates.append((name, tokens, now))
+        if wait_s > RATE_MAX_WAIT:
+            raise RateLimitedError(f"rate limited ({full}, queue {wait_s:.1f}s > {RATE_MAX_WAIT:g}s)")
+        con.executemany("""
+            INSERT INTO rate_buckets(name, tokens, updated_at) VALUES(?,?,?)
+            ON CONFLICT(name) DO UPDATE SET tokens=excluded.tokens, updated_at=excluded.updated_at
+        """, updates)
+    return wait_s
+
+def rate_reserve_each(buckets) -> dict:
+    """
+    Như rate_reserve nhưng mỗi bucket độc lập, cả nhóm trong 1 transaction: {name: số giây chờ}
+    cho các bucket lấy được token; bucket phải chờ quá RATE_MAX_WAIT không bị trừ và không có trong kết quả.
+    """
+    con = db()
+    with con:
+        con.execute("BEGIN IMMEDIATE")
+        now = time.time()
+        waits, updates = {}, []
+        for name, rps, burst in buckets:
+            row = con.execute("SELECT tokens, updated_at FROM rate_buckets WHERE name=?", (name,)).fetchone()
+            tokens = burst if row is None else min(burst, row["tokens"] + max(now - row["updated_at"], 0.0) * rps)
+            tokens -= 1
+            if -tokens / rps > RATE_MAX_WAIT:
+                continue
+            waits[name] = max(-tokens / rps, 0.0)
+            updates.append((name, tokens, now))
+        con.executemany("""
+            INSERT INTO rate_buckets(name, tokens, updated_at) VALUES(?,?,?)
+            ON CONFLICT(name) DO UPDATE SET tokens=excluded.tokens, updated_at=excluded.updated_at
+        """, updates)
+    return waits
+
+def rate_limit_wait(base_url: str = None, api_key: str = None, input_key: str = None) -> float:
+    """Xin lượt cho 1 request tới NCC (base_url, api_key) hoặc của input_key; trả số giây phải chờ."""
+    if base_url and RATE_PROVIDER_RPS > 0:
+        kind, buckets = "provider", [(f"provider:{base_url}:{api_key}", RATE_PROVIDER_RPS, RATE_PROVIDER_BURST)]
+    elif input_key and RATE_KEY_RPS > 0:
+        kind, buckets = "key", [(f"key:{input_key}", RATE_KEY_RPS, RATE_KEY_BURST)]
+    else:
+        return 0.0
+    try:
+        wait_s = rate_reserve(buckets)
+    except RateLimitedError:
+        metric_inc("rate_limited_total", bucket=kind)
+        raise
+    if wait_s > 0:
+        metric_observe("rate_limit_wait_seconds", wait_s, bucket=kind)
+    return wait_s
+
+def rate_limit(**bucket):
+    """Như rate_limit_wait nhưng tự ngủ tới lượt (phase "queue" trong Server-Timing)."""
+    wait_s = rate_limit_wait(**bucket)
+    if wait_s > 0:
+        with phase("queue"):
+            time.sleep(wait_s)
+
+def admit_key(scope: str, key: str) -> bool:
+    """Rate limit theo input_key cho /stock, /fetch; False (đã log) nếu hàng chờ của key đã đầy."""
+    try:
+        rate_limit(input_key=key)
+        return True
+    except RateLimitedError as e:
+        log(f"{scope.upper()}_ERROR", "rate limited", key=key, error=str(e))
+        metric_error(scope, "rate_limited")
+        return False
+
+def admit_keys(scope: str, keys: list) -> list:
+    """
+    admit_key cho nhiều key (/stock/batch): mỗi key 1 token như /stock, lấy trong 1 transaction
+    và chỉ ngủ 1 lần (tới lượt của key phải chờ lâu nhất). Trả các key được nhận; key bị từ chối đã log.
+    """
+    if RATE_KEY_RPS <= 0 or not keys:
+        return keys
+    waits = rate_reserve_each([(f"key:{k}", RATE_KEY_RPS, RATE_KEY_BURST) for k in keys])
+    admitted = [k for k in keys if f"key:{k}" in waits]
+    limited = [k for k in keys if f"key:{k}" not in waits]
+    if limited:
+        metric_inc("rate_limited_total", len(limited), bucket="key")
+        for _ in limited:
+            metric_error(scope, "rate_limited")
+        log(f"{scope.upper()}_ERROR", "rate limited", keys=limited[:20], count=len(limited))
+    wait_s = max(waits.values(), default=0.0)
+    if wait_s > 0:
+        metric_observe("rate_limit_wait_seconds", wait_s, bucket="key")
+        with phase("queue"):
+            time.sleep(wait_s)
+    return admitted
+
 def mail72h_buy(base_url: str, api_key: str, product_id: int, amount: int) -> dict:
     data = {"action": "buyProduct", "id": product_id, "amount": amount, "api_key": api_key}
     url = f"{base_url.rstrip('/')}/api/buy_product"
-    r = requests.post(url, data=data, timeout=DEFAULT_TIMEOUT)
+    circuit_allow(base_url, probe=False)  # circuit mở: lỗi ngay, không chờ token
+    rate_limit(base_url=base_url, api_key=api_key)
+    # Không retry/hedge: mua hàng không idempotent, gửi lại có thể bị trừ tiền 2 lần
+    r = provider_request(base_url, "buy", lambda: http_session(base_url).post(url, data=data, timeout=(CONNECT_TIMEOUT, READ_TIMEOUT)))
     r.raise_for_status()
     return r.json()
 
-def mail72h_product_list(base_url: str, api_key: str) -> dict:
+def catalog_response(base_url: str, api_key: str, stream=False) -> requests.Response:
+    """GET /api/products.php (có retry/hedge); stream=True: body chưa được đọc."""
     params = {"api_key": api_key}
     url = f"{base_url.rstrip('/')}/api/products.php"
-    r = requests.get(url, params=params, timeout=DEFAULT_TIMEOUT)
-    r.raise_for_status()
-    return r.json()
+    for attempt in range(CATALOG_RETRIES + 1):
+        last = attempt == CATALOG_RETRIES
+        circuit_allow(base_url, probe=False)  # circuit mở: lỗi ngay, không chờ token
+        rate_limit(base_url=base_url, api_key=api_key)
+        try:
+            r = hedged_request(base_url, lambda: http_session(base_url).get(url, params=params, stream=stream, timeout=(CONNECT_TIMEOUT, READ_TIMEOUT)))
+            if r.status_code < 500 or last:
+                r.raise_for_status()
+                return r
+            r.close()
+        except (requests.ConnectionError, requests.Timeout):
+            if last:
+                raise
+        time.sleep(CATALOG_RETRY_BACKOFF * (2 ** attempt))
 
+def mail72h_product_list(base_url: str, api_key: str) -> dict:
+    r = catalog_response(base_url, api_key)
+    with phase("parse"):
+        return r.json()
 
-def stock_mail72h(row):
+def load_catalog_index(base_url: str, api_key: str, want: str = None) -> dict:
+    """
+    Tải catalog và index luôn trong lúc đọc body (stream_catalog_index). `want`: chỉ cần
+    1 product id (không cache) -> dừng đọc ngay khi thấy. Body lỗi/lạ -> parse toàn bộ như cũ.
+    """
+    if not CATALOG_STREAM:
+        return build_catalog_index(mail72h_product_list(base_url, api_key))
+    with closing(catalog_response(base_url, api_key, stream=True)) as r:
+        body = []  # bytes gốc (gọn hơn nhiều so với cây JSON), để parse lại nếu stream lỗi
+        reading = 0.0  # thời gian chờ socket trong lúc parse -> upstream_transfer, phần còn lại là parse
+        def chunks():
+            nonlocal reading
+            it = r.iter_content(CATALOG_STREAM_CHUNK)
+            while True:
+                t0 = time.perf_counter()
+                c = next(it, None)
+                reading += time.perf_counter() - t0
+                if c is None:
+                    return
+                body.append(c)
+                yield c
+        gen = chunks()
+        def full_body():
+            for _ in gen:  # đọc nốt phần body stream chưa đọc tới
+                pass
+            return b"".join(body)
+        t0 = time.perf_counter()
+        try:
+            return index_catalog_chunks(gen, want, full_body)
+        finally:
+            trace_add("upstream_transfer", reading)
+            trace_add("parse", time.perf_counter() - t0 - reading)
+
+
+# ========= Index catalog: product_id -> amount =========
+_NOT_FOUND = object()
+
+def _parse_amount(raw):
+    # === SỬA LỖI 6: Đọc 'amount' thay vì 'stock', "1.234" -> 1234 ===
+    if not raw: # Xử lý None, "", 0
+        return 0
     try:
-        # Tự động lấy base_url từ CSDL. Nếu không set, mặc định là mail72h.com
-        base_url = row['base_url'] or 'https://mail72h.com'
-        # Đây là ID từ CSDL của bạn (ví dụ: "28")
-        pid_to_find_str = str(row["product_id"])
-        
-        list_data = mail72h_product_list(base_url, row["api_key"])
-        
-        if list_data.get("status") != "success":
-            print(f"STOCK_ERROR (API List): {list_data.get('message', 'unknown')}")
-            return jsonify({"sum": 0}), 200
-
-        # SỬA LỖI 6: Dùng hàm _collect_all_products
-        products = _collect_all_products(list_data)
-
-        if not products:
-             # Ghi log chi tiết hơn
-             print(f"STOCK_ERROR: Could not find 'categories' or 'products' list inside /products.php response. Raw data: {str(list_data)[:500]}")
-             return jsonify({"sum": 0}), 200
-
-        stock_val = 0
-        found = False
-        for item in products:
-            if not isinstance(item, dict):
-                continue
-            
-            item_id_raw = item.get("id")
-            if item_id_raw is None:
-                continue
-            
-            # === SỬA LỖI 3: XỬ LÝ ID LÀ SỐ THỰC (FLOAT) "28.0" ===
+        return int(str(raw).replace(".", ""))
+    except (ValueError, TypeError):
+        return None
+
+def build_catalog_index(list_data) -> dict:
+    """
+    Chuẩn hoá catalog 1 lần sau khi tải:
+    {"status", "message", "amounts": {product_id đã chuẩn hoá: amount}, "count", "raw"}.
+    ID dạng float ("28.0") được đưa về "28" ngay tại đây, /stock chỉ còn tra dict.
+    """
+    if not isinstance(list_data, dict):
+        return {"status": "error", "message": f"API response is not a dict: {str(list_data)[:200]}",
+                "amounts": {}, "count": 0, "raw": ""}
+    if list_data.get("status") != "success":
+        return {"status": list_data.get("status"), "message": list_data.get("message", "unknown"),
+                "amounts": {}, "count": 0, "raw": ""}
+
+    # SỬA LỖI 6: Dùng hàm _collect_all_products
+    with phase("collect"):
+        products = _collect_all_products(list_data) or []
+    with phase("index"):
+        amounts = _index_amounts(products)
+    return {"status": "success", "message": "", "amounts": amounts, "count": len(products),
+            "raw": "" if products else str(list_data)[:500]}
+
+def _index_amounts(products) -> dict:
+    amounts = {}
+    for item in products:
+        _index_amounts_add(amounts, item)
+    return amounts
+
+def _index_amounts_add(amounts: dict, item):
+    """Thêm 1 product vào index; trả về product id đã chuẩn hoá (None nếu bỏ qua)."""
+    if not isinstance(item, dict):
+        return None
+    item_id_raw = item.get("id")
+    if item_id_raw is None:
+        return None
+    # isascii(): isdigit() còn nhận cả chữ số Unicode ("²", "٣") mà int() không parse giống
+    if type(item_id_raw) is str and item_id_raw.isascii() and item_id_raw.isdigit() and item_id_raw[0] != "0" and len(item_id_raw) < 16:
+        pid = item_id_raw  # đường nhanh cho id dạng "28": kết quả y như phép chuyển bên dưới
+    else:
+        # === SỬA LỖI 3: XỬ LÝ ID LÀ SỐ THỰC (FLOAT) "28.0" ===
+        try:
+            pid = str(int(float(str(item_id_raw).strip())))
+        except (ValueError, TypeError, OverflowError):
+            log("STOCK_DEBUG", "skipping unparseable product ID", product_id=item_id_raw)
+            return None
+    if pid not in amounts: # Giữ sản phẩm xuất hiện đầu tiên như vòng lặp cũ
+        amounts[pid] = _parse_amount(item.get("amount"))
+    return pid
+
+# ========= Đọc catalog dạng stream: categories[].products[] -> {id: amount} =========
+_WS = re.compile(r"[ \t\n\r]*")
+_SEP = re.compile(r"[ \t\n\r]*([,\]])[ \t\n\r]*")
+_json_decoder = json.JSONDecoder()
+
+class _JsonStream:
+    """
+    Con trỏ đọc JSON từ iterator bytes: chỉ giữ trong RAM phần chưa đọc của chunk hiện tại.
+    Giá trị nhỏ (1 product, status, ...) được decode bằng JSONDecoder.raw_decode.
+    """
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._dec = codecs.getincrementaldecoder("utf-8")()
+        self.buf, self.pos, self.eof = "", 0, False
+
+    def _fill(self) -> bool:
+        while not self.eof:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                self.eof = True
+                text = self._dec.decode(b"", final=True)
+            else:
+                text = self._dec.decode(chunk)
+            if text:
+                self.buf = self.buf[self.pos:] + text
+                self.pos = 0
+                return True
+        return False
+
+    def peek(self) -> str:
+        """Ký tự kế tiếp (bỏ khoảng trắng), "" nếu hết body."""
+        while True:
+            self.pos = _WS.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self._fill():
+                return ""
+
+    def expect(self, ch: str):
+        if self.peek() != ch:
+            raise ValueError(f"expected {ch!r}, got {self.buf[self.pos:self.pos + 20]!r}")
+        self.pos += 1
+
+    def value(self):
+        while True:
+            self.peek()
             try:
-                item_id_str_cleaned = str(int(float(str(item_id_raw).strip())))
-            except (ValueError, TypeError):
-                print(f"STOCK_DEBUG: Skipping unparseable product ID: {item_id_raw}")
+                val, end = _json_decoder.raw_decode(self.buf, self.pos)
+            except ValueError:
+                if self._fill():  # giá trị bị cắt giữa 2 chunk
+                    continue
+                raise
+            if end == len(self.buf) and self._fill():  # số ở cuối chunk có thể còn chữ số phía sau
                 continue
-            
-            if item_id_str_cleaned == pid_to_find_str:
-                
-                # ==========================================================
-                # === SỬA LỖI 6: Đọc 'amount' thay vì 'stock' ===
-                # ==========================================================
-                stock_from_api = item.get("amount") 
-                if not stock_from_api: # Xử lý None, "", 0
-                    stock_from_api = 0
-                
-                stock_val = int(str(stock_from_api).replace(".", ""))
-                # ==========================================================
-                
-                found = True
-                break
-        
-        if not found:
-            print(f"STOCK_ERROR: Product ID {pid_to_find_str} not found in *any* category. (Collected {len(products)} products, but ID mismatch. Check your admin config.)")
-            return jsonify({"sum": 0}), 200 
-        
-        return jsonify({"sum": stock_val})
+            self.pos = end
+            return val
 
-    except requests.HTTPError as e:
-        err_msg = f"mail72h http error {e.response.status_code}"
+    def members(self):
+        """Yield từng key của object; người gọi phải đọc value tương ứng trước khi lấy key kế."""
+        self.expect("{")
+        if self.peek() == "}":
+            self.pos += 1
+            return
+        while True:
+            key = self.value()
+            if not isinstance(key, str):
+                raise ValueError("object key is not a string")
+            self.expect(":")
+            yield key
+            c = self.peek()
+            self.pos += 1
+            if c == "}":
+                return
+            if c != ",":
+                raise ValueError(f"expected ',' or '}}', got {c!r}")
+
+    def values(self):
+        """
+        Yield từng phần tử (đã decode) của array. Đường nhanh cho array products dài: decode và
+        nhảy qua dấu phẩy ngay trên buffer; chỉ khi chạm ranh giới chunk mới đi đường chậm.
+        """
+        self.expect("[")
+        if self.peek() == "]":
+            self.pos += 1
+            return
+        buf, pos = self.buf, self.pos
+        while True:
+            try:
+                val, end = _json_decoder.raw_decode(buf, pos)
+                if end == len(buf):
+                    raise ValueError("value may continue in next chunk")
+            except ValueError:
+                self.pos = pos
+                val = self.value()
+                buf, end = self.buf, self.pos
+            yield val
+            m = _SEP.match(buf, end)
+            if m is None or m.end() == len(buf):
+                self.pos = end
+                c = self.peek()
+                self.pos += 1
+                if c == "]":
+                    return
+                if c != ",":
+                    raise ValueError(f"expected ',' or ']', got {c!r}")
+                self.peek()
+                buf, pos = self.buf, self.pos
+            elif m.group(1) == "]":
+                self.pos = m.end()
+                return
+            else:
+                pos = m.end()
+
+    def elements(self):
+        """Yield 1 lần cho mỗi phần tử array; người gọi phải đọc phần tử đó."""
+        self.expect("[")
+        if self.peek() == "]":
+            self.pos += 1
+            return
+        while True:
+            yield
+            c = self.peek()
+            self.pos += 1
+            if c == "]":
+                return
+            if c != ",":
+                raise ValueError(f"expected ',' or ']', got {c!r}")
+
+def stream_catalog_index(chunks, want: str = None):
+    """
+    Như build_catalog_index nhưng đọc {"status", "message", "categories": [{"products": [...]}]}
+    từng phần, mỗi product chỉ giữ id/amount. Có `want` và đã thấy status success -> dừng ngay
+    khi gặp product đó (kết quả "partial", không được cache). Trả None nếu không tìm thấy
+    product nào (để build_catalog_index log/raw đúng như cũ); ValueError nếu body không hợp lệ.
+    """
+    s = _JsonStream(chunks)
+    status, message, amounts, count = None, None, {}, 0
+    for key in s.members():
+        if key == "categories" and s.peek() == "[":
+            for _ in s.elements():
+                if s.peek() != "{":
+                    s.value()
+                    continue
+                for ckey in s.members():
+                    if ckey != "products" or s.peek() != "[":
+                        s.value()
+                        continue
+                    for item in s.values():
+                        count += 1
+                        pid = _index_amounts_add(amounts, item)
+                        if want is not None and pid == want and status == "success":
+                            return {"status": "success", "message": "", "amounts": {pid: amounts[pid]},
+                                    "count": count, "raw": "", "partial": True}
+        elif key == "status":
+            status = s.value()
+        elif key == "message":
+            message = s.value()
+        else:
+            s.value()
+    if s.peek() != "":
+        raise ValueError("trailing data after catalog")
+    if status != "success":
+        return {"status": status, "message": "unknown" if message is None else message,
+                "amounts": {}, "count": 0, "raw": ""}
+    if not count:
+        return None
+    return {"status": "success", "message": "", "amounts": amounts, "count": count, "raw": ""}
+
+def index_catalog_chunks(chunks, want, full_body) -> dict:
+    """stream_catalog_index, lỗi/không có product -> build_catalog_index(json.loads(full_body()))."""
+    try:
+        data = stream_catalog_index(chunks, want)
+    except ValueError as e:
+        log("STOCK_DEBUG", "streaming catalog parse failed, falling back to full parse", error=str(e))
+        metric_inc("catalog_parse_fallback_total")
+        data = None
+    if data is None:
+        data = build_catalog_index(json.loads(full_body()))
+    return data
+
+
+# ========= Cache catalog theo (base_url, api_key) =========
+# Nhiều input_key dùng chung một tài khoản NCC -> chỉ tải catalog 1 lần / TTL.
+_catalog_cache = {}     # (base_url, api_key) -> (monotonic lúc tải, catalog đã index)
+_snapshot_seen = {}     # (base_url, api_key) -> fetched_at của snapshot mới nhất đã có trong RAM
+_catalog_inflight = {}  # (base_url, api_key) -> Future của lần tải đang chạy
+_catalog_lock = threading.Lock()
+
+def _load_catalog(ck, fut: Future, want: str = None) -> dict:
+    # Chỉ "leader" của một lần single-flight gọi hàm này
+    fk = ck if want is None else (*ck, want)
+    try:
+        data = load_catalog_index(*ck, want)
+    except BaseException as e:
+        with _catalog_lock:
+            _catalog_inflight.pop(fk, None)
+        fut.set_exception(e)
+        raise
+
+    store_catalog(ck, data)
+    with _catalog_lock:
+        _catalog_inflight.pop(fk, None)
+    fut.set_result(data)
+    return data
+
+def store_catalog(ck, data: dict):
+    """Lưu catalog vừa tải vào cache RAM (+ snapshot SQLite)."""
+    # Chỉ cache khi NCC trả về thành công (và đủ cả catalog), lỗi API thì lần sau gọi lại
+    if not _catalog_caching() or data["status"] != "success" or data.get("partial"):
+        return
+    if CATALOG_SNAPSHOTS:
         try:
-            err_detail = e.response.json().get('message', e.response.text)
-            err_msg = f"mail72h error: {err_detail}"
-        except:
-            err_msg = f"mail72h http error {e.response.status_code}: {e.response.text}"
-        print(f"STOCK_ERROR (HTTP): {err_msg}")
-        return jsonify({"sum": 0}), 200
-    
+            save_snapshot(ck, data)
+        except Exception as e:
+            log("SNAPSHOT_ERROR", "save failed", error=str(e))
+    with _catalog_lock:
+        _catalog_cache[ck] = (time.monotonic(), data)
+
+def _catalog_caching() -> bool:
+    return CATALOG_TTL > 0 or STOCK_REFRESH_INTERVAL > 0
+
+
+# ========= Snapshot catalog trong SQLite (dùng chung giữa các worker) =========
+def save_snapshot(ck, data: dict):
+    fetched_at = time.time()
+    with db() as con:
+        con.execute("""
+            INSERT OR REPLACE INTO catalog_snapshots(base_url, api_key, fetched_at, product_count, amounts, raw)
+            VALUES(?,?,?,?,?,?)
+        """, (ck[0], ck[1], fetched_at, data["count"], json.dumps(data["amounts"]), data["raw"]))
+        con.commit()
+    with _catalog_lock:
+        _snapshot_seen[ck] = fetched_at
+
+def snapshot_fetched_at(ck):
+    """fetched_at của snapshot trong SQLite (chỉ đọc 1 cột, không đọc payload) hoặc None."""
+    with db() as con:
+        row = con.execute("SELECT fetched_at FROM catalog_snapshots WHERE base_url=? AND api_key=?", ck).fetchone()
+    return row["fetched_at"] if row else None
+
+def load_snapshot(ck):
+    """(monotonic tương ứng lúc tải, catalog đã index) hoặc None."""
+    with db() as con:
+        row = con.execute("SELECT * FROM catalog_snapshots WHERE base_url=? AND api_key=?", ck).fetchone()
+    if not row:
+        return None
+    data = {"status": "success", "message": "", "amounts": json.loads(row["amounts"]),
+            "count": row["product_count"], "raw": row["raw"]}
+    # fetched_at là giờ hệ thống, cache trong RAM dùng monotonic
+    return (time.monotonic() - max(time.time() - row["fetched_at"], 0.0), data)
+
+def _sync_snapshot(ck):
+    # Bản trong RAM đã hết hạn: xem worker khác (hoặc lần chạy trước restart) đã lưu bản mới hơn chưa
+    with _catalog_lock:
+        hit = _catalog_cache.get(ck)
+    if hit and time.monotonic() - hit[0] < CATALOG_TTL:
+        return
+    # Đọc fetched_at trước; chỉ parse payload (amounts có thể rất lớn) khi snapshot mới hơn bản đã có
+    try:
+        with phase("snapshot"):
+            fetched_at = snapshot_fetched_at(ck)
+            with _catalog_lock:
+                seen = _snapshot_seen.get(ck, 0.0)
+            if fetched_at is None or (hit is not None and fetched_at <= seen):
+                metric_cache("snapshot", "miss" if fetched_at is None else "unchanged")
+                return
+            snap = load_snapshot(ck)
     except Exception as e:
-        print(f"STOCK_ERROR (Processing/Other): {e}")
-        return jsonify({"sum": 0}), 200
+        log("SNAPSHOT_ERROR", "load failed", error=str(e))
+        return
+    metric_cache("snapshot", "hit" if snap else "miss")
+    if snap:
+        with _catalog_lock:
+            cur = _catalog_cache.get(ck)
+            if cur is None or cur[0] < snap[0]:
+                _catalog_cache[ck] = snap
+            _snapshot_seen[ck] = max(_snapshot_seen.get(ck, 0.0), fetched_at)
 
-def fetch_mail72h(row, qty):
+def refresh_catalog(base_url: str, api_key: str):
+    """Tải lại catalog bỏ qua TTL (dùng ở background); không làm gì nếu đang có lần tải khác."""
+    ck = (base_url, api_key)
+    with _catalog_lock:
+        if ck in _catalog_inflight:
+            return
+        fut = _catalog_inflight[ck] = Future()
+    try:
+        _load_catalog(ck, fut)
+    except Exception as e:
+        log("REFRESH_ERROR", "catalog refresh failed", base_url=base_url, error=str(e))
+        metric_error("refresh", exception_class(e))
+
+def peek_catalog(base_url: str, api_key: str):
+    """
+    Catalog dùng được ngay từ RAM/snapshot (không gọi NCC), hoặc None nếu phải tải.
+    Bản quá TTL nhưng chưa quá CATALOG_MAX_STALENESS (khi bật refresher) vẫn được trả,
+    kèm theo việc lên lịch tải lại ở background (stale-while-revalidate).
+    """
+    ck = (base_url, api_key)
+    if CATALOG_SNAPSHOTS and _catalog_caching():
+        _sync_snapshot(ck)
+    with _catalog_lock:
+        hit = _catalog_cache.get(ck)
+        refreshing = ck in _catalog_inflight
+    if not hit:
+        metric_cache("catalog", "miss")
+        return None
+    age = time.monotonic() - hit[0]
+    if age < CATALOG_TTL:
+        metric_cache("catalog", "hit")
+        return hit[1]
+    if STOCK_REFRESH_INTERVAL > 0 and age < CATALOG_MAX_STALENESS:
+        metric_cache("catalog", "stale")
+        # Có leader dùng chung snapshot: worker khác chỉ chờ snapshot mới, không tự gọi NCC
+        if not refreshing and (_refresh_leader or not (STOCK_REFRESH_LEADER and CATALOG_SNAPSHOTS)):
+            refresh_pool().submit(refresh_catalog, base_url, api_key)
+        return hit[1]
+    metric_cache("catalog", "miss")
+    return None
+
+def get_catalog(base_url: str, api_key: str, want: str = None) -> dict:
+    """
+    Trả về catalog đã index (build_catalog_index) của NCC, ưu tiên cache (peek_catalog).
+    Các request cùng miss một key sẽ chờ chung MỘT lần gọi /api/products.php
+    (single-flight); lỗi của lần gọi đó được ném lại cho tất cả.
+    Khi bật CATALOG_SNAPSHOTS, bản của worker khác trong SQLite được dùng trước khi gọi NCC.
+    `want` (1 product id): khi không cache catalog thì chỉ đọc body tới product đó.
+    """
+    data = peek_catalog(base_url, api_key)
+    if data is not None:
+        return data
+
+    ck = (base_url, api_key)
+    want = want if want is not None and not _catalog_caching() else None
+    fk = ck if want is None else (*ck, want)
+    with _catalog_lock:
+        fut = _catalog_inflight.get(fk)
+        leader = fut is None
+        if leader:
+            fut = _catalog_inflight[fk] = Future()
+    if not leader:
+        return fut.result()
+    return _load_catalog(ck, fut, want)
+
+
+# ========= Background refresher (mỗi worker 1 thread lập lịch) =========
+_refresher_pid = None
+_refresher_lock = threading.Lock()
+_refresh_leader = False  # worker này đang giữ lease "stock-refresher"
+
+def refresh_pool() -> ThreadPoolExecutor:
+    """Thread pool tải catalog ở background, NCC chậm không chặn lịch của NCC khác."""
+    return worker_pool("stock-refresh", STOCK_REFRESH_WORKERS)
+
+def active_accounts() -> set:
+    """Các cặp (base_url, api_key) khác nhau của keymaps đang bật."""
+    with db() as con:
+        rows = con.execute("""
+            SELECT DISTINCT COALESCE(NULLIF(base_url, ''), 'https://mail72h.com') AS base_url, api_key
+            FROM keymaps WHERE is_active=1 AND provider_type != ''
+        """).fetchall()
+    return {(r["base_url"], r["api_key"]) for r in rows}
+
+def _next_refresh(now: float) -> float:
+    return now + STOCK_REFRESH_INTERVAL * (1 + random.uniform(-STOCK_REFRESH_JITTER, STOCK_REFRESH_JITTER))
+
+def _refresher_loop():
+    global _refresh_leader
+    due = {}  # (base_url, api_key) -> monotonic lần refresh kế tiếp
+    next_scan = 0.0
+    leader = True
+    while True:
+        now = time.monotonic()
+        if now >= next_scan:
+            scan_every = max(STOCK_REFRESH_INTERVAL, 5)
+            if STOCK_REFRESH_LEADER and CATALOG_SNAPSHOTS:
+                # Snapshot dùng chung -> chỉ 1 worker cần gọi NCC, các worker khác đọc snapshot
+                try:
+                    leader = try_lease("stock-refresher", scan_every * 3)
+                except Exception as e:
+                    log("REFRESH_ERROR", "lease failed", error=str(e))
+                    leader = False
+                _refresh_leader = leader
+            try:
+                accounts = active_accounts()
+            except Exception as e:
+                log("REFRESH_ERROR", "keymap scan failed", error=str(e))
+                accounts = set(due)
+            for ck in accounts - set(due):
+                # Rải đều các NCC trong 1 chu kỳ thay vì tải tất cả cùng lúc
+                due[ck] = now + STOCK_REFRESH_INTERVAL * random.random()
+            for ck in set(due) - accounts:
+                del due[ck]
+            next_scan = now + scan_every
+
+        for ck, t in list(due.items()):
+            if t <= now:
+                if leader:
+                    refresh_pool().submit(refresh_catalog, *ck)
+                due[ck] = _next_refresh(now)
+
+        wake = min([next_scan, *due.values()])
+        time.sleep(min(max(wake - time.monotonic(), 0.05), 1.0))
+
+def start_refresher():
+    """Bật thread refresher cho worker hiện tại (1 lần / process)."""
+    global _refresher_pid
+    if STOCK_REFRESH_INTERVAL <= 0 or _refresher_pid == os.getpid():
+        return
+    with _refresher_lock:
+        if _refresher_pid == os.getpid():
+            return
+        _refresher_pid = os.getpid()
+        threading.Thread(target=_refresher_loop, name="stock-refresher", daemon=True).start()
+
+
+def http_error_message(e: requests.HTTPError) -> str:
+    try:
+        err_detail = e.response.json().get('message', e.response.text)
+        return f"mail72h error: {err_detail}"
+    except:
+        return f"mail72h http error {e.response.status_code}: {e.response.text}"
+
+def stock_from_catalog(row, catalog: dict) -> int:
+    """
+    Tra amount của row trong catalog đã index (dict lookup, không quét list).
+    Lỗi nào cũng trả về 0 và ghi log giống như trước.
+    """
+    # Đây là ID từ CSDL của bạn (ví dụ: "28")
+    pid_to_find_str = str(row["product_id"])
+
+    if catalog["status"] != "success":
+        log("STOCK_ERROR", "API list returned error", message=catalog["message"])
+        metric_error("stock", "api_status")
+        return 0
+
+    if not catalog["count"]:
+        # Ghi log chi tiết hơn
+        log("STOCK_ERROR", "could not find 'categories' or 'products' list inside /products.php response", raw=catalog["raw"])
+        metric_error("stock", "parse")
+        return 0
+
+    stock_val = catalog["amounts"].get(pid_to_find_str, _NOT_FOUND)
+    if stock_val is _NOT_FOUND:
+        log("STOCK_ERROR", "product ID not found in any category, check admin config",
+            product_id=pid_to_find_str, collected=catalog["count"])
+        metric_error("stock", "not_found")
+        return 0
+    if stock_val is None:
+        log("STOCK_ERROR", "unparseable amount", product_id=pid_to_find_str)
+        metric_error("stock", "parse")
+        return 0
+    return stock_val
+
+def stock_total(row, catalog: dict) -> int:
+    """Số hàng còn trong kho đệm + amount của NCC."""
+    with phase("match"):
+        upstream = stock_from_catalog(row, catalog)
+    return inventory_count(row) + upstream
+
+def stock_mail72h(row):
     try:
         # Tự động lấy base_url từ CSDL. Nếu không set, mặc định là mail72h.com
         base_url = row['base_url'] or 'https://mail72h.com'
-        res = mail72h_buy(base_url, row["api_key"], int(row["product_id"]), qty)
-    
+        catalog = get_catalog(base_url, row["api_key"], want=str(row["product_id"]))
+        return jsonify({"sum": stock_total(row, catalog)})
+
     except requests.HTTPError as e:
-        err_msg = f"mail72h http error {e.response.status_code}"
-        try:
-            err_detail = e.response.json().get('message', e.response.text)
-            err_msg = f"mail72h error: {err_detail}"
-        except:
-            err_msg = f"mail72h http error {e.response.status_code}: {e.response.text}"
-        print(f"FETCH_ERROR (HTTP): {err_msg}")
-        return jsonify([]), 200
+        log("STOCK_ERROR", "HTTP error", error=http_error_message(e))
+        metric_error("stock", "http")
+        return jsonify({"sum": inventory_stock(row)}), 200
+    
+    except Exception as e:
+        log("STOCK_ERROR", "processing error", error=repr(e))
+        metric_error("stock", exception_class(e))
+        return jsonify({"sum": inventory_stock(row)}), 200
 
+def stock_for_account(base_url: str, api_key: str, rows) -> dict:
+    """
+    Stock cho nhiều key cùng 1 tài khoản NCC: tải catalog 1 lần, trả {input_key: sum}.
+    Lỗi khi tải catalog -> mỗi key chỉ còn số hàng trong kho đệm (giống stock_mail72h).
+    """
+    try:
+        catalog = get_catalog(base_url, api_key)
+    except requests.HTTPError as e:
+        log("STOCK_ERROR", "HTTP error", error=http_error_message(e))
+        metric_error("stock", "http")
+        return {r["input_key"]: inventory_stock(r) for r in rows}
     except Exception as e:
-        print(f"FETCH_ERROR (Connect): {e}")
-        return jsonify([]), 200
+        log("STOCK_ERROR", "processing error", error=repr(e))
+        metric_error("stock", exception_class(e))
+        return {r["input_key"]: inventory_stock(r) for r in rows}
+    return {r["input_key"]: stock_total(r, catalog) for r in rows}
+
+def stock_batch(keys) -> dict:
+    """Resolve tất cả key bằng 1 query, gom theo (base_url, api_key), mỗi catalog tải 1 lần."""
+    rows = find_maps_by_keys(keys)
+    out = {k: 0 for k in keys}
+    for k, row in rows.items():
+        if not row:
+            log("STOCK_ERROR", "unknown key", key=k)
+            metric_error("stock", "unknown_key")
+    # Rate limit theo input_key như /stock: batch không được vượt giới hạn của từng key
+    admitted = admit_keys("stock", [k for k, row in rows.items() if row])
+    groups = {}
+    for k in admitted:
+        row = rows[k]
+        if not row['provider_type']:
+            log("STOCK_ERROR", "provider not supported or not set", provider=row["provider_type"])
+            continue
+        base_url = row['base_url'] or 'https://mail72h.com'
+        groups.setdefault((base_url, row["api_key"]), []).append(row)
+
+    if len(groups) == 1:
+        (base_url, api_key), grp = next(iter(groups.items()))
+        out.update(stock_for_account(base_url, api_key, grp))
+    elif groups:
+        # Thread pool (mỗi worker) để tải catalog của nhiều NCC song song
+        pool = worker_pool("stock-batch", BATCH_MAX_WORKERS)
+        futs = [pool.submit(stock_for_account, b, a, grp) for (b, a), grp in groups.items()]
+        for f in futs:
+            out.update(f.result())
+    return out
+
+def fetch_mail72h(row, qty, order_id=None):
+    if order_id and not order_claim(row, order_id, qty):
+        return jsonify(order_replay(row, order_id))
+    try:
+        items = take_inventory(row, qty)
+    except Exception:
+        order_release(row, order_id)  # chưa mua gì: không để claim treo tới ORDER_PENDING_TTL
+        raise
+    if items is None:
+        if FETCH_CHUNK_SIZE > 0 and qty > FETCH_CHUNK_SIZE:
+            return fetch_mail72h_chunked(row, qty, order_id)
+        items, err = buy_live(row, qty)
+        if err is not None:
+            order_failed(row, order_id, err)
+            return jsonify(items)
+    order_record(row, order_id, items)
+    return jsonify(items)
+
+def buy_live(row, qty):
+    """Mua cả đơn trong 1 lần buyProduct -> (items, BuyError hoặc None) như buy_chunk."""
+    # Tự động lấy base_url từ CSDL. Nếu không set, mặc định là mail72h.com
+    base_url = row['base_url'] or 'https://mail72h.com'
+    items, err = buy_chunk(base_url, row["api_key"], int(row["product_id"]), qty)
+    if err is not None:
+        log("FETCH_ERROR", "buy failed", error=str(err), outcome_unknown=err.unknown)
+    return items, err
 
+def fetch_items(res: dict, qty: int) -> list:
+    """Chuyển kết quả buyProduct thành list [{"product": ...}] trả cho Tạp Hóa."""
     if res.get("status") != "success":
-        print(f"FETCH_ERROR (API): {res.get('message', 'mail72h buy failed')}")
-        return jsonify([]), 200
+        log("FETCH_ERROR", "API buy returned error", message=res.get("message", "mail72h buy failed"))
+        metric_error("fetch", "api_status")
+        return []
 
     data = res.get("data")
     out = []
@@ -207,8 +1688,338 @@ def fetch_mail72h(row, qty):
     else:
         t = json.dumps(data, ensure_ascii=False) if isinstance(data, dict) else str(data)
         out = [{"product": t} for _ in range(qty)]
-    
-    return jsonify(out)
+    return out
+
+
+# ========= /fetch số lượng lớn: mua theo phần, stream JSON =========
+def chunk_sizes(qty: int, size: int) -> list:
+    sizes = [size] * (qty // size)
+    if qty % size:
+        sizes.append(qty % size)
+    return sizes
+
+class BuyError(Exception):
+    """
+    Lỗi khi mua 1 phần. unknown=True: request có thể đã tới NCC (5xx, timeout lúc chờ/đọc
+    response, body hỏng) -> không biết NCC đã trừ tiền/giao hàng chưa.
+    """
+    def __init__(self, message: str, unknown: bool = False):
+        super().__init__(message)
+        self.unknown = unknown
+
+def buy_outcome_unknown(e: Exception) -> bool:
+    """False chỉ khi chắc chắn request mua chưa được gửi (circuit mở, rate limit, không kết nối được)."""
+    if isinstance(e, (CircuitOpenError, RateLimitedError, requests.ConnectTimeout)):
+        return False
+    if isinstance(e, requests.ConnectionError):
+        reason = getattr(e.args[0], "reason", None) if e.args else None
+        return not isinstance(reason, NewConnectionError)
+    return True
+
+def buy_chunk(base_url: str, api_key: str, product_id: int, n: int):
+    """Mua 1 phần của đơn lớn -> (items, BuyError hoặc None)."""
+    try:
+        res = mail72h_buy(base_url, api_key, product_id, n)
+    except requests.HTTPError as e:
+        metric_error("fetch", "http")
+        return [], BuyError(f"HTTP: {http_error_message(e)}", unknown=e.response.status_code >= 500)
+    except Exception as e:
+        metric_error("fetch", exception_class(e))
+        return [], BuyError(f"Connect: {e}", unknown=buy_outcome_unknown(e))
+    if res.get("status") != "success":
+        metric_error("fetch", "api_status")
+        return [], BuyError(f"API: {res.get('message', 'mail72h buy failed')}")
+    return fetch_items(res, n), None
+
+def log_abandoned_chunk(row, n: int, items: list, err):
+    """Phần đã gửi NCC nhưng không còn ai nhận (client ngắt): ghi cả hàng để đối soát/giao lại."""
+    log("ORDER_ERROR", "chunk bought after client disconnected", key=row["input_key"], quantity=n,
+        bought=len(items), items=[it["product"] for it in items], error=str(err) if err else None)
+
+def buy_in_chunks(row, qty: int, on_abandoned=None):
+    """
+    Yield (số lượng của phần, items, lỗi) theo thứ tự phần nào xong trước.
+    Tối đa FETCH_CHUNK_CONCURRENCY phần chạy cùng lúc; khi 1 phần lỗi thì không gửi thêm
+    phần mới (thường là hết hàng/hết tiền), chỉ chờ các phần đang chạy.
+    Generator bị đóng sớm: phần chưa chạy bị huỷ, phần đang mua được chờ xong rồi giao cho
+    on_abandoned(n, items, lỗi) (mặc định log_abandoned_chunk) -> hàng đã trả tiền không bị mất.
+    """
+    base_url = row['base_url'] or 'https://mail72h.com'
+    sizes = chunk_sizes(qty, FETCH_CHUNK_SIZE)
+    pool = worker_pool("fetch-chunk", FETCH_POOL_WORKERS)
+    pending = {}  # Future -> số lượng
+    failed = False
+    try:
+        while pending or (sizes and not failed):
+            while sizes and not failed and len(pending) < FETCH_CHUNK_CONCURRENCY:
+                n = sizes.pop(0)
+                pending[pool.submit(buy_chunk, base_url, row["api_key"], int(row["product_id"]), n)] = n
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for f in done:
+                items, err = f.result()
+                failed = failed or err is not None
+                yield pending.pop(f), items, err
+    finally:
+        for f, n in pending.items():
+            if f.cancel():
+                continue
+            items, err = f.result()
+            (on_abandoned or (lambda *a: log_abandoned_chunk(row, *a)))(n, items, err)
+
+def fetch_mail72h_chunked(row, qty: int, order_id=None):
+    """
+    Stream mảng JSON [{"product": ...}, ...], mỗi phần mua xong được gửi ngay.
+    Mọi hàng (kể cả phần mua xong sau khi client ngắt) đều vào nhật ký đơn; đơn chỉ được chốt
+    'done' khi biết kết quả của mọi phần và ghi nhật ký đủ, không thì để 'pending' để đối soát.
+    Không mua được đơn vị nào (và biết chắc NCC chưa giao) -> bỏ claim như order_failed.
+    """
+    def generate():
+        delivered, journaled, errors, finished = 0, 0, [], False
+        settled = True  # mọi phần đều biết kết quả và mọi hàng đều đã vào nhật ký
+
+        def journal(items):
+            nonlocal journaled, settled
+            settled = order_record(row, order_id, items, seq=journaled, done=False) and settled
+            journaled += len(items)
+
+        def abandoned(n, items, err):
+            nonlocal settled
+            log_abandoned_chunk(row, n, items, err)
+            settled = settled and not (err and err.unknown)
+            if items:
+                journal(items)
+
+        chunks = buy_in_chunks(row, qty, on_abandoned=abandoned)
+        try:
+            yield "["
+            for n, items, err in chunks:
+                if err:
+                    errors.append(f"{n} units: {err}")
+                    settled = settled and not err.unknown
+                if items:
+                    # Ghi nhật ký trước khi gửi: client ngắt giữa chừng thì lần gửi lại vẫn nhận đủ
+                    journal(items)
+                    piece = ("," if delivered else "") + ",".join(json.dumps(it, separators=(",", ":")) for it in items)
+                    delivered += len(items)
+                    yield piece
+            yield "]\n"
+            finished = True
+        finally:
+            chunks.close()  # chờ các phần đang mua dở (buy_in_chunks) rồi ghi hàng của chúng vào nhật ký
+            if not settled:
+                if order_id:
+                    log("ORDER_ERROR", "order left pending, chunk outcome unknown", key=row["input_key"],
+                        order_id=order_id, journaled=journaled, quantity=qty)
+            elif journaled:
+                order_record(row, order_id, [], done=True)
+            else:
+                order_release(row, order_id)  # chắc chắn chưa mua được gì: lần gửi lại được mua
+            # Đơn giao thiếu: ghi lại số đã giao để đối soát với NCC
+            if errors or not finished:
+                why = "; ".join(errors) if errors else "client disconnected"
+                log("ORDER_ERROR", "chunked fetch incomplete", key=row["input_key"], delivered=delivered,
+                    journaled=journaled, quantity=qty, error=why)
+    return Response(generate(), mimetype="application/json")
+
+
+# ========= Nhật ký đơn: /fetch?order_id=... gửi lại không mua lần 2 =========
+def order_claim(row, order_id: str, qty: int) -> bool:
+    """True nếu request này là lần đầu của order_id (được phép mua), False nếu đơn đã có."""
+    with db() as con:
+        cur = con.execute("""
+            INSERT INTO orders(input_key, order_id, quantity, status, created_at) VALUES(?,?,?,'pending',?)
+            ON CONFLICT(input_key, order_id) DO NOTHING
+        """, (row["input_key"], order_id, qty, time.time()))
+        con.commit()
+    claimed = cur.rowcount == 1
+    metric_cache("order", "miss" if claimed else "hit")
+    return claimed
+
+def order_record(row, order_id, items: list, seq: int = 0, done: bool = True) -> bool:
+    """
+    Ghi hàng đã giao vào nhật ký (commit trước khi trả response; WAL + synchronous=NORMAL nên
+    chỉ tốn 1 lần ghi WAL, không fsync). Lỗi ghi không được làm mất hàng của khách: chỉ log
+    (kèm nội dung hàng) và trả False.
+    """
+    if not order_id:
+        return True
+    try:
+        with phase("db"), db() as con:
+            con.executemany("INSERT INTO order_journal(input_key, order_id, seq, item) VALUES(?,?,?,?)",
+                            [(row["input_key"], order_id, seq + i, it["product"]) for i, it in enumerate(items)])
+            if done:
+                con.execute("UPDATE orders SET status='done' WHERE input_key=? AND order_id=?",
+                            (row["input_key"], order_id))
+            con.commit()
+    except Exception as e:
+        log("ORDER_ERROR", "items not journaled", key=row["input_key"], order_id=order_id,
+            items=[it["product"] for it in items], error=str(e))
+        return False
+    return True
+
+def order_release(row, order_id):
+    """Bỏ claim của đơn chưa mua được gì: lần gửi lại cùng order_id được mua như đơn mới."""
+    if not order_id:
+        return
+    with phase("db"), db() as con:
+        con.execute("DELETE FROM orders WHERE input_key=? AND order_id=? AND status='pending'",
+                    (row["input_key"], order_id))
+        con.commit()
+
+def order_failed(row, order_id, err):
+    """
+    Lần mua của đơn lỗi, không có hàng nào. Lỗi chắc chắn (circuit mở, rate limit, API báo lỗi)
+    -> order_release. Không biết NCC đã trừ tiền chưa (err.unknown) -> để 'pending' để đối soát,
+    lần gửi lại chỉ được trả nhật ký, không mua lần 2.
+    """
+    if not order_id:
+        return
+    if err.unknown:
+        log("ORDER_ERROR", "order left pending, buy outcome unknown", key=row["input_key"],
+            order_id=order_id, error=str(err))
+        return
+    order_release(row, order_id)
+
+def order_state(row, order_id: str):
+    """
+    (status, list [{"product": ...}] đã ghi nhật ký). status: 'pending' | 'done' | 'expired' | None
+    (không có đơn). 'pending' quá ORDER_PENDING_TTL được chuyển sang 'expired' (1 lần, có log):
+    không ai còn mua cho đơn đó nữa nhưng cũng không biết NCC đã giao gì -> không mua lại, chỉ đối soát.
+    """
+    with phase("db"), db() as con:
+        st = con.execute("SELECT status, created_at FROM orders WHERE input_key=? AND order_id=?",
+                         (row["input_key"], order_id)).fetchone()
+        items = con.execute("SELECT item FROM order_journal WHERE input_key=? AND order_id=? ORDER BY seq",
+                            (row["input_key"], order_id)).fetchall()
+        status = st["status"] if st else None
+        if status == "pending" and st["created_at"] < time.time() - ORDER_PENDING_TTL:
+            cur = con.execute("UPDATE orders SET status='expired' WHERE input_key=? AND order_id=? AND status='pending'",
+                              (row["input_key"], order_id))
+            con.commit()
+            status = "expired"
+            if cur.rowcount:
+                log("ORDER_ERROR", "stale pending order expired", key=row["input_key"], order_id=order_id,
+                    items=[r["item"] for r in items], age=round(time.time() - st["created_at"]))
+    return status, [{"product": r["item"]} for r in items]
+
+def order_replay(row, order_id: str) -> list:
+    """Trả lại hàng của đơn đã có; đơn còn đang mua ở request khác thì chờ tối đa ORDER_WAIT giây."""
+    deadline = time.monotonic() + ORDER_WAIT
+    while True:
+        status, items = order_state(row, order_id)
+        if status != "pending" or time.monotonic() >= deadline:
+            break
+        time.sleep(0.2)
+    if status not in ("done", None):
+        log("ORDER_ERROR", f"order {status}, replayed journal", key=row["input_key"], order_id=order_id, items=len(items))
+    return items
+
+
+# ========= Kho đệm: mua trước hàng cho key bán chạy, /fetch lấy ngay từ SQLite =========
+def inventory_count(row) -> int:
+    if not row["buffer_high"]:
+        return 0
+    with phase("db"), db() as con:
+        return con.execute("SELECT COUNT(*) FROM inventory WHERE input_key=? AND product_id=?",
+                           (row["input_key"], int(row["product_id"]))).fetchone()[0]
+
+def inventory_drop(con, input_key: str, product_id: int, why: str):
+    """
+    Xoá kho đệm của (input_key, product_id) trong transaction đang mở của con (xoá key, đổi
+    product_id...). Hàng đã trả tiền nên ghi lại nội dung để đối soát/giao tay.
+    """
+    items = [r["item"] for r in con.execute(
+        "SELECT item FROM inventory WHERE input_key=? AND product_id=? ORDER BY id", (input_key, product_id))]
+    if items:
+        log("INVENTORY_ERROR", why, key=input_key, product_id=product_id, items=items)
+        con.execute("DELETE FROM inventory WHERE input_key=? AND product_id=?", (input_key, product_id))
+
+def inventory_stock(row) -> int:
+    """Số hàng trong kho đệm cho /stock khi NCC lỗi; lỗi SQLite cũng chỉ trả 0."""
+    try:
+        return inventory_count(row)
+    except sqlite3.Error as e:
+        log("STOCK_ERROR", "inventory count failed", key=row["input_key"], error=str(e))
+        return 0
+
+def take_inventory(row, qty: int):
+    """
+    Lấy đúng qty đơn vị trong kho (1 transaction, 2 worker không thể lấy trùng), trả list
+    [{"product": ...}]; None nếu key không dùng kho hoặc kho không đủ (khi đó mua trực tiếp cả đơn).
+    """
+    if not row["buffer_high"]:
+        return None
+    con = db()
+    with phase("db"), con:
+        con.execute("BEGIN IMMEDIATE")
+        rows = con.execute("SELECT id, item FROM inventory WHERE input_key=? AND product_id=? ORDER BY id LIMIT ?",
+                           (row["input_key"], int(row["product_id"]), qty)).fetchall()
+        if len(rows) < qty:
+            metric_cache("inventory", "miss")
+            return None
+        con.execute(f"DELETE FROM inventory WHERE id IN ({','.join('?' * len(rows))})", [r["id"] for r in rows])
+    metric_cache("inventory", "hit")
+    return [{"product": r["item"]} for r in rows]
+
+INVENTORY_LEASE_TTL = max(INVENTORY_INTERVAL * 3, 60)
+
+def replenish(row, lease=None):
+    """
+    Mua bù kho của 1 keymap lên buffer_high nếu đang dưới buffer_low (buffer_low = 0: khi kho hết).
+    lease(): gia hạn lease trước mỗi lần mua; False (lease đã sang worker khác) thì dừng.
+    """
+    have = inventory_count(row)
+    if have >= max(row["buffer_low"], 1):
+        return
+    base_url = row['base_url'] or 'https://mail72h.com'
+    need = row["buffer_high"] - have
+    for n in chunk_sizes(need, max(INVENTORY_BUY_MAX, 1)):
+        if lease is not None and not lease():
+            log("INVENTORY_ERROR", "replenish stopped, lease lost", key=row["input_key"])
+            return
+        items, err = buy_chunk(base_url, row["api_key"], int(row["product_id"]), n)
+        if items:
+            now = time.time()
+            try:
+                with db() as con:
+                    con.executemany("INSERT INTO inventory(input_key, product_id, item, bought_at) VALUES(?,?,?,?)",
+                                    [(row["input_key"], int(row["product_id"]), it["product"], now) for it in items])
+                    con.commit()
+            except sqlite3.Error as e:
+                # Hàng đã trả tiền nhưng không vào được kho: ghi lại nội dung để xử lý tay
+                log("INVENTORY_ERROR", "bought items not stored", key=row["input_key"],
+                    items=[it["product"] for it in items], error=str(e))
+                return
+            metric_inc("inventory_bought_total", len(items))
+        if err:
+            log("INVENTORY_ERROR", "replenish incomplete", key=row["input_key"], bought=len(items), wanted=n, error=str(err))
+            return
+
+def _replenisher_loop():
+    while True:
+        try:
+            # Lease: chỉ 1 worker mua bù, tránh nhiều worker cùng mua cho 1 key
+            lease = lambda: try_lease("inventory-replenisher", INVENTORY_LEASE_TTL)
+            if lease():
+                with db() as con:
+                    rows = con.execute("SELECT * FROM keymaps WHERE is_active=1 AND buffer_high > 0").fetchall()
+                for row in rows:
+                    replenish(row, lease)
+        except Exception as e:
+            log("INVENTORY_ERROR", "replenisher failed", error=str(e))
+        time.sleep(INVENTORY_INTERVAL)
+
+_replenisher_pid = None
+
+def start_replenisher():
+    global _replenisher_pid
+    if INVENTORY_INTERVAL <= 0 or _replenisher_pid == os.getpid():
+        return
+    with _refresher_lock:
+        if _replenisher_pid == os.getpid():
+            return
+        _replenisher_pid = os.getpid()
+        threading.Thread(target=_replenisher_loop, name="inventory-replenisher", daemon=True).start()
 
 
 # ========= Admin UI (Folder lồng nhau) =========
@@ -272,22 +2083,67 @@ details details summary { background: #f3f4f6; }
          <div class="col-1"><button type="submit">Lưu key</button></div>
          <div class="col-1"><button type="reset" class="btn gray" id="reset-form-btn">Xóa form</button></div>
       </div>
+      <div class="row" style="margin-top:12px">
+         <div class="col-2"><label>Kho đệm: mua bù khi dưới</label><input class="mono" name="buffer_low" type="number" min="0" placeholder="giữ nguyên"></div>
+         <div class="col-2"><label>Kho đệm: mua lên tới</label><input class="mono" name="buffer_high" type="number" min="0" placeholder="giữ nguyên"></div>
+      </div>
+    </form>
+  </div>
+
+  <div class="card">
+    <h3>Import / Export Keys</h3>
+    <form method="post" action="{{ url_for('admin_import_keymaps') }}?admin_secret={{ asec }}" enctype="multipart/form-data">
+      <div class="row">
+        <div class="col-4"><label>File CSV / JSONL (cột: {{ keymap_fields|join(', ') }})</label><input type="file" name="file" accept=".csv,.jsonl,.json" required></div>
+        <div class="col-2"><label><input type="checkbox" name="dry_run" value="1" checked style="width:auto"> Chỉ kiểm tra (dry run)</label></div>
+        <div class="col-2"><button type="submit">Import</button></div>
+        <div class="col-4">
+          <a class="btn gray" href="{{ url_for('admin_export_keymaps', format='csv') }}&admin_secret={{ asec }}">Export CSV</a>
+          <a class="btn gray" href="{{ url_for('admin_export_keymaps', format='jsonl') }}&admin_secret={{ asec }}">Export JSONL</a>
+        </div>
+      </div>
+    </form>
+  </div>
+
+  <div class="card">
+    <h3>Profiling</h3>
+    <form method="post" action="{{ url_for('admin_settings') }}?admin_secret={{ asec }}">
+      <div class="row">
+        <div class="col-4"><label>cProfile 1/N request (0 = tắt, trống = mặc định {{ profile_default }})</label><input class="mono" name="profile_sample_n" type="number" min="0" value="{{ profile_sample_n }}"></div>
+        <div class="col-2"><button type="submit">Lưu</button></div>
+      </div>
     </form>
   </div>
 
   <div class="card">
     <h3>Danh sách Keys (Theo Folder)</h3>
-    {% if not grouped_data %}
-      <p>Chưa có key nào. Vui lòng thêm key bằng form bên trên.</p>
+    <form method="get" action="{{ url_for('admin_index') }}">
+      <input type="hidden" name="admin_secret" value="{{ asec }}">
+      <div class="row" style="margin-bottom:12px">
+        <div class="col-3"><label>Folder</label><input class="mono" name="folder" value="{{ filters.folder }}"></div>
+        <div class="col-2"><label>Provider</label><input class="mono" name="provider" value="{{ filters.provider }}"></div>
+        <div class="col-3"><label>SKU chứa</label><input class="mono" name="sku" value="{{ filters.sku }}"></div>
+        <div class="col-2"><label>Active</label>
+          <select name="active">
+            <option value="" {{ 'selected' if filters.active == '' }}>Tất cả</option>
+            <option value="1" {{ 'selected' if filters.active == '1' }}>Đang bật</option>
+            <option value="0" {{ 'selected' if filters.active == '0' }}>Đang tắt</option>
+          </select>
+        </div>
+        <div class="col-2"><button type="submit">Lọc</button></div>
+      </div>
+    </form>
+    {% if not folders %}
+      <p>Không có key nào khớp. Thêm key bằng form bên trên hoặc đổi bộ lọc.</p>
     {% endif %}
     
-    {% for folder, providers in grouped_data.items() %}
+    {% for folder, providers in folders %}
       <details class="folder">
         <summary>📁 Folder: {{ folder }}</summary>
         <div class="content">
-          {% for provider, data in providers.items() %}
-            <details class="provider">
-              <summary>📦 Provider: {{ provider }} ({{ data.key_list|length }} keys) - Base URL: <code>{{ data['base_url'] or 'Chưa set' }}</code></summary>
+          {% for p in providers %}
+            <details class="provider" data-folder="{{ folder }}" data-provider="{{ p['provider_type'] }}">
+              <summary>📦 Provider: {{ p['provider_type'] }} ({{ p['n'] }} keys) - Base URL: <code>{{ p['base_url'] or 'Chưa set' }}</code></summary>
               <div class="content">
                 <table>
                   <thead>
@@ -296,33 +2152,18 @@ details details summary { background: #f3f4f6; }
                       <th>input_key</th>
                       <th>product_id</th>
                       <th>Active</th>
+                      <th>Kho đệm</th>
                       <th>Hành động</th>
                     </tr>
                   </thead>
-                  <tbody>
-                  {% for key in data.key_list %}
-                    <tr>
-                      <td>{{ key['sku'] }}</td>
-                      <td><code>{{ key['input_key'] }}</code></td>
-                      <td>{{ key['product_id'] }}</td>
-                      <td>{{ '✅' if key['is_active'] else '❌' }}</td>
-                      <td>
-                        <form method="post" action="{{ url_for('admin_toggle_key', kmid=key['id']) }}?admin_secret={{ asec }}" style="display:inline">
-                          <button class="btn blue small" type="submit">{{ 'Disable' if key['is_active'] else 'Enable' }}</button>
-                        </form>
-                        <form method="post" action="{{ url_for('admin_delete_key', kmid=key['id']) }}?admin_secret={{ asec }}" style="display:inline" onsubmit="return confirm('Xoá key {{key['input_key']}}?')">
-                          <button class="btn red small" type="submit">Xoá</button>
-                        </form>
-                      </td>
-                    </tr>
-                  {% endfor %}
-                  </tbody>
+                  <tbody></tbody>
                 </table>
+                <button class="btn gray small load-more" style="display:none">Tải thêm</button>
                 <button class="btn green small add-key-helper" 
                         data-folder="{{ folder }}" 
-                        data-provider="{{ provider }}" 
-                        data-baseurl="{{ data['base_url'] }}"
-                        data-apikey="{{ data.key_list[0]['api_key'] if data.key_list else '' }}">
+                        data-provider="{{ p['provider_type'] }}" 
+                        data-baseurl="{{ p['base_url'] or '' }}"
+                        data-apikey="{{ p['api_key'] or '' }}">
                   + Thêm Key vào đây
                 </button>
               </div>
@@ -331,6 +2172,13 @@ details details summary { background: #f3f4f6; }
         </div>
       </details>
     {% endfor %}
+    {% if pages > 1 %}
+      <p>
+        {% if page > 1 %}<a class="btn gray small" href="{{ url_for('admin_index', page=page - 1, **filters) }}&admin_secret={{ asec }}">&larr; Trước</a>{% endif %}
+        Trang {{ page }}/{{ pages }} ({{ total_folders }} folder)
+        {% if page < pages %}<a class="btn gray small" href="{{ url_for('admin_index', page=page + 1, **filters) }}&admin_secret={{ asec }}">Sau &rarr;</a>{% endif %}
+      </p>
+    {% endif %}
   </div>
 
 <script>
@@ -373,74 +2221,371 @@ document.addEventListener('click', function(e) {
 document.getElementById('reset-form-btn').addEventListener('click', function() {
     setLockedFields(false);
 });
+
+// Key của từng provider chỉ được tải (JSON, theo trang) khi mở <details>
+const ASEC = {{ asec|tojson }};
+const FILTERS = {{ filters|tojson }};
+const KEYMAP_URL = {{ url_for('admin_add_keymap')|tojson }};
+const KEYS_API = {{ url_for('admin_api_keys')|tojson }};
+
+function actionForm(action, label, cls, confirmMsg) {
+  const f = document.createElement('form');
+  f.method = 'post';
+  f.action = action + '?admin_secret=' + encodeURIComponent(ASEC);
+  f.style.display = 'inline';
+  if (confirmMsg) f.onsubmit = () => confirm(confirmMsg);
+  const b = document.createElement('button');
+  b.className = 'btn small ' + cls;
+  b.type = 'submit';
+  b.textContent = label;
+  f.appendChild(b);
+  return f;
+}
+
+function keyRow(k) {
+  const tr = document.createElement('tr');
+  const cells = [k.sku, k.input_key, k.product_id, k.is_active ? '✅' : '❌',
+                 k.buffer_high ? `${k.buffered} (${k.buffer_low}–${k.buffer_high})` : '-'];
+  cells.forEach((v, i) => {
+    const td = document.createElement('td');
+    if (i === 1) { const c = document.createElement('code'); c.textContent = v; td.appendChild(c); }
+    else td.textContent = v;
+    tr.appendChild(td);
+  });
+  const td = document.createElement('td');
+  td.appendChild(actionForm(`${KEYMAP_URL}/${k.id}/toggle`, k.is_active ? 'Disable' : 'Enable', 'blue'));
+  td.appendChild(document.createTextNode(' '));
+  td.appendChild(actionForm(`${KEYMAP_URL}/${k.id}`, 'Xoá', 'red', `Xoá key ${k.input_key}?`));
+  tr.appendChild(td);
+  return tr;
+}
+
+async function loadKeys(det) {
+  const page = (parseInt(det.dataset.page || '0', 10)) + 1;
+  const params = new URLSearchParams({...FILTERS, admin_secret: ASEC, folder: det.dataset.folder,
+                                      provider: det.dataset.provider, page: page});
+  const r = await fetch(`${KEYS_API}?${params}`);
+  const data = await r.json();
+  const tbody = det.querySelector('tbody');
+  data.items.forEach(k => tbody.appendChild(keyRow(k)));
+  det.dataset.page = page;
+  det.querySelector('.load-more').style.display = page * data.per_page < data.total ? '' : 'none';
+}
+
+document.querySelectorAll('details.provider').forEach(det => {
+  det.addEventListener('toggle', () => { if (det.open && !det.dataset.page) loadKeys(det); });
+  det.querySelector('.load-more').addEventListener('click', e => { e.preventDefault(); loadKeys(det); });
+});
 </script>
 </body></html>
 """
 
+# ========= Cache keymap (dùng chung cho /stock, /fetch, /debuglist) =========
+# input_key -> Row (LRU, tối đa KEYMAP_CACHE_MAX). Key không tồn tại/đã tắt nằm ở negative
+# cache riêng (LRU, tối đa KEYMAP_NEG_CACHE_MAX): spam key sai không chạm tới DB và cũng không
+# đẩy được key thật ra khỏi cache.
+_keymap_cache = OrderedDict()
+_keymap_neg = OrderedDict()
+_keymap_version = None   # keymap_version trong app_meta lúc đồng bộ gần nhất
+_keymap_checked_at = 0.0
+_keymap_gen = 0          # tăng mỗi lần xoá cache, tránh ghi lại row cũ đọc trước khi xoá
+_keymap_lock = threading.Lock()
+
+def bump_keymap_version(con):
+    """Gọi trong cùng transaction với lệnh sửa bảng keymaps."""
+    con.execute("UPDATE app_meta SET value=value+1 WHERE name='keymap_version'")
+
+def keymap_cache_invalidate():
+    """Xoá cache của worker hiện tại ngay (sau khi admin commit)."""
+    global _keymap_version, _keymap_checked_at, _keymap_gen
+    with _keymap_lock:
+        _keymap_cache.clear()
+        _keymap_neg.clear()
+        _keymap_gen += 1
+        _keymap_version = None
+        _keymap_checked_at = 0.0
+
+def _keymap_cache_sync():
+    # Mỗi KEYMAP_CACHE_CHECK giây đọc 1 số nguyên trong SQLite; đổi -> worker khác đã sửa keymaps
+    global _keymap_version, _keymap_checked_at, _keymap_gen
+    now = time.monotonic()
+    if now - _keymap_checked_at < KEYMAP_CACHE_CHECK:
+        return
+    with phase("db"), db() as con:
+        v = con.execute("SELECT value FROM app_meta WHERE name='keymap_version'").fetchone()[0]
+    with _keymap_lock:
+        _keymap_checked_at = now
+        if v != _keymap_version:
+            _keymap_cache.clear()
+            _keymap_neg.clear()
+            _keymap_gen += 1
+            _keymap_version = v
+
+def _keymap_cache_get(key: str):
+    """Row, None (key biết là không có) hoặc _NOT_FOUND (chưa cache)."""
+    with _keymap_lock:
+        row = _keymap_cache.get(key)
+        if row is not None:
+            _keymap_cache.move_to_end(key)
+            return row
+        if key in _keymap_neg:
+            _keymap_neg.move_to_end(key)
+            return None
+    return _NOT_FOUND
+
+def _keymap_cache_put(key: str, row):
+    """Gọi khi đang giữ _keymap_lock."""
+    cache, limit = (_keymap_cache, KEYMAP_CACHE_MAX) if row is not None else (_keymap_neg, KEYMAP_NEG_CACHE_MAX)
+    if limit <= 0:
+        return
+    cache[key] = row
+    cache.move_to_end(key)
+    while len(cache) > limit:
+        cache.popitem(last=False)
+
 def find_map_by_key(key: str):
-    with db() as con:
-        row = con.execute("SELECT * FROM keymaps WHERE input_key=? AND is_active=1", (key,)).fetchone()
+    _keymap_cache_sync()
+    row = _keymap_cache_get(key)
+    if row is not _NOT_FOUND:
+        metric_cache("keymap", "hit")
         return row
+    metric_cache("keymap", "miss")
+
+    gen = _keymap_gen
+    with phase("db"), db() as con:
+        row = con.execute("SELECT * FROM keymaps WHERE input_key=? AND is_active=1", (key,)).fetchone()
+    with _keymap_lock:
+        if gen == _keymap_gen:
+            _keymap_cache_put(key, row)
+    return row
+
+def find_maps_by_keys(keys) -> dict:
+    """Như find_map_by_key cho nhiều key: các key chưa có trong cache được lấy bằng 1 query."""
+    _keymap_cache_sync()
+    out = {}
+    missing = []
+    for k in keys:
+        row = _keymap_cache_get(k)
+        if row is _NOT_FOUND:
+            missing.append(k)
+        else:
+            out[k] = row
+    metric_inc("cache_requests_total", len(out), cache="keymap", result="hit")
+    metric_inc("cache_requests_total", len(missing), cache="keymap", result="miss")
+    if not missing:
+        return out
+
+    gen = _keymap_gen
+    marks = ",".join("?" * len(missing))
+    with phase("db"), db() as con:
+        found = {r["input_key"]: r for r in con.execute(
+            f"SELECT * FROM keymaps WHERE is_active=1 AND input_key IN ({marks})", missing)}
+    with _keymap_lock:
+        fresh = gen == _keymap_gen
+        for k in missing:
+            out[k] = found.get(k)
+            if fresh:
+                _keymap_cache_put(k, out[k])
+    return out
 
 def require_admin():
     if request.args.get("admin_secret") != ADMIN_SECRET:
         abort(403)
 
+_admin_tpl = None
+
+def admin_template():
+    """ADMIN_TPL biên dịch 1 lần mỗi process (render_template_string biên dịch lại mỗi request)."""
+    global _admin_tpl
+    if _admin_tpl is None:
+        _admin_tpl = app.jinja_env.from_string(ADMIN_TPL)
+    return _admin_tpl
+
+def _admin_filters() -> dict:
+    a = request.args
+    active = a.get("active", "").strip()
+    return {"folder": a.get("folder", "").strip(), "provider": a.get("provider", "").strip().lower(),
+            "sku": a.get("sku", "").strip(), "active": active if active in ("0", "1") else ""}
+
+def _keymap_where(filters: dict):
+    """Điều kiện WHERE (dùng được index group_name, provider_type, sku) cho bộ lọc admin."""
+    where, params = [], []
+    if filters["folder"]:
+        if filters["folder"] == "DEFAULT":
+            where.append("(group_name = 'DEFAULT' OR group_name IS NULL OR group_name = '')")
+        else:
+            where.append("group_name = ?")
+            params.append(filters["folder"])
+    if filters["provider"]:
+        where.append("provider_type = ?")
+        params.append(filters["provider"])
+    if filters["sku"]:
+        where.append("sku LIKE ? ESCAPE '\\'")
+        params.append("%" + filters["sku"].replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%")
+    if filters["active"]:
+        where.append("is_active = ?")
+        params.append(int(filters["active"]))
+    return ("WHERE " + " AND ".join(where)) if where else "", params
+
+def _page_args(default_per_page: int, max_per_page: int):
+    try:
+        page = max(int(request.args.get("page", "1")), 1)
+        per_page = min(max(int(request.args.get("per_page", str(default_per_page))), 1), max_per_page)
+    except ValueError:
+        page, per_page = 1, default_per_page
+    return page, per_page
+
 @app.route("/admin")
 def admin_index():
+    """Chỉ liệt kê folder/provider (đếm số key) theo trang; key được tải qua /admin/api/keys."""
     require_admin()
+    filters = _admin_filters()
+    where, params = _keymap_where(filters)
+    page, per_page = _page_args(ADMIN_FOLDERS_PER_PAGE, 500)
+    folder_col = "COALESCE(NULLIF(group_name, ''), 'DEFAULT')"
     with db() as con:
-        maps = con.execute("SELECT * FROM keymaps ORDER BY group_name, provider_type, sku, id").fetchall()
-    
-    grouped_data = {}
-    for key in maps:
-        folder = key['group_name'] or 'DEFAULT'
-        provider = key['provider_type']
-        
-        if folder not in grouped_data:
-            grouped_data[folder] = {}
-        
-        if provider not in grouped_data[folder]:
-            grouped_data[folder][provider] = {"key_list": [], "base_url": key['base_url']}
-        
-        grouped_data[folder][provider]["key_list"].append(key)
+        total_folders = con.execute(f"SELECT COUNT(DISTINCT {folder_col}) FROM keymaps {where}", params).fetchone()[0]
+        names = [r[0] for r in con.execute(
+            f"SELECT DISTINCT {folder_col} AS folder FROM keymaps {where} ORDER BY folder LIMIT ? OFFSET ?",
+            [*params, per_page, (page - 1) * per_page])]
+        groups = []
+        if names:
+            # MIN(id): base_url/api_key lấy từ key đầu tiên của nhóm (cho nút "Thêm Key vào đây")
+            groups = con.execute(f"""
+                SELECT {folder_col} AS folder, provider_type, COUNT(*) AS n, MIN(id), base_url, api_key
+                FROM keymaps {where + (' AND' if where else 'WHERE')} {folder_col} IN ({','.join('?' * len(names))})
+                GROUP BY folder, provider_type ORDER BY folder, provider_type
+            """, [*params, *names]).fetchall()
 
-    return render_template_string(ADMIN_TPL, grouped_data=grouped_data, asec=ADMIN_SECRET)
+    folders = {name: [] for name in names}
+    for grp in groups:
+        folders[grp["folder"]].append(grp)
 
-@app.route("/admin/keymap", methods=["POST"])
-def admin_add_keymap():
+    return admin_template().render(folders=list(folders.items()), filters=filters, page=page,
+                                   pages=max(-(-total_folders // per_page), 1), total_folders=total_folders,
+                                   keymap_fields=KEYMAP_FIELDS, asec=ADMIN_SECRET,
+                                   profile_sample_n=runtime_setting("profile_sample_n", PROFILE_SAMPLE_N),
+                                   profile_default=PROFILE_SAMPLE_N)
+
+@app.route("/admin/settings", methods=["POST"])
+def admin_settings():
+    """Đổi tỉ lệ profiling không cần restart; để trống = quay về PROFILE_SAMPLE_N."""
     require_admin()
-    f = request.form
-    
-    group_name = f.get("group_name","").strip() or 'DEFAULT'
-    sku = f.get("sku","").strip()
-    input_key = f.get("input_key","").strip()
-    product_id = f.get("product_id","").strip()
+    raw = (request.form.get("profile_sample_n") or "").strip()
+    try:
+        value = None if raw == "" else max(int(raw), 0)
+    except ValueError:
+        return jsonify({"error": f"profile_sample_n must be an integer, got {raw!r}"}), 400
+    set_runtime_setting("profile_sample_n", value)
+    return redirect(url_for("admin_index", admin_secret=ADMIN_SECRET))
+
+@app.route("/admin/api/keys")
+def admin_api_keys():
+    """JSON: key theo bộ lọc (folder, provider, sku, active) và trang; không trả api_key."""
+    require_admin()
+    where, params = _keymap_where(_admin_filters())
+    page, per_page = _page_args(ADMIN_KEYS_PER_PAGE, 1000)
+    with db() as con:
+        total = con.execute(f"SELECT COUNT(*) FROM keymaps {where}", params).fetchone()[0]
+        rows = con.execute(f"""
+            SELECT id, sku, input_key, product_id, is_active, buffer_low, buffer_high FROM keymaps {where}
+            ORDER BY sku, id LIMIT ? OFFSET ?
+        """, [*params, per_page, (page - 1) * per_page]).fetchall()
+        buffered = {}
+        pairs = [(r["input_key"], r["product_id"]) for r in rows if r["buffer_high"]]
+        if pairs:
+            buffered = {(r[0], r[1]): r[2] for r in con.execute(f"""
+                SELECT input_key, product_id, COUNT(*) FROM inventory
+                WHERE input_key IN ({','.join('?' * len(pairs))}) GROUP BY input_key, product_id
+            """, [k for k, _ in pairs])}
+    items = [{**dict(r), "buffered": buffered.get((r["input_key"], r["product_id"]), 0)} for r in rows]
+    return jsonify({"items": items, "page": page, "per_page": per_page, "total": total})
+
+# Cột của 1 keymap khi nhập/xuất (form admin, import/export CSV/JSONL)
+KEYMAP_FIELDS = ("group_name", "provider_type", "base_url", "sku", "input_key", "product_id", "api_key",
+                 "is_active", "buffer_low", "buffer_high")
+
+KEYMAP_UPSERT = """
+    INSERT INTO keymaps(group_name, provider_type, base_url, sku, input_key, product_id, api_key,
+                        is_active, buffer_low, buffer_high)
+    VALUES(?,?,?,?,?,?,?,?,?,?)
+    ON CONFLICT(input_key) DO UPDATE SET
+      group_name=excluded.group_name,
+      sku=excluded.sku,
+      product_id=excluded.product_id,
+      api_key=excluded.api_key,
+      is_active=excluded.is_active,
+      provider_type=excluded.provider_type,
+      base_url=excluded.base_url,
+      buffer_low=excluded.buffer_low,
+      buffer_high=excluded.buffer_high
+"""
+
+def keymap_current(con, keys) -> dict:
+    """{input_key: dòng keymaps hiện có (input_key, product_id, buffer_low, buffer_high)} cho các key."""
+    current = {}
+    for i in range(0, len(keys), 500):
+        part = keys[i:i + 500]
+        current.update((r["input_key"], r) for r in con.execute(
+            "SELECT input_key, product_id, buffer_low, buffer_high FROM keymaps "
+            f"WHERE input_key IN ({','.join('?' * len(part))})", part))
+    return current
+
+def keymap_drop_stale_inventory(con, current: dict, rows):
+    """Key đổi product_id: kho đệm theo product cũ không còn được bán/đếm nữa -> inventory_drop."""
+    ki, pi = KEYMAP_FIELDS.index("input_key"), KEYMAP_FIELDS.index("product_id")
+    for values in rows:
+        cur = current.get(values[ki])
+        if cur is not None and cur["product_id"] != values[pi]:
+            inventory_drop(con, cur["input_key"], cur["product_id"], "inventory removed, product_id changed")
+
+def keymap_values(f, current=None) -> tuple:
+    """
+    Kiểm tra 1 keymap (dict/form) -> tuple theo KEYMAP_FIELDS; ValueError nếu thiếu/sai.
+    current: dòng keymaps đang có của input_key này; buffer_low/buffer_high để trống thì giữ giá trị cũ.
+    """
+    get = lambda k: str(f.get(k) if f.get(k) is not None else "").strip()
+    group_name = get("group_name") or 'DEFAULT'
+    sku = get("sku")
+    input_key = get("input_key")
+    product_id = get("product_id")
     
-    provider_type = f.get("provider_type","").strip().lower() or 'mail72h'
-    base_url = f.get("base_url","").strip()
-    api_key = f.get("api_key","").strip()
+    provider_type = get("provider_type").lower() or 'mail72h'
+    # base_url rỗng thì giữ rỗng (hàm stock/fetch sẽ tự dùng default)
+    base_url = get("base_url")
+    api_key = get("api_key")
+    is_active = get("is_active").lower() or "1"
+    buffer_low = get("buffer_low") or str(current["buffer_low"] if current else 0)
+    buffer_high = get("buffer_high") or str(current["buffer_high"] if current else 0)
     
     if not sku or not input_key or not product_id.isdigit() or not api_key:
-        return "Thiếu thông tin quan trọng (sku, input_key, product_id, api_key)", 400
-    
-    # Bỏ dòng 'if not base_url and provider_type == 'mail72h':'
-    # để nếu base_url rỗng thì nó sẽ là rỗng (và hàm stock/fetch sẽ tự dùng default)
-    
-    with db() as con:
-        con.execute("""
-            INSERT INTO keymaps(group_name, sku, input_key, product_id, api_key, is_active, provider_type, base_url)
-            VALUES(?,?,?,?,?,1,?,?)
-            ON CONFLICT(input_key) DO UPDATE SET
-              group_name=excluded.group_name,
-              sku=excluded.sku,
-              product_id=excluded.product_id,
-              api_key=excluded.api_key,
-              is_active=1,
-              provider_type=excluded.provider_type,
-              base_url=excluded.base_url
-        """, (group_name, sku, input_key, int(product_id), api_key, provider_type, base_url))
+        raise ValueError("Thiếu thông tin quan trọng (sku, input_key, product_id, api_key)")
+    if not buffer_low.isdigit() or not buffer_high.isdigit() or int(buffer_low) > int(buffer_high):
+        raise ValueError("Kho đệm không hợp lệ (cần 0 <= buffer_low <= buffer_high)")
+    if is_active not in ("1", "0", "true", "false"):
+        raise ValueError("is_active phải là 1/0")
+    return (group_name, provider_type, base_url, sku, input_key, int(product_id), api_key,
+            int(is_active in ("1", "true")), int(buffer_low), int(buffer_high))
+
+@app.route("/admin/keymap", methods=["POST"])
+def admin_add_keymap():
+    require_admin()
+    # Lưu từ form luôn bật lại key (is_active=1)
+    form = {**request.form.to_dict(), "is_active": "1"}
+    con = db()
+    with con:
+        con.execute("BEGIN IMMEDIATE")
+        key = (form.get("input_key") or "").strip()
+        current = keymap_current(con, [key])
+        try:
+            values = keymap_values(form, current.get(key))
+        except ValueError as e:
+            return str(e), 400
+        keymap_drop_stale_inventory(con, current, [values])
+        con.execute(KEYMAP_UPSERT, values)
+        bump_keymap_version(con)
         con.commit()
+    keymap_cache_invalidate()
     return redirect(url_for("admin_index", admin_secret=ADMIN_SECRET))
 
 @app.route("/admin/keymap/<int:kmid>/toggle", methods=["POST"])
@@ -451,28 +2596,179 @@ def admin_toggle_key(kmid):
         if not row: abort(404)
         newv = 0 if row["is_active"] else 1
         con.execute("UPDATE keymaps SET is_active=? WHERE id=?", (newv, kmid))
+        bump_keymap_version(con)
         con.commit()
+    keymap_cache_invalidate()
     return redirect(url_for("admin_index", admin_secret=ADMIN_SECRET))
 
 @app.route("/admin/keymap/<int:kmid>", methods=["POST"])
 def admin_delete_key(kmid):
     require_admin()
     with db() as con:
+        row = con.execute("SELECT input_key, product_id FROM keymaps WHERE id=?", (kmid,)).fetchone()
+        if not row: abort(404)
+        inventory_drop(con, row["input_key"], row["product_id"], "inventory removed with key")
         con.execute("DELETE FROM keymaps WHERE id=?", (kmid,))
+        bump_keymap_version(con)
         con.commit()
+    keymap_cache_invalidate()
     return redirect(url_for("admin_index", admin_secret=ADMIN_SECRET))
 
+def _read_keymap_rows(text: str, fmt: str):
+    """Yield (số dòng, dict) từ nội dung CSV (có header) hoặc JSONL."""
+    if fmt == "csv":
+        reader = csv.DictReader(io.StringIO(text))
+        for rec in reader:
+            yield reader.line_num, rec
+        return
+    for n, line in enumerate(text.splitlines(), 1):
+        if not line.strip():
+            continue
+        try:
+            rec = json.loads(line)
+        except ValueError as e:
+            rec = e
+        yield n, rec
+
+@app.route("/admin/keymaps/import", methods=["POST"])
+def admin_import_keymaps():
+    """
+    POST file CSV/JSONL (form field "file" hoặc body thô) ?format=csv|jsonl&dry_run=1
+    Có lỗi ở bất kỳ dòng nào thì không ghi gì; không lỗi thì upsert tất cả trong 1 transaction.
+    """
+    require_admin()
+    up = request.files.get("file")
+    raw = up.read() if up else request.get_data()
+    fmt = (request.args.get("format") or "").lower()
+    if not fmt:
+        name = (up.filename if up else "") or ""
+        fmt = "csv" if name.lower().endswith(".csv") or "csv" in (request.content_type or "") else "jsonl"
+    if fmt not in ("csv", "jsonl"):
+        return jsonify({"error": "format phải là csv hoặc jsonl"}), 400
+    dry_run = (request.values.get("dry_run") or "") in ("1", "true", "on")
+    try:
+        text = raw.decode("utf-8-sig")
+    except UnicodeDecodeError:
+        return jsonify({"error": "file phải là UTF-8"}), 400
+
+    records = list(_read_keymap_rows(text, fmt))
+    keys = list({str(rec.get("input_key") or "").strip() for _, rec in records if isinstance(rec, dict)})
+    with db() as con:
+        current = keymap_current(con, keys)
+
+    rows, errors, seen = [], [], {}
+    for line, rec in records:
+        if not isinstance(rec, dict):
+            errors.append({"line": line, "error": f"dòng không phải object JSON ({rec})"})
+            continue
+        try:
+            values = keymap_values(rec, current.get(str(rec.get("input_key") or "").strip()))
+        except ValueError as e:
+            errors.append({"line": line, "error": str(e)})
+            continue
+        key = values[KEYMAP_FIELDS.index("input_key")]
+        if key in seen:
+            errors.append({"line": line, "error": f"input_key {key} trùng với dòng {seen[key]}"})
+            continue
+        seen[key] = line
+        rows.append(values)
+
+    existing = set(seen) & set(current)
+    con = db()
+    with con:
+        apply = not dry_run and not errors and rows
+        if apply:
+            con.execute("BEGIN IMMEDIATE")
+            keymap_drop_stale_inventory(con, keymap_current(con, list(seen)), rows)
+            con.executemany(KEYMAP_UPSERT, rows)
+            bump_keymap_version(con)
+            con.commit()
+    if apply:
+        keymap_cache_invalidate()
+    result = {"rows": len(rows), "inserted": len(rows) - len(existing), "updated": len(existing),
+              "errors": errors, "dry_run": dry_run, "applied": bool(apply)}
+    return jsonify(result), 400 if errors else 200
+
+@app.route("/admin/keymaps/export")
+def admin_export_keymaps():
+    """GET ?format=csv|jsonl -> stream toàn bộ keymaps (đọc từng lô, không nạp cả bảng)."""
+    require_admin()
+    fmt = (request.args.get("format") or "csv").lower()
+    if fmt not in ("csv", "jsonl"):
+        abort(400)
+
+    def generate():
+        # Kết nối riêng: generator chạy sau khi request kết thúc, không dùng chung kết nối của thread
+        with closing(sqlite3.connect(DB, timeout=DB_BUSY_TIMEOUT)) as con:
+            cur = con.execute(f"SELECT {', '.join(KEYMAP_FIELDS)} FROM keymaps ORDER BY id")
+            buf = io.StringIO()
+            w = csv.writer(buf)
+            if fmt == "csv":
+                w.writerow(KEYMAP_FIELDS)
+            while True:
+                batch = cur.fetchmany(500)
+                if not batch:
+                    break
+                for r in batch:
+                    if fmt == "csv":
+                        w.writerow(r)
+                    else:
+                        buf.write(json.dumps(dict(zip(KEYMAP_FIELDS, r)), ensure_ascii=False) + "\n")
+                yield buf.getvalue()
+                buf.seek(0)
+                buf.truncate()
+            if fmt == "csv" and buf.tell():
+                yield buf.getvalue()
+
+    mimetype = "text/csv" if fmt == "csv" else "application/x-ndjson"
+    return Response(generate(), mimetype=mimetype,
+                    headers={"Content-Disposition": f"attachment; filename=keymaps.{fmt}"})
+
 # ========= Public endpoints (Bộ định tuyến) =========
+def start_background():
+    # Thread phải khởi động trong chính worker (sau fork), không phải lúc import
+    start_refresher()
+    start_replenisher()
+    start_metrics()
+
+@app.before_request
+def _before_request():
+    start_background()
+    g.timings = trace_start()
+    g.profile = profile_start()
+    g.t0 = time.perf_counter()
+
+@app.after_request
+def _observe_request(resp):
+    t0 = g.get("t0")
+    if t0 is not None:
+        elapsed = time.perf_counter() - t0
+        route = request.url_rule.rule if request.url_rule else "unmatched"
+        metric_observe("http_request_duration_seconds", elapsed, route=route, status=str(resp.status_code))
+        resp.headers["Server-Timing"] = server_timing({**g.timings, "total": elapsed})
+    return resp
+
+@app.teardown_request
+def _finish_request(exc):
+    _timings.set(None)
+    prof = g.pop("profile", None)
+    if prof is not None:
+        profile_finish(prof, request.url_rule.rule if request.url_rule else "unmatched")
+
 @app.route("/stock")
 def stock():
     key = request.args.get("key","").strip()
     if not key:
-        print("STOCK_ERROR: Missing key")
+        log("STOCK_ERROR", "missing key")
+        metric_error("stock", "bad_request")
         return jsonify({"sum": 0}), 200
         
     row = find_map_by_key(key)
     if not row:
-        print(f"STOCK_ERROR: Unknown key {key}")
+        log("STOCK_ERROR", "unknown key", key=key)
+        metric_error("stock", "unknown_key")
+        return jsonify({"sum": 0}), 200
+    if not admit_key("stock", key):
         return jsonify({"sum": 0}), 200
 
     provider = row['provider_type']
@@ -486,31 +2782,69 @@ def stock():
         return stock_mail72h(row) # Hàm này đã dùng base_url trong 'row'
     else:
         # Trường hợp này gần như không xảy ra nếu bạn nhập từ admin
-        print(f"STOCK_ERROR: Provider '{provider}' not supported or not set")
+        log("STOCK_ERROR", "provider not supported or not set", provider=provider)
         return jsonify({"sum": 0}), 200
     # ==========================================================
 
 
+@app.route("/stock/batch", methods=["GET", "POST"])
+def stock_batch_route():
+    """
+    GET /stock/batch?keys=a,b,c  hoặc  POST {"keys": ["a","b","c"]}
+    -> {"a": sum, "b": sum, ...}; key lỗi/không tồn tại trả 0 như /stock.
+    Mỗi key tốn 1 lượt rate limit theo input_key (chung bucket với /stock, /fetch); key hết lượt trả 0.
+    """
+    if request.method == "POST":
+        body = request.get_json(silent=True)
+        raw = body.get("keys") if isinstance(body, dict) else body
+        if isinstance(raw, str):
+            raw = raw.split(",")
+    else:
+        raw = request.args.get("keys", "").split(",")
+    if not isinstance(raw, list):
+        raw = []
+
+    keys = list(dict.fromkeys(str(k).strip() for k in raw if str(k).strip()))
+    if not keys:
+        log("STOCK_ERROR", "missing keys")
+        return jsonify({}), 200
+    if len(keys) > BATCH_MAX_KEYS:
+        log("STOCK_ERROR", "too many keys", keys=len(keys), max=BATCH_MAX_KEYS)
+        return jsonify({"error": f"too many keys (max {BATCH_MAX_KEYS})"}), 400
+
+    return jsonify(stock_batch(keys))
+
+
 @app.route("/fetch")
 def fetch():
     key = request.args.get("key","").strip()
     qty_s = request.args.get("quantity","").strip()
+    order_id = request.args.get("order_id","").strip()
     
     if not key or not qty_s:
-        print("FETCH_ERROR: Missing key/quantity")
+        log("FETCH_ERROR", "missing key/quantity")
+        metric_error("fetch", "bad_request")
         return jsonify([]), 200
     try:
         qty = int(qty_s); 
         if qty<=0 or qty>1000: raise ValueError()
     except Exception:
-        print(f"FETCH_ERROR: Invalid quantity '{qty_s}'")
+        log("FETCH_ERROR", "invalid quantity", quantity=qty_s)
+        metric_error("fetch", "bad_request")
+        return jsonify([]), 200
+    if len(order_id) > 128:
+        log("FETCH_ERROR", "order_id too long")
+        metric_error("fetch", "bad_request")
         return jsonify([]), 200
 
     row = find_map_by_key(key)
     if not row:
-        print(f"FETCH_ERROR: Unknown key {key}")
+        log("FETCH_ERROR", "unknown key", key=key)
+        metric_error("fetch", "unknown_key")
         return jsonify([]), 200
-    
+    if not admit_key("fetch", key):
+        return jsonify([]), 200
+
     provider = row['provider_type']
 
     # ==========================================================
@@ -518,9 +2852,9 @@ def fetch():
     # ==========================================================
     # Giả định rằng mọi provider đều dùng chung logic API của 'mail72h'
     if provider:
-        return fetch_mail72h(row, qty) # Hàm này đã dùng base_url trong 'row'
+        return fetch_mail72h(row, qty, order_id or None) # Hàm này đã dùng base_url trong 'row'
     else:
-        print(f"FETCH_ERROR: Provider '{provider}' not supported or not set")
+        log("FETCH_ERROR", "provider not supported or not set", provider=provider)
         return jsonify([]), 200
     # ==========================================================
 
@@ -528,6 +2862,13 @@ def fetch():
 def health():
     return "OK", 200
 
+@app.route("/metrics")
+def metrics():
+    """Prometheus text format, cộng dồn mọi worker (cần ?admin_secret=...)."""
+    require_admin()
+    counters, hists = collect_metrics()
+    return Response(render_metrics(counters, hists), mimetype="text/plain; version=0.0.4")
+
 # ==========================================================
 # === ROUTE DEBUG: ĐỂ XEM DANH SÁCH SẢN PHẨM TỪ NCC ===
 # ==========================================================
@@ -570,5 +2911,10 @@ def debug_list_products():
 
 
 if __name__ == "__main__":
+    import sys
+    if sys.argv[1:] == ["migrate"]:
+        # python app.py migrate: lúc import đã migrate nếu cần, chỉ in version hiện tại
+        print(f"{DB}: schema version {migrate()}")
+        sys.exit(0)
     port = int(os.getenv("PORT", "8000"))
     app.run(host="0.0.0.0", port=port)
@@ -0,0 +1,529 @@
+"""
+ASGI entry point: /stock và /fetch chạy trên asyncio, gọi NCC bằng httpx (không chặn worker
+trong lúc chờ NCC). Các route còn lại (admin, /stock/batch, /debuglist, ...) được chuyển
+nguyên sang Flask app:app, chạy trong thread pool.
+
+    uvicorn asgi:app --host 0.0.0.0 --port $PORT --workers 2
+    gunicorn asgi:app -k uvicorn.workers.UvicornWorker -b 0.0.0.0:$PORT
+
+Dùng chung với app.py: keymap cache, catalog cache/snapshot, build_catalog_index,
+stock_from_catalog, fetch_items -> response giữ nguyên ({"sum": n}, [{"product": ...}]).
+Mọi hàm của app.py có chạm SQLite đều được gọi qua asyncio.to_thread: lock ghi/checkpoint
+WAL không được chặn event loop (và mọi kết nối khác của worker).
+"""
+import asyncio, io, json, sys, time
+from urllib.parse import parse_qs
+
+import httpx
+
+import app as core
+
+def _wsgi_environ(scope, body: bytes) -> dict:
+    server = scope.get("server") or ("localhost", 80)
+    client = scope.get("client") or ("", 0)
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", "").encode("utf-8").decode("latin-1"),
+        "PATH_INFO": scope["path"].encode("utf-8").decode("latin-1"),
+        "QUERY_STRING": scope["query_string"].decode("latin-1"),
+        "SERVER_NAME": server[0],
+        "SERVER_PORT": str(server[1]),
+        "REMOTE_ADDR": client[0],
+        "REMOTE_PORT": str(client[1]),
+        "SERVER_PROTOCOL": f"HTTP/{scope.get('http_version', '1.1')}",
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": io.BytesIO(body),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": True,
+        "wsgi.run_once": False,
+    }
+    for name, value in scope["headers"]:
+        name, value = name.decode("latin-1").upper().replace("-", "_"), value.decode("latin-1")
+        if name not in ("CONTENT_TYPE", "CONTENT_LENGTH"):
+            name = "HTTP_" + name
+        environ[name] = f"{environ[name]},{value}" if name in environ else value
+    return environ
+
+class ThreadedWsgi:
+    """
+    ASGI -> WSGI cho các route Flask. Mỗi request chạy trong thread pool mặc định của event
+    loop (Flask app thread-safe, không xếp hàng sau 1 thread duy nhất); body trả về được gửi
+    dần qua event loop nên response stream (export CSV) vẫn stream.
+    """
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+
+    async def __call__(self, scope, receive, send):
+        body = bytearray()
+        while True:
+            msg = await receive()
+            if msg["type"] == "http.disconnect":
+                return
+            body += msg.get("body", b"")
+            if not msg.get("more_body"):
+                break
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self._run, _wsgi_environ(scope, bytes(body)), loop, send)
+
+    def _run(self, environ, loop, send):
+        def emit(msg):
+            asyncio.run_coroutine_threadsafe(send(msg), loop).result()
+
+        start = {}
+
+        def start_response(status, headers, exc_info=None):
+            if exc_info and start.get("sent"):
+                raise exc_info[1].with_traceback(exc_info[2])
+            start["msg"] = {"type": "http.response.start", "status": int(status.split(" ", 1)[0]),
+                            "headers": [(k.lower().encode("latin-1"), v.encode("latin-1")) for k, v in headers]}
+
+        result = self.wsgi_app(environ, start_response)
+        try:
+            for piece in result:
+                if not piece:
+                    continue
+                if not start.get("sent"):
+                    emit(start["msg"])
+                    start["sent"] = True
+                emit({"type": "http.response.body", "body": piece, "more_body": True})
+            if not start.get("sent"):
+                emit(start["msg"])
+            emit({"type": "http.response.body", "body": b""})
+        finally:
+            if hasattr(result, "close"):
+                result.close()
+
+_wsgi = ThreadedWsgi(core.app)
+_clients = {}   # base_url -> httpx.AsyncClient (keep-alive)
+_inflight = {}  # (base_url, api_key) -> asyncio.Future của lần tải catalog đang chạy
+
+def http_client(base_url: str) -> httpx.AsyncClient:
+    c = _clients.get(base_url)
+    if c is None:
+        c = _clients[base_url] = httpx.AsyncClient(
+            timeout=httpx.Timeout(core.READ_TIMEOUT, connect=core.CONNECT_TIMEOUT),
+            # Không giới hạn số kết nối đồng thời, chỉ giới hạn số kết nối giữ lại
+            limits=httpx.Limits(max_connections=None,
+                                max_keepalive_connections=core.HTTP_POOL_SIZE if core.HTTP_KEEPALIVE else 0),
+        )
+    return c
+
+def exception_class(e: Exception) -> str:
+    if isinstance(e, httpx.TransportError):
+        return "connect"
+    return core.exception_class(e)
+
+async def provider_request_async(base_url: str, action: str, send, track_latency=False):
+    """Như core.provider_request: dùng chung circuit breaker/latency với các thread sync."""
+    core.circuit_allow(base_url)
+    t0 = time.monotonic()
+    try:
+        with core.phase("upstream"):
+            r = await send()
+    except httpx.TransportError:
+        core.circuit_record(base_url, False)
+        core.metric_observe("upstream_request_duration_seconds", time.monotonic() - t0, base_url=base_url, action=action)
+        raise
+    dt = time.monotonic() - t0
+    core.metric_observe("upstream_request_duration_seconds", dt, base_url=base_url, action=action)
+    core.circuit_record(base_url, r.status_code < 500, dt if track_latency else None)
+    return r
+
+async def hedged_request_async(base_url: str, send):
+    """Như core.hedged_request: lần 2 được gửi sau hedge_delay(), 5xx không thắng, lần thua bị huỷ."""
+    delay = core.hedge_delay(base_url)
+    if delay is None:
+        return await provider_request_async(base_url, "products", send, True)
+
+    tasks = [asyncio.ensure_future(provider_request_async(base_url, "products", send, True))]
+    done, _ = await asyncio.wait(tasks, timeout=delay)
+    if not done:
+        core.metric_inc("upstream_hedged_total", base_url=base_url)
+        tasks.append(asyncio.ensure_future(provider_request_async(base_url, "products", send, True)))
+    pending = set(tasks)
+    rejected = []  # lần đã về nhưng là 5xx
+    while pending:
+        done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        for t in done:
+            if t.exception() is None and t.result().status_code < 500:
+                for other in pending:
+                    other.cancel()
+                return t.result()
+        rejected += [t for t in done if t.exception() is None]
+    return rejected[0].result() if rejected else tasks[0].result()
+
+async def rate_limit_async(**bucket):
+    """Như core.rate_limit (cùng bucket trong SQLite) nhưng chờ bằng asyncio.sleep."""
+    wait_s = await asyncio.to_thread(core.rate_limit_wait, **bucket)
+    if wait_s > 0:
+        with core.phase("queue"):
+            await asyncio.sleep(wait_s)
+
+async def admit_key(scope: str, key: str) -> bool:
+    try:
+        await rate_limit_async(input_key=key)
+        return True
+    except core.RateLimitedError as e:
+        core.log(f"{scope.upper()}_ERROR", "rate limited", key=key, error=str(e))
+        core.metric_error(scope, "rate_limited")
+        return False
+
+async def mail72h_buy_async(base_url: str, api_key: str, product_id: int, amount: int) -> dict:
+    data = {"action": "buyProduct", "id": product_id, "amount": amount, "api_key": api_key}
+    url = f"{base_url.rstrip('/')}/api/buy_product"
+    core.circuit_allow(base_url, probe=False)
+    await rate_limit_async(base_url=base_url, api_key=api_key)
+    # Không retry, giống mail72h_buy
+    r = await provider_request_async(base_url, "buy", lambda: http_client(base_url).post(url, data=data))
+    r.raise_for_status()
+    return r.json()
+
+async def catalog_response_async(base_url: str, api_key: str) -> httpx.Response:
+    url = f"{base_url.rstrip('/')}/api/products.php"
+    for attempt in range(core.CATALOG_RETRIES + 1):
+        last = attempt == core.CATALOG_RETRIES
+        core.circuit_allow(base_url, probe=False)
+        await rate_limit_async(base_url=base_url, api_key=api_key)
+        try:
+            r = await hedged_request_async(base_url, lambda: http_client(base_url).get(url, params={"api_key": api_key}))
+            if r.status_code < 500 or last:
+                r.raise_for_status()
+                return r
+        except httpx.TransportError:
+            if last:
+                raise
+        await asyncio.sleep(core.CATALOG_RETRY_BACKOFF * (2 ** attempt))
+
+async def mail72h_product_list_async(base_url: str, api_key: str) -> dict:
+    r = await catalog_response_async(base_url, api_key)
+    with core.phase("parse"):
+        return r.json()
+
+async def load_catalog_index_async(base_url: str, api_key: str, want: str = None) -> dict:
+    """
+    Như core.load_catalog_index. Body đã được httpx đọc xong (parser kéo dữ liệu đồng bộ, không
+    chờ được socket), nhưng vẫn index từng đoạn thay vì dựng cả cây JSON, và dừng sớm với `want`.
+    """
+    if not core.CATALOG_STREAM:
+        return core.build_catalog_index(await mail72h_product_list_async(base_url, api_key))
+    body = (await catalog_response_async(base_url, api_key)).content
+    view, n = memoryview(body), core.CATALOG_STREAM_CHUNK
+    with core.phase("parse"):
+        return core.index_catalog_chunks((view[i:i + n] for i in range(0, len(body), n)), want, lambda: body)
+
+async def get_catalog_async(base_url: str, api_key: str, want: str = None) -> dict:
+    """Như core.get_catalog nhưng single-flight bằng asyncio.Future, không chặn event loop."""
+    data = await asyncio.to_thread(core.peek_catalog, base_url, api_key)
+    if data is not None:
+        return data
+
+    ck = (base_url, api_key)
+    want = want if want is not None and not core._catalog_caching() else None
+    fk = ck if want is None else (*ck, want)
+    fut = _inflight.get(fk)
+    if fut is not None:
+        return await asyncio.shield(fut)
+
+    fut = _inflight[fk] = asyncio.get_running_loop().create_future()
+    try:
+        data = await load_catalog_index_async(base_url, api_key, want)
+        await asyncio.to_thread(core.store_catalog, ck, data)
+        fut.set_result(data)
+        return data
+    except asyncio.CancelledError:
+        fut.cancel()
+        raise
+    except Exception as e:
+        fut.set_exception(e)
+        fut.exception()  # đánh dấu đã đọc, tránh warning khi không có ai chờ
+        raise
+    finally:
+        _inflight.pop(fk, None)
+
+
+# ========= Handlers (cùng hợp đồng response với app.py) =========
+async def stock(args):
+    key = args.get("key", [""])[0].strip()
+    if not key:
+        core.log("STOCK_ERROR", "missing key")
+        core.metric_error("stock", "bad_request")
+        return {"sum": 0}
+
+    row = await asyncio.to_thread(core.find_map_by_key, key)
+    if not row:
+        core.log("STOCK_ERROR", "unknown key", key=key)
+        core.metric_error("stock", "unknown_key")
+        return {"sum": 0}
+    if not await admit_key("stock", key):
+        return {"sum": 0}
+    if not row['provider_type']:
+        core.log("STOCK_ERROR", "provider not supported or not set", provider=row["provider_type"])
+        return {"sum": 0}
+
+    try:
+        base_url = row['base_url'] or 'https://mail72h.com'
+        catalog = await get_catalog_async(base_url, row["api_key"], want=str(row["product_id"]))
+        return {"sum": await asyncio.to_thread(core.stock_total, row, catalog)}
+    except httpx.HTTPStatusError as e:
+        core.log("STOCK_ERROR", "HTTP error", error=core.http_error_message(e))
+        core.metric_error("stock", "http")
+        return {"sum": await asyncio.to_thread(core.inventory_stock, row)}
+    except Exception as e:
+        core.log("STOCK_ERROR", "processing error", error=repr(e))
+        core.metric_error("stock", exception_class(e))
+        return {"sum": await asyncio.to_thread(core.inventory_stock, row)}
+
+async def fetch(args):
+    key = args.get("key", [""])[0].strip()
+    qty_s = args.get("quantity", [""])[0].strip()
+    order_id = args.get("order_id", [""])[0].strip() or None
+
+    if not key or not qty_s:
+        core.log("FETCH_ERROR", "missing key/quantity")
+        core.metric_error("fetch", "bad_request")
+        return []
+    try:
+        qty = int(qty_s)
+        if qty<=0 or qty>1000: raise ValueError()
+    except Exception:
+        core.log("FETCH_ERROR", "invalid quantity", quantity=qty_s)
+        core.metric_error("fetch", "bad_request")
+        return []
+    if order_id and len(order_id) > 128:
+        core.log("FETCH_ERROR", "order_id too long")
+        core.metric_error("fetch", "bad_request")
+        return []
+
+    row = await asyncio.to_thread(core.find_map_by_key, key)
+    if not row:
+        core.log("FETCH_ERROR", "unknown key", key=key)
+        core.metric_error("fetch", "unknown_key")
+        return []
+    if not await admit_key("fetch", key):
+        return []
+    if not row['provider_type']:
+        core.log("FETCH_ERROR", "provider not supported or not set", provider=row["provider_type"])
+        return []
+
+    if order_id and not await asyncio.to_thread(core.order_claim, row, order_id, qty):
+        return await order_replay_async(row, order_id)
+    try:
+        items = await asyncio.to_thread(core.take_inventory, row, qty)
+    except Exception:
+        await asyncio.to_thread(core.order_release, row, order_id)
+        raise
+    if items is None:
+        if core.FETCH_CHUNK_SIZE > 0 and qty > core.FETCH_CHUNK_SIZE:
+            return fetch_chunked(row, qty, order_id)
+        items, err = await buy_live_async(row, qty)
+        if err is not None:
+            await asyncio.to_thread(core.order_failed, row, order_id, err)
+            return items
+    await asyncio.to_thread(core.order_record, row, order_id, items)
+    return items
+
+async def order_replay_async(row, order_id: str) -> list:
+    """Như core.order_replay, chờ đơn đang mua bằng asyncio.sleep."""
+    deadline = time.monotonic() + core.ORDER_WAIT
+    while True:
+        status, items = await asyncio.to_thread(core.order_state, row, order_id)
+        if status != "pending" or time.monotonic() >= deadline:
+            break
+        await asyncio.sleep(0.2)
+    if status not in ("done", None):
+        core.log("ORDER_ERROR", f"order {status}, replayed journal", key=row["input_key"], order_id=order_id, items=len(items))
+    return items
+
+async def buy_live_async(row, qty: int):
+    """Như core.buy_live: (items, BuyError hoặc None)."""
+    base_url = row['base_url'] or 'https://mail72h.com'
+    items, err = await buy_chunk_async(base_url, row["api_key"], int(row["product_id"]), qty)
+    if err is not None:
+        core.log("FETCH_ERROR", "buy failed", error=str(err), outcome_unknown=err.unknown)
+    return items, err
+
+def buy_outcome_unknown(e: Exception) -> bool:
+    """Bản httpx của core.buy_outcome_unknown."""
+    return not isinstance(e, (core.CircuitOpenError, core.RateLimitedError,
+                              httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout))
+
+async def buy_chunk_async(base_url: str, api_key: str, product_id: int, n: int):
+    try:
+        res = await mail72h_buy_async(base_url, api_key, product_id, n)
+    except httpx.HTTPStatusError as e:
+        core.metric_error("fetch", "http")
+        return [], core.BuyError(f"HTTP: {core.http_error_message(e)}", unknown=e.response.status_code >= 500)
+    except Exception as e:
+        core.metric_error("fetch", exception_class(e))
+        return [], core.BuyError(f"Connect: {e}", unknown=buy_outcome_unknown(e))
+    if res.get("status") != "success":
+        core.metric_error("fetch", "api_status")
+        return [], core.BuyError(f"API: {res.get('message', 'mail72h buy failed')}")
+    return core.fetch_items(res, n), None
+
+async def buy_in_chunks_async(row, qty: int, on_abandoned=None):
+    """
+    Bản asyncio của core.buy_in_chunks (cùng giới hạn song song, cùng cách dừng khi lỗi).
+    Đóng sớm: không huỷ phần đang mua (không biết NCC đã nhận request chưa) mà chờ xong rồi
+    giao cho `await on_abandoned(n, items, lỗi)` (mặc định core.log_abandoned_chunk).
+    """
+    base_url = row['base_url'] or 'https://mail72h.com'
+    sizes = core.chunk_sizes(qty, core.FETCH_CHUNK_SIZE)
+    pending = {}  # Task -> số lượng
+    failed = False
+    try:
+        while pending or (sizes and not failed):
+            while sizes and not failed and len(pending) < core.FETCH_CHUNK_CONCURRENCY:
+                n = sizes.pop(0)
+                task = asyncio.ensure_future(buy_chunk_async(base_url, row["api_key"], int(row["product_id"]), n))
+                pending[task] = n
+            done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for t in done:
+                items, err = t.result()
+                failed = failed or err is not None
+                yield pending.pop(t), items, err
+    finally:
+        if pending:
+            # shield: request bị huỷ thì việc thu hàng vẫn chạy tiếp ở task riêng
+            await asyncio.shield(asyncio.ensure_future(_settle_chunks(row, pending, on_abandoned)))
+
+async def _settle_chunks(row, pending: dict, on_abandoned=None):
+    await asyncio.wait(pending)
+    for t, n in pending.items():
+        items, err = t.result()
+        if on_abandoned is not None:
+            await on_abandoned(n, items, err)
+        else:
+            core.log_abandoned_chunk(row, n, items, err)
+
+async def fetch_chunked(row, qty: int, order_id=None):
+    """Bản asyncio của core.fetch_mail72h_chunked (cùng cách ghi nhật ký và chốt đơn)."""
+    delivered, journaled, errors, finished = 0, 0, [], False
+    settled = True  # mọi phần đều biết kết quả và mọi hàng đều đã vào nhật ký
+
+    async def journal(items):
+        nonlocal journaled, settled
+        seq, journaled = journaled, journaled + len(items)
+        # Hàng đã mua: client ngắt (task bị huỷ) cũng phải ghi xong nhật ký. Huỷ to_thread khi
+        # executor chưa chạy việc ghi sẽ bỏ luôn việc ghi -> shield, chờ xong rồi mới báo huỷ.
+        write = asyncio.ensure_future(asyncio.to_thread(core.order_record, row, order_id, items, seq=seq, done=False))
+        try:
+            settled = await asyncio.shield(write) and settled
+        except asyncio.CancelledError:
+            settled = await write and settled
+            raise
+
+    async def abandoned(n, items, err):
+        nonlocal settled
+        core.log_abandoned_chunk(row, n, items, err)
+        settled = settled and not (err and err.unknown)
+        if items:
+            await journal(items)
+
+    chunks = buy_in_chunks_async(row, qty, on_abandoned=abandoned)
+    try:
+        yield "["
+        async for n, items, err in chunks:
+            if err:
+                errors.append(f"{n} units: {err}")
+                settled = settled and not err.unknown
+            if items:
+                await journal(items)
+                piece = ("," if delivered else "") + ",".join(json.dumps(it, separators=(",", ":")) for it in items)
+                delivered += len(items)
+                yield piece
+        yield "]\n"
+        finished = True
+    finally:
+        await chunks.aclose()  # chờ các phần đang mua dở rồi ghi hàng của chúng vào nhật ký
+        if not settled:
+            if order_id:
+                core.log("ORDER_ERROR", "order left pending, chunk outcome unknown", key=row["input_key"],
+                         order_id=order_id, journaled=journaled, quantity=qty)
+        elif journaled:
+            await asyncio.to_thread(core.order_record, row, order_id, [], done=True)
+        else:
+            await asyncio.to_thread(core.order_release, row, order_id)
+        if errors or not finished:
+            why = "; ".join(errors) if errors else "client disconnected"
+            core.log("ORDER_ERROR", "chunked fetch incomplete", key=row["input_key"], delivered=delivered,
+                     journaled=journaled, quantity=qty, error=why)
+
+ROUTES = {"/stock": stock, "/fetch": fetch}
+
+
+# ========= ASGI app =========
+async def _send_json(send, obj, status=200, extra_headers=()):
+    body = (json.dumps(obj, separators=(",", ":"), sort_keys=True) + "\n").encode()
+    await send({"type": "http.response.start", "status": status,
+                "headers": [(b"content-type", b"application/json"),
+                            (b"content-length", str(len(body)).encode()), *extra_headers]})
+    await send({"type": "http.response.body", "body": body})
+
+async def _wait_disconnect(receive):
+    while (await receive())["type"] != "http.disconnect":
+        pass
+
+async def _send_stream(send, receive, chunks):
+    """
+    Chunked transfer: không có content-length, mỗi phần gửi ngay khi có.
+    Uvicorn không báo lỗi khi send() sau lúc client ngắt (chỉ bỏ qua), nên phải tự chờ
+    http.disconnect: khi có thì huỷ việc gửi -> generator (fetch_chunked) dừng mua phần mới,
+    chờ các phần đang mua rồi ghi nhật ký/log như khi bị đóng sớm.
+    """
+    async def pump():
+        try:
+            await send({"type": "http.response.start", "status": 200,
+                        "headers": [(b"content-type", b"application/json")]})
+            async for piece in chunks:
+                await send({"type": "http.response.body", "body": piece.encode(), "more_body": True})
+            await send({"type": "http.response.body", "body": b""})
+        finally:
+            await chunks.aclose()
+
+    sender = asyncio.ensure_future(pump())
+    watcher = asyncio.ensure_future(_wait_disconnect(receive))
+    try:
+        await asyncio.wait({sender, watcher}, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        watcher.cancel()
+        if not sender.done():
+            sender.cancel()
+        # Chờ generator thu xong các phần đang mua (kể cả khi chính request này bị huỷ)
+        await asyncio.shield(asyncio.gather(sender, return_exceptions=True))
+    if not sender.cancelled() and sender.exception() is not None:
+        raise sender.exception()
+
+async def _lifespan(receive, send):
+    while True:
+        msg = await receive()
+        if msg["type"] == "lifespan.startup":
+            await send({"type": "lifespan.startup.complete"})
+        elif msg["type"] == "lifespan.shutdown":
+            await asyncio.gather(*(c.aclose() for c in _clients.values()), return_exceptions=True)
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+async def app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        return await _lifespan(receive, send)
+
+    handler = ROUTES.get(scope.get("path")) if scope["type"] == "http" and scope["method"] == "GET" else None
+    if handler is None:
+        return await _wsgi(scope, receive, send)
+
+    core.start_background()
+    timings = core.trace_start()
+    t0 = time.perf_counter()
+    # Giống Flask: query string là UTF-8 (key có dấu phải ra cùng 1 chuỗi ở cả 2 đường)
+    args = parse_qs(scope["query_string"].decode("utf-8", errors="replace"))
+    result = await handler(args)
+    if hasattr(result, "__aiter__"):
+        await _send_stream(send, receive, result)
+    else:
+        st = core.server_timing({**timings, "total": time.perf_counter() - t0})
+        await _send_json(send, result, extra_headers=[(b"server-timing", st.encode())])
+    core.metric_observe("http_request_duration_seconds", time.perf_counter() - t0,
+                        route=scope["path"], status="200")
@@ -0,0 +1,58 @@
+"""
+So sánh tốc độ tra keymap: mở kết nối mới mỗi lần (db() cũ) vs kết nối dùng lại (db() mới).
+
+    python bench/bench_db.py --keys 5000 --lookups 20000
+
+Chạy trên một file SQLite tạm, không đụng tới DB_PATH thật.
+"""
+import argparse, os, random, sqlite3, sys, tempfile, time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--keys", type=int, default=5000)
+    ap.add_argument("--lookups", type=int, default=20000)
+    args = ap.parse_args()
+
+    os.environ["DB_PATH"] = os.path.join(tempfile.mkdtemp(), "bench.db")
+    sys.path.insert(0, ROOT)
+    import app
+
+    with app.db() as con:
+        con.executemany(
+            "INSERT INTO keymaps(group_name, sku, input_key, product_id, api_key, provider_type, base_url) "
+            "VALUES('bench', 'sku', ?, ?, 'k', 'mail72h', '')",
+            [(f"key-{i}", i) for i in range(args.keys)])
+        con.commit()
+    keys = [f"key-{random.randrange(args.keys)}" for _ in range(args.lookups)]
+    sql = "SELECT * FROM keymaps WHERE input_key=? AND is_active=1"
+
+    def old_db():
+        con = sqlite3.connect(app.DB)
+        con.row_factory = sqlite3.Row
+        return con
+
+    def run(name, lookup):
+        t0 = time.perf_counter()
+        for k in keys:
+            lookup(k)
+        dt = time.perf_counter() - t0
+        print(f"{name:<28} {args.lookups / dt:>12,.0f} lookups/s")
+
+    def before(k):
+        con = old_db()
+        with con:
+            con.execute(sql, (k,)).fetchone()
+        con.close()
+
+    def after(k):
+        with app.db() as con:
+            con.execute(sql, (k,)).fetchone()
+
+    run("connect per lookup (cũ)", before)
+    run("per-thread connection + WAL", after)
+    run("find_map_by_key (cache RAM)", app.find_map_by_key)
+
+if __name__ == "__main__":
+    main()
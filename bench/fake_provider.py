@@ -0,0 +1,94 @@
+"""
+NCC giả lập cho benchmark: /api/products.php và /api/buy_product giống mail72h.
+
+    python bench/fake_provider.py --port 9100 --products 2000 --categories 10 --latency 0.2 --error-rate 0.01
+
+--error-rate: tỉ lệ request trả lỗi (một nửa HTTP 500, một nửa {"status": "error"}).
+
+Dùng trong code: `server, base_url = start(products=..., latency=...)` (chạy ở thread nền).
+"""
+import argparse, json, random, threading, time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import parse_qs, urlparse
+
+def build_catalog(products: int, categories: int) -> bytes:
+    categories = max(categories, 1)
+    per_cat = -(-products // categories)
+    cats = []
+    for c in range(categories):
+        ids = range(c * per_cat + 1, min((c + 1) * per_cat, products) + 1)
+        cats.append({"name": f"cat-{c}", "products": [
+            {"id": str(i), "name": f"product {i}", "price": "1000", "amount": str(i * 10)} for i in ids]})
+    return json.dumps({"status": "success", "categories": cats}).encode()
+
+def make_handler(catalog: bytes, latency: float, error_rate: float = 0.0):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args):
+            pass
+
+        def _send(self, body: bytes, status=200):
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _fail(self) -> bool:
+            if error_rate <= 0 or random.random() >= error_rate:
+                return False
+            if random.random() < 0.5:
+                self._send(b'{"status":"error","message":"internal error"}', 500)
+            else:
+                self._send(b'{"status":"error","message":"rate limited"}')
+            return True
+
+        def do_GET(self):
+            time.sleep(latency)
+            if urlparse(self.path).path != "/api/products.php":
+                return self._send(b'{"status":"error","message":"not found"}', 404)
+            if not self._fail():
+                self._send(catalog)
+
+        def do_POST(self):
+            length = int(self.headers.get("Content-Length") or 0)
+            form = parse_qs(self.rfile.read(length).decode())
+            time.sleep(latency)
+            if urlparse(self.path).path != "/api/buy_product":
+                return self._send(b'{"status":"error","message":"not found"}', 404)
+            if self._fail():
+                return
+            amount = int(form.get("amount", ["1"])[0])
+            pid = form.get("id", ["0"])[0]
+            data = [{"product_id": pid, "email": f"user{i}@example.com", "password": "secret"} for i in range(amount)]
+            self._send(json.dumps({"status": "success", "data": data}).encode())
+
+    return Handler
+
+def start(host="127.0.0.1", port=0, products=500, categories=5, latency=0.0, error_rate=0.0):
+    server = ThreadingHTTPServer((host, port), make_handler(build_catalog(products, categories), latency, error_rate))
+    server.daemon_threads = True
+    server.request_queue_size = 1024
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://{host}:{server.server_address[1]}"
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=9100)
+    ap.add_argument("--products", type=int, default=500)
+    ap.add_argument("--categories", type=int, default=5)
+    ap.add_argument("--latency", type=float, default=0.0, help="giây trễ mỗi request")
+    ap.add_argument("--error-rate", type=float, default=0.0)
+    args = ap.parse_args()
+    server, base_url = start(args.host, args.port, args.products, args.categories, args.latency, args.error_rate)
+    print(f"fake provider on {base_url}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+if __name__ == "__main__":
+    main()
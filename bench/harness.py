@@ -0,0 +1,90 @@
+"""
+Hàm dùng chung cho các script benchmark: seed DB tạm, chạy server con, đo latency.
+"""
+import json, os, socket, subprocess, sys, threading, time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def seed(db_path: str, base_url: str, keys: int, accounts: int, products: int):
+    """Tạo `keys` keymap key-0..key-N, chia đều cho `accounts` api_key khác nhau."""
+    env = dict(os.environ, DB_PATH=db_path)
+    rows = [(f"key-{i}", i % max(products, 1) + 1, f"api-{i % max(accounts, 1)}") for i in range(keys)]
+    code = (
+        "import app, json, sys\n"
+        "rows = json.loads(sys.stdin.read())\n"
+        "with app.db() as con:\n"
+        "    con.executemany(\"INSERT INTO keymaps(group_name, sku, input_key, product_id, api_key, provider_type, base_url) "
+        f"VALUES('bench', 'sku', ?, ?, ?, 'mail72h', {base_url!r})\", rows)\n"
+        "    con.commit()\n")
+    subprocess.run([sys.executable, "-c", code], cwd=ROOT, env=env, input=json.dumps(rows), text=True, check=True,
+                   stdout=subprocess.DEVNULL)
+
+def start_server(cmd, env):
+    proc = subprocess.Popen(cmd, cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return proc
+
+def wait_ready(url: str, proc, timeout=20):
+    t0 = time.time()
+    while time.time() - t0 < timeout:
+        if proc.poll() is not None:
+            raise RuntimeError(f"server exited with {proc.returncode}")
+        try:
+            requests.get(url, timeout=1)
+            return
+        except requests.RequestException:
+            time.sleep(0.2)
+    raise RuntimeError(f"{url} not ready")
+
+def stop_server(proc):
+    proc.terminate()
+    try:
+        proc.wait(timeout=10)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+        proc.wait()
+
+def percentile(sorted_vals, q: float) -> float:
+    if not sorted_vals:
+        return 0.0
+    return sorted_vals[min(int(q * len(sorted_vals)), len(sorted_vals) - 1)]
+
+def drive(make_url, total: int, concurrency: int, timeout=60) -> dict:
+    """
+    Gửi `total` GET (make_url(i) -> url) với `concurrency` luồng, mỗi luồng 1 Session keep-alive.
+    Trả về {"rps", "p50", "p95", "p99" (ms), "errors"}.
+    """
+    local = threading.local()
+    lat, errors = [], [0]
+    lock = threading.Lock()
+
+    def one(i):
+        s = getattr(local, "s", None)
+        if s is None:
+            s = local.s = requests.Session()
+        t = time.perf_counter()
+        try:
+            ok = s.get(make_url(i), timeout=timeout).status_code == 200
+        except requests.RequestException:
+            ok = False
+        dt = time.perf_counter() - t
+        with lock:
+            lat.append(dt)
+            if not ok:
+                errors[0] += 1
+
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as ex:
+        list(ex.map(one, range(total)))
+    wall = time.perf_counter() - t0
+    lat.sort()
+    return {"rps": total / wall, "p50": percentile(lat, 0.50) * 1000, "p95": percentile(lat, 0.95) * 1000,
+            "p99": percentile(lat, 0.99) * 1000, "errors": errors[0]}
@@ -0,0 +1,53 @@
+"""
+Load test /stock: gunicorn sync (app:app) so với ASGI (asgi:app) khi NCC chậm.
+
+    python bench/loadtest_async.py --workers 2 --concurrency 50 --requests 500 --latency 0.2
+
+Mỗi key dùng một api_key riêng và tắt cache (CATALOG_TTL=0, CATALOG_SNAPSHOTS=0), nên mọi
+request đều phải gọi NCC giả lập -> đo đúng số request đồng thời mỗi chế độ xử lý được.
+"""
+import argparse, os, sys, tempfile
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+import fake_provider
+from harness import drive, free_port, seed, start_server, stop_server, wait_ready
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--workers", type=int, default=2)
+    ap.add_argument("--concurrency", type=int, default=50)
+    ap.add_argument("--requests", type=int, default=500)
+    ap.add_argument("--keys", type=int, default=100)
+    ap.add_argument("--latency", type=float, default=0.2)
+    args = ap.parse_args()
+
+    server, base_url = fake_provider.start(products=args.keys, categories=5, latency=args.latency)
+    db_path = os.path.join(tempfile.mkdtemp(), "loadtest.db")
+    seed(db_path, base_url, args.keys, accounts=args.keys, products=args.keys)
+    env = dict(os.environ, DB_PATH=db_path, CATALOG_TTL="0", CATALOG_SNAPSHOTS="0",
+               DEFAULT_TIMEOUT="30", PYTHONUNBUFFERED="1")
+
+    modes = {
+        "gunicorn sync (app:app)": lambda port: [sys.executable, "-m", "gunicorn", "app:app",
+                                                 "-w", str(args.workers), "-b", f"127.0.0.1:{port}"],
+        "uvicorn (asgi:app)": lambda port: [sys.executable, "-m", "uvicorn", "asgi:app", "--workers",
+                                            str(args.workers), "--port", str(port), "--log-level", "warning"],
+    }
+    print(f"provider latency {args.latency * 1000:.0f} ms, {args.workers} workers, "
+          f"concurrency {args.concurrency}, {args.requests} requests")
+    for name, cmd in modes.items():
+        port = free_port()
+        proc = start_server(cmd(port), env)
+        try:
+            url = f"http://127.0.0.1:{port}"
+            wait_ready(url, proc)
+            r = drive(lambda i: f"{url}/stock?key=key-{i % args.keys}", args.requests, args.concurrency)
+            print(f"{name:<26} {r['rps']:>8.1f} req/s   p50 {r['p50']:>7.1f} ms   p95 {r['p95']:>7.1f} ms"
+                  f"   errors {r['errors']}")
+        finally:
+            stop_server(proc)
+    server.shutdown()
+
+if __name__ == "__main__":
+    main()
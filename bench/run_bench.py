@@ -0,0 +1,114 @@
+"""
+Benchmark /stock, /fetch, /admin với NCC giả lập, theo từng loại gunicorn worker.
+
+    python bench/run_bench.py --worker-class sync --worker-class gthread --worker-class uvicorn \
+        --products 5000 --categories 20 --latency 0.05 --error-rate 0.01 \
+        --concurrency 32 --requests 1000 --json bench_output.json
+
+    # So sánh với lần chạy trước (phát hiện regression):
+    python bench/run_bench.py ... --baseline bench_output.json
+
+Worker class: sync, gthread, gevent (cần cài gevent), uvicorn (asgi:app qua UvicornWorker).
+Class nào thiếu thư viện thì bị bỏ qua. Mọi cấu hình cache/refresher của app có thể truyền
+qua biến môi trường như khi chạy thật (vd. CATALOG_TTL=0 để luôn gọi NCC).
+"""
+import argparse, importlib.util, json, os, sys, tempfile
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+import fake_provider
+from harness import drive, free_port, seed, start_server, stop_server, wait_ready
+
+ADMIN_SECRET = "bench-secret"
+
+def worker_command(worker_class: str, port: int, args):
+    """Lệnh gunicorn cho worker_class, hoặc None nếu thiếu thư viện."""
+    base = [sys.executable, "-m", "gunicorn", "-w", str(args.workers), "-b", f"127.0.0.1:{port}",
+            "--timeout", "120"]
+    if worker_class == "sync":
+        return base + ["-k", "sync", "app:app"]
+    if worker_class == "gthread":
+        return base + ["-k", "gthread", "--threads", str(args.threads), "app:app"]
+    if worker_class == "gevent":
+        if not importlib.util.find_spec("gevent"):
+            return None
+        return base + ["-k", "gevent", "--worker-connections", str(args.concurrency * 2), "app:app"]
+    if worker_class == "uvicorn":
+        if not importlib.util.find_spec("uvicorn") or not importlib.util.find_spec("uvicorn.workers"):
+            return None
+        return base + ["-k", "uvicorn.workers.UvicornWorker", "asgi:app"]
+    raise SystemExit(f"unknown worker class {worker_class!r}")
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--worker-class", action="append", dest="worker_classes",
+                    help="sync | gthread | gevent | uvicorn (lặp lại để chạy nhiều loại)")
+    ap.add_argument("--workers", type=int, default=2)
+    ap.add_argument("--threads", type=int, default=8, help="số thread mỗi worker gthread")
+    ap.add_argument("--endpoint", action="append", dest="endpoints", help="stock | fetch | admin")
+    ap.add_argument("--concurrency", type=int, default=16)
+    ap.add_argument("--requests", type=int, default=500, help="số request mỗi endpoint")
+    ap.add_argument("--keys", type=int, default=200)
+    ap.add_argument("--accounts", type=int, default=5, help="số api_key NCC khác nhau")
+    ap.add_argument("--products", type=int, default=1000)
+    ap.add_argument("--categories", type=int, default=10)
+    ap.add_argument("--latency", type=float, default=0.05, help="giây trễ của NCC giả lập")
+    ap.add_argument("--error-rate", type=float, default=0.0)
+    ap.add_argument("--fetch-qty", type=int, default=5)
+    ap.add_argument("--json", help="ghi kết quả ra file JSON")
+    ap.add_argument("--baseline", help="file JSON của lần chạy trước để so sánh")
+    args = ap.parse_args()
+    worker_classes = args.worker_classes or ["sync", "gthread"]
+    endpoints = args.endpoints or ["stock", "fetch", "admin"]
+
+    server, base_url = fake_provider.start(products=args.products, categories=args.categories,
+                                           latency=args.latency, error_rate=args.error_rate)
+    db_path = os.path.join(tempfile.mkdtemp(), "bench.db")
+    seed(db_path, base_url, args.keys, args.accounts, args.products)
+    env = dict(os.environ, DB_PATH=db_path, ADMIN_SECRET=ADMIN_SECRET, PYTHONUNBUFFERED="1")
+
+    urls = {
+        "stock": lambda url: lambda i: f"{url}/stock?key=key-{i % args.keys}",
+        "fetch": lambda url: lambda i: f"{url}/fetch?key=key-{i % args.keys}&quantity={args.fetch_qty}",
+        "admin": lambda url: lambda i: f"{url}/admin?admin_secret={ADMIN_SECRET}",
+    }
+
+    print(f"provider: {args.products} products / {args.categories} categories, latency "
+          f"{args.latency * 1000:.0f} ms, error rate {args.error_rate:.1%}; {args.workers} workers, "
+          f"concurrency {args.concurrency}, {args.requests} requests/endpoint")
+    print(f"{'worker':<10} {'endpoint':<8} {'req/s':>9} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'errors':>7}")
+    results = {}
+    for wc in worker_classes:
+        port = free_port()
+        cmd = worker_command(wc, port, args)
+        if cmd is None:
+            print(f"{wc:<10} skipped (library not installed)")
+            continue
+        proc = start_server(cmd, env)
+        try:
+            url = f"http://127.0.0.1:{port}"
+            wait_ready(url, proc)
+            for ep in endpoints:
+                drive(urls[ep](url), min(args.concurrency * 2, args.requests), args.concurrency)  # warm-up
+                r = drive(urls[ep](url), args.requests, args.concurrency)
+                results[f"{wc}/{ep}"] = r
+                print(f"{wc:<10} {ep:<8} {r['rps']:>9.1f} {r['p50']:>9.1f} {r['p95']:>9.1f} {r['p99']:>9.1f} {r['errors']:>7}")
+        finally:
+            stop_server(proc)
+    server.shutdown()
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"args": vars(args), "results": results}, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            base = json.load(f)["results"]
+        print("\nso với baseline (dương = tốt hơn):")
+        for name, r in results.items():
+            if name in base and base[name]["rps"] and r["p95"]:
+                d_rps = (r["rps"] / base[name]["rps"] - 1) * 100
+                d_p95 = (base[name]["p95"] / r["p95"] - 1) * 100
+                print(f"  {name:<20} req/s {d_rps:+7.1f}%   p95 {d_p95:+7.1f}%")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,9 @@
+"""
+Cấu hình gunicorn (tự được nạp khi chạy `gunicorn app:app` trong thư mục này).
+Migration DB chạy 1 lần ở master trước khi fork worker; worker chỉ kiểm tra PRAGMA user_version.
+"""
+import subprocess, sys
+
+def on_starting(server):
+    # Process con: master không import app (giữ nguyên cách worker tự nạp app và reload bằng HUP)
+    subprocess.run([sys.executable, "app.py", "migrate"], cwd=server.cfg.chdir, check=True)
@@ -0,0 +1,56 @@
+"""
+Fixture chung: DB SQLite tạm cho cả phiên test, NCC giả lập của bench (bench/fake_provider.py)
+chạy ở thread nền, và hàm tạo keymap trỏ vào NCC đó.
+
+    python -m pytest -q
+"""
+import os, sys, tempfile, uuid
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "bench"))
+
+# app.py đọc cấu hình lúc import: đặt trước khi import
+TMP = tempfile.mkdtemp(prefix="store-test-")
+os.environ["DB_PATH"] = os.path.join(TMP, "store.db")
+# Thread ghi log giữ stream lúc khởi động: ghi ra file, không ghi vào stdout mà pytest đóng khi kết thúc
+os.environ["LOG_FILE"] = os.path.join(TMP, "app.log")
+os.environ["ADMIN_SECRET"] = "test-secret"
+os.environ.setdefault("ORDER_WAIT", "1")
+
+import pytest
+
+import app as core
+import fake_provider
+
+@pytest.fixture(scope="session")
+def provider():
+    server, base_url = fake_provider.start(products=200, categories=4)
+    yield base_url
+    server.shutdown()
+
+@pytest.fixture(scope="session")
+def slow_provider():
+    # Mỗi request chờ 0.2s: đủ lâu để client ngắt khi còn phần đang mua
+    server, base_url = fake_provider.start(products=20, categories=1, latency=0.2)
+    yield base_url
+    server.shutdown()
+
+@pytest.fixture
+def client():
+    return core.app.test_client()
+
+@pytest.fixture
+def make_key():
+    """make_key(base_url, product_id=..., **cột khác) -> row keymaps (input_key ngẫu nhiên)."""
+    def make(base_url, product_id=7, **fields):
+        rec = {"group_name": "test", "provider_type": "mail72h", "base_url": base_url, "sku": "sku",
+               "input_key": "k-" + uuid.uuid4().hex[:12], "product_id": str(product_id), "api_key": "A",
+               "is_active": "1", **fields}
+        with core.db() as con:
+            con.execute(core.KEYMAP_UPSERT, core.keymap_values(rec))
+            core.bump_keymap_version(con)
+            con.commit()
+        core.keymap_cache_invalidate()
+        return core.find_map_by_key(rec["input_key"])
+    return make
@@ -0,0 +1,57 @@
+"""Index catalog: đường nhanh của _index_amounts_add, stream_catalog_index (_JsonStream) và fallback parse toàn bộ."""
+import json
+
+import pytest
+
+import app as core
+import fake_provider
+
+def test_index_id_fast_path_matches_slow_path():
+    for raw in ("28", "28.0", " 28 ", "028", 28, 28.0, "٣", "²", "abc"):
+        amounts = {}
+        pid = core._index_amounts_add(amounts, {"id": raw, "amount": "1.234"})
+        try:
+            expected = str(int(float(str(raw).strip())))
+        except ValueError:
+            expected = None
+        assert pid == expected, raw
+        assert amounts == ({expected: 1234} if expected else {})
+
+def _split(body: bytes, size: int):
+    return [body[i:i + size] for i in range(0, len(body), size)]
+
+@pytest.mark.parametrize("size", [1, 7, 64, 65536])
+def test_stream_index_matches_full_parse(size):
+    body = fake_provider.build_catalog(products=300, categories=4)
+    # Chữ có dấu bị cắt giữa chunk: incremental decoder phải ghép lại đúng
+    body = body.replace(b'"cat-1"', '"Danh mục 1"'.encode())
+    assert core.stream_catalog_index(_split(body, size)) == core.build_catalog_index(json.loads(body))
+
+def test_stream_index_stops_at_wanted_product():
+    body = fake_provider.build_catalog(products=300, categories=4)
+    read = []
+    def chunks():
+        for c in _split(body, 256):
+            read.append(c)
+            yield c
+    data = core.stream_catalog_index(chunks(), want="5")
+    assert data["partial"] and data["amounts"] == {"5": 50}
+    assert len(read) < len(body) // 256  # không đọc hết body
+
+@pytest.mark.parametrize("body", [
+    # UTF-16: stream (chỉ hiểu UTF-8) lỗi, json.loads(bytes) vẫn đọc được
+    json.dumps({"status": "success", "categories": [{"products": [{"id": "1", "amount": "9"}]}]}).encode("utf-16"),
+    # Không phải object: build_catalog_index báo lỗi như trước khi có stream
+    b'[{"id": "1", "amount": "9"}]',
+    # Không có product nào: giữ "raw" để log như cũ
+    b'{"status": "success", "categories": []}',
+])
+def test_index_catalog_chunks_falls_back_to_full_parse(body):
+    data = core.index_catalog_chunks(iter(_split(body, 5)), None, lambda: body)
+    assert data == core.build_catalog_index(json.loads(body))
+
+def test_load_catalog_index_stream_and_full_parse_agree(provider, monkeypatch):
+    streamed = core.load_catalog_index(provider, "A")
+    monkeypatch.setattr(core, "CATALOG_STREAM", False)
+    assert core.load_catalog_index(provider, "A") == streamed
+    assert streamed["count"] == 200
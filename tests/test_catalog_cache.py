@@ -0,0 +1,75 @@
+"""Cache catalog theo (base_url, api_key): TTL và single-flight (nhiều request chờ chung 1 lần tải)."""
+import threading, time, uuid
+from http.server import ThreadingHTTPServer
+
+import pytest
+import requests
+
+import app as core
+import fake_provider
+
+@pytest.fixture
+def counting_provider():
+    """NCC giả lập đếm số request /api/products.php; status=500 -> mọi request catalog trả 500."""
+    state = {"catalog": 0, "status": 200}
+    base = fake_provider.make_handler(fake_provider.build_catalog(50, 2), latency=0.2)
+
+    class Handler(base):
+        def do_GET(self):
+            state["catalog"] += 1
+            if state["status"] != 200:
+                time.sleep(0.2)
+                return self._send(b'{"status":"error","message":"boom"}', state["status"])
+            super().do_GET()
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_address[1]}", state
+    server.shutdown()
+
+def _concurrent_get_catalog(base_url, api_key, n=16):
+    results, start = [None] * n, threading.Barrier(n)
+    def worker(i):
+        start.wait()
+        try:
+            results[i] = core.get_catalog(base_url, api_key)
+        except Exception as e:
+            results[i] = e
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(n)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return results
+
+def test_cold_key_is_fetched_once(counting_provider):
+    base_url, state = counting_provider
+    results = _concurrent_get_catalog(base_url, uuid.uuid4().hex)
+    assert state["catalog"] == 1
+    assert all(r is results[0] for r in results)
+    assert results[0]["status"] == "success" and results[0]["count"] == 50
+
+def test_error_reaches_every_waiter(counting_provider):
+    base_url, state = counting_provider
+    state["status"] = 500
+    api_key = uuid.uuid4().hex
+    results = _concurrent_get_catalog(base_url, api_key)
+    assert state["catalog"] == 1
+    assert all(isinstance(r, requests.HTTPError) for r in results)
+    # Lỗi không được cache: lần sau gọi lại NCC
+    state["status"] = 200
+    assert core.get_catalog(base_url, api_key)["status"] == "success"
+    assert state["catalog"] == 2
+
+def test_ttl_expiry_refetches(counting_provider, monkeypatch):
+    monkeypatch.setattr(core, "CATALOG_TTL", 0.3)
+    monkeypatch.setattr(core, "CATALOG_SNAPSHOTS", False)
+    base_url, state = counting_provider
+    api_key = uuid.uuid4().hex
+    core.get_catalog(base_url, api_key)
+    core.get_catalog(base_url, api_key)
+    assert state["catalog"] == 1
+    time.sleep(0.35)
+    core.get_catalog(base_url, api_key)
+    assert state["catalog"] == 2
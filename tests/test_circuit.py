@@ -0,0 +1,69 @@
+"""Circuit breaker theo base_url: mở sau CB_FAILURE_THRESHOLD lỗi, half-open cho đúng 1 request thử."""
+import socket, time, uuid
+
+import pytest
+
+import app as core
+
+@pytest.fixture
+def breaker(monkeypatch):
+    monkeypatch.setattr(core, "CB_FAILURE_THRESHOLD", 3)
+    monkeypatch.setattr(core, "CB_RESET_TIMEOUT", 0.2)
+    return f"http://cb-{uuid.uuid4().hex[:8]}.invalid"
+
+def test_opens_after_threshold(breaker):
+    for _ in range(2):
+        core.circuit_record(breaker, False)
+    core.circuit_allow(breaker)  # dưới ngưỡng: vẫn cho qua
+    core.circuit_record(breaker, False)
+    with pytest.raises(core.CircuitOpenError):
+        core.circuit_allow(breaker)
+
+def test_success_resets_failure_count(breaker):
+    for _ in range(2):
+        core.circuit_record(breaker, False)
+    core.circuit_record(breaker, True)
+    for _ in range(2):
+        core.circuit_record(breaker, False)
+    core.circuit_allow(breaker)
+
+def test_half_open_allows_single_probe(breaker):
+    for _ in range(3):
+        core.circuit_record(breaker, False)
+    time.sleep(0.25)
+    # probe=False (trước khi chờ rate limit) chỉ kiểm tra, không giữ lượt thử
+    core.circuit_allow(breaker, probe=False)
+    assert core._health[breaker]["state"] == "open"
+    core.circuit_allow(breaker)
+    assert core._health[breaker]["state"] == "half_open"
+    with pytest.raises(core.CircuitOpenError):
+        core.circuit_allow(breaker)  # lượt thử đang chạy: request khác bị chặn
+    core.circuit_record(breaker, True)
+    assert core._health[breaker]["state"] == "closed"
+    core.circuit_allow(breaker)
+
+def test_failed_probe_reopens(breaker):
+    for _ in range(3):
+        core.circuit_record(breaker, False)
+    time.sleep(0.25)
+    core.circuit_allow(breaker)
+    core.circuit_record(breaker, False)
+    assert core._health[breaker]["state"] == "open"
+    with pytest.raises(core.CircuitOpenError):
+        core.circuit_allow(breaker)
+
+def test_unreachable_provider_opens_circuit(client, make_key, monkeypatch):
+    monkeypatch.setattr(core, "CB_FAILURE_THRESHOLD", 2)
+    monkeypatch.setattr(core, "CB_RESET_TIMEOUT", 30)
+    with socket.socket() as s:  # cổng vừa được cấp rồi đóng: không có ai nghe
+        s.bind(("127.0.0.1", 0))
+        base_url = f"http://127.0.0.1:{s.getsockname()[1]}"
+    row = make_key(base_url)
+    for _ in range(2):
+        assert client.get(f"/stock?key={row['input_key']}").json == {"sum": 0}
+    assert core._health[base_url]["state"] == "open"
+    # Circuit mở: /fetch báo lỗi ngay, không gửi request mua
+    sent = []
+    monkeypatch.setattr(core, "provider_request", lambda *a, **k: sent.append(a))
+    assert client.get(f"/fetch?key={row['input_key']}&quantity=1").json == []
+    assert not sent
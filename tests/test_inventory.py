@@ -0,0 +1,70 @@
+"""Kho đệm: hàng đã trả tiền không bị bỏ rơi khi admin sửa/xoá key."""
+import pytest
+
+import app as core
+
+ADMIN = "?admin_secret=test-secret"
+
+@pytest.fixture
+def buffered(provider, make_key):
+    row = make_key(provider, product_id=7, buffer_low=2, buffer_high=3)
+    core.replenish(row)
+    assert core.inventory_count(row) == 3
+    return row
+
+@pytest.fixture
+def inventory_errors(monkeypatch):
+    logged = []
+    real = core.log
+    def log(cat, msg, **fields):
+        if cat == "INVENTORY_ERROR":
+            logged.append((msg, fields))
+        real(cat, msg, **fields)
+    monkeypatch.setattr(core, "log", log)
+    return logged
+
+def _left(row, product_id):
+    with core.db() as con:
+        return con.execute("SELECT COUNT(*) FROM inventory WHERE input_key=? AND product_id=?",
+                           (row["input_key"], product_id)).fetchone()[0]
+
+def _form(row, **fields):
+    return {"sku": "sku", "input_key": row["input_key"], "product_id": str(row["product_id"]), "api_key": "A",
+            "base_url": row["base_url"], **fields}
+
+def test_form_change_of_product_id_removes_inventory(client, buffered, inventory_errors):
+    assert client.post("/admin/keymap" + ADMIN, data=_form(buffered, product_id="8")).status_code == 302
+    assert _left(buffered, 7) == 0
+    (msg, fields), = inventory_errors
+    assert msg == "inventory removed, product_id changed" and len(fields["items"]) == 3
+    # Key giữ nguyên buffer, kho theo product mới mua lại từ đầu
+    row = core.find_map_by_key(buffered["input_key"])
+    assert (row["product_id"], row["buffer_low"], row["buffer_high"]) == (8, 2, 3)
+
+def test_form_save_without_change_keeps_inventory(client, buffered, inventory_errors):
+    assert client.post("/admin/keymap" + ADMIN, data=_form(buffered)).status_code == 302
+    assert _left(buffered, 7) == 3 and not inventory_errors
+
+def test_import_change_of_product_id_removes_inventory(client, buffered, inventory_errors):
+    line = '{"sku": "sku", "input_key": "%s", "product_id": "9", "api_key": "A"}' % buffered["input_key"]
+    r = client.post("/admin/keymaps/import" + ADMIN + "&format=jsonl&dry_run=1", data=line)
+    assert r.json["applied"] is False and _left(buffered, 7) == 3  # dry run: không đụng kho
+    r = client.post("/admin/keymaps/import" + ADMIN + "&format=jsonl", data=line)
+    assert r.json["applied"] is True
+    assert _left(buffered, 7) == 0 and len(inventory_errors) == 1
+
+def test_delete_key_removes_inventory(client, buffered, inventory_errors):
+    assert client.post(f"/admin/keymap/{buffered['id']}" + ADMIN).status_code == 302
+    assert _left(buffered, 7) == 0
+    assert inventory_errors[0][0] == "inventory removed with key"
+
+def test_zero_low_water_mark_refills_when_empty(provider, make_key):
+    row = make_key(provider, product_id=7, buffer_low=0, buffer_high=2)
+    core.replenish(row)
+    assert core.inventory_count(row) == 2
+    core.take_inventory(row, 1)
+    core.replenish(row)  # còn 1 >= buffer_low: chưa mua
+    assert core.inventory_count(row) == 1
+    core.take_inventory(row, 1)
+    core.replenish(row)  # hết kho: mua lại lên buffer_high
+    assert core.inventory_count(row) == 2
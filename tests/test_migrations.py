@@ -0,0 +1,69 @@
+"""Migration theo PRAGMA user_version: DB mới, DB cũ (trước khi có migration), chạy song song."""
+import sqlite3, threading
+
+import pytest
+
+import app as core
+
+@pytest.fixture
+def fresh_db(tmp_path, monkeypatch):
+    path = str(tmp_path / "store.db")
+    monkeypatch.setattr(core, "DB", path)  # migrate() tự mở kết nối tới core.DB
+    return path
+
+def _tables(path) -> set:
+    with sqlite3.connect(path) as con:
+        return {r[0] for r in con.execute("SELECT name FROM sqlite_master WHERE type='table'")}
+
+def _columns(path, table) -> list:
+    with sqlite3.connect(path) as con:
+        return [r[1] for r in con.execute(f"PRAGMA table_info({table})")]
+
+def test_fresh_db_gets_full_schema(fresh_db):
+    assert core.migrate() == core.SCHEMA_VERSION
+    assert {"keymaps", "app_meta", "catalog_snapshots", "leases", "rate_buckets",
+            "inventory", "orders", "order_journal"} <= _tables(fresh_db)
+    with sqlite3.connect(fresh_db) as con:
+        assert con.execute("PRAGMA user_version").fetchone()[0] == core.SCHEMA_VERSION
+    assert core.migrate() == core.SCHEMA_VERSION  # chạy lại: không làm gì
+
+def test_legacy_db_is_upgraded_in_place(fresh_db):
+    with sqlite3.connect(fresh_db) as con:
+        con.execute("""CREATE TABLE keymaps(id INTEGER PRIMARY KEY AUTOINCREMENT, sku TEXT NOT NULL,
+                       input_key TEXT NOT NULL UNIQUE, product_id INTEGER NOT NULL, is_active INTEGER DEFAULT 1,
+                       mail72h_api_key TEXT, note TEXT)""")
+        con.execute("INSERT INTO keymaps(sku, input_key, product_id, mail72h_api_key, note) VALUES('s','old',7,'KEY','x')")
+    core.migrate()
+    cols = _columns(fresh_db, "keymaps")
+    assert "api_key" in cols and "mail72h_api_key" not in cols and "note" not in cols
+    with sqlite3.connect(fresh_db) as con:
+        con.row_factory = sqlite3.Row
+        row = con.execute("SELECT * FROM keymaps WHERE input_key='old'").fetchone()
+    assert (row["api_key"], row["provider_type"], row["buffer_low"], row["buffer_high"]) == ("KEY", "mail72h", 0, 0)
+
+def test_newer_schema_is_left_alone(fresh_db):
+    core.migrate()
+    with sqlite3.connect(fresh_db) as con:
+        con.execute(f"PRAGMA user_version={core.SCHEMA_VERSION + 1}")
+    assert core.migrate() == core.SCHEMA_VERSION + 1
+
+def test_concurrent_migrate_runs_once(fresh_db, monkeypatch):
+    ran = []
+    def counted(fn):
+        def run(con):
+            ran.append(fn.__name__)
+            fn(con)
+        run.__name__ = fn.__name__
+        return run
+    monkeypatch.setattr(core, "MIGRATIONS", [counted(m) for m in core.MIGRATIONS])
+    results, start = [], threading.Barrier(8)
+    def worker():
+        start.wait()
+        results.append(core.migrate())
+    threads = [threading.Thread(target=worker) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert results == [core.SCHEMA_VERSION] * 8
+    assert ran == [m.__name__ for m in core.MIGRATIONS]
@@ -0,0 +1,236 @@
+"""/fetch theo phần (FETCH_CHUNK_SIZE) và nhật ký đơn khi client ngắt giữa chừng."""
+import asyncio, json, time, uuid
+
+import pytest
+import requests
+
+import app as core
+
+@pytest.fixture
+def chunked(monkeypatch):
+    # 10 đơn vị = 5 phần x 2, tối đa 3 phần chạy cùng lúc
+    monkeypatch.setattr(core, "FETCH_CHUNK_SIZE", 2)
+    monkeypatch.setattr(core, "FETCH_CHUNK_CONCURRENCY", 3)
+
+def test_disconnect_journals_inflight_chunks(client, slow_provider, make_key, chunked):
+    row = make_key(slow_provider)
+    order_id = uuid.uuid4().hex
+    r = client.get(f"/fetch?key={row['input_key']}&quantity=10&order_id={order_id}", buffered=False)
+    body = iter(r.response)
+    assert next(body) == b"["
+    first = json.loads(b"[" + next(body) + b"]")
+    r.close()  # client ngắt khi 2 phần còn lại đang mua
+
+    status, items = core.order_state(row, order_id)
+    assert status == "done"
+    # 3 phần đã gửi NCC: phần đã giao + 2 phần mua xong sau khi ngắt đều nằm trong nhật ký
+    assert len(items) == 6
+    assert items[:len(first)] == first
+    # Gửi lại cùng order_id: nhận đủ hàng đã trả tiền, không mua lần 2
+    assert client.get(f"/fetch?key={row['input_key']}&quantity=10&order_id={order_id}").json == items
+
+def test_disconnect_journals_inflight_chunks_async(slow_provider, make_key, chunked):
+    asgi = pytest.importorskip("asgi")
+    row = make_key(slow_provider)
+    order_id = uuid.uuid4().hex
+    assert core.order_claim(row, order_id, 10)
+
+    async def go():
+        gen = asgi.fetch_chunked(row, 10, order_id)
+        try:
+            assert await gen.__anext__() == "["
+            return json.loads("[" + await gen.__anext__() + "]")
+        finally:
+            await gen.aclose()
+            # httpx.AsyncClient gắn với event loop: đóng trước khi asyncio.run kết thúc
+            for c in asgi._clients.values():
+                await c.aclose()
+            asgi._clients.clear()
+    first = asyncio.run(go())
+
+    status, items = core.order_state(row, order_id)
+    assert status == "done"
+    assert len(items) == 6
+    assert items[:len(first)] == first
+
+@pytest.mark.parametrize("unknown", [True, False])
+def test_chunk_outcome_decides_order_state(client, provider, make_key, chunked, monkeypatch, unknown):
+    real = core.buy_chunk
+    calls = []
+    def buy_chunk(*args):
+        calls.append(args)
+        if len(calls) == 2:
+            return [], core.BuyError("HTTP: 502 Bad Gateway" if unknown else "API: out of stock", unknown=unknown)
+        return real(*args)
+    monkeypatch.setattr(core, "buy_chunk", buy_chunk)
+    row = make_key(provider)
+    order_id = uuid.uuid4().hex
+
+    delivered = client.get(f"/fetch?key={row['input_key']}&quantity=10&order_id={order_id}").json
+    status, items = core.order_state(row, order_id)
+    assert items == delivered and len(delivered) < 10
+    # 502: NCC có thể đã trừ tiền -> đơn để pending để đối soát; lỗi API rõ ràng -> chốt đơn
+    assert status == ("pending" if unknown else "done")
+
+def _count_buys(monkeypatch):
+    calls = []
+    real = core.mail72h_buy
+    def buy(*args):
+        calls.append(args)
+        return real(*args)
+    monkeypatch.setattr(core, "mail72h_buy", buy)
+    return calls
+
+def test_retry_with_order_id_replays_without_buying(client, provider, make_key, monkeypatch):
+    calls = _count_buys(monkeypatch)
+    row = make_key(provider)
+    url = f"/fetch?key={row['input_key']}&quantity=3&order_id={uuid.uuid4().hex}"
+    first = client.get(url).json
+    assert len(first) == 3
+    assert client.get(url).json == first
+    assert len(calls) == 1
+    # order_id riêng theo key: cùng order_id ở key khác là đơn mới
+    other = make_key(provider)
+    assert len(client.get(url.replace(row["input_key"], other["input_key"])).json) == 3
+    assert len(calls) == 2
+
+def test_pending_order_replays_journal_after_wait(client, provider, make_key, monkeypatch):
+    monkeypatch.setattr(core, "ORDER_WAIT", 0.3)
+    calls = _count_buys(monkeypatch)
+    row = make_key(provider)
+    order_id = uuid.uuid4().hex
+    assert core.order_claim(row, order_id, 2)
+    assert core.order_record(row, order_id, [{"product": "a"}], done=False)
+    # Request đầu còn đang mua (đơn pending): lần gửi lại chờ rồi trả phần đã ghi nhật ký
+    assert client.get(f"/fetch?key={row['input_key']}&quantity=2&order_id={order_id}").json == [{"product": "a"}]
+    assert not calls
+    assert core.order_record(row, order_id, [{"product": "b"}], seq=1, done=True)
+    assert core.order_state(row, order_id) == ("done", [{"product": "a"}, {"product": "b"}])
+
+def test_journal_write_failure_is_reported(make_key, provider):
+    row = make_key(provider)
+    order_id = uuid.uuid4().hex
+    assert core.order_claim(row, order_id, 1)
+    assert core.order_record(row, order_id, [{"product": "a"}], done=False)
+    # Trùng seq -> lỗi ghi: không ném ra ngoài (hàng vẫn giao cho khách), chỉ trả False
+    assert core.order_record(row, order_id, [{"product": "b"}], seq=0) is False
+    assert core.order_state(row, order_id) == ("pending", [{"product": "a"}])
+
+@pytest.fixture
+def order_errors(monkeypatch):
+    logged = []
+    real = core.log
+    def log(cat, msg, **fields):
+        if cat == "ORDER_ERROR":
+            logged.append(msg)
+        real(cat, msg, **fields)
+    monkeypatch.setattr(core, "log", log)
+    return logged
+
+@pytest.mark.parametrize("failure, unknown", [
+    (requests.ReadTimeout("read timed out"), True),   # NCC có thể đã trừ tiền
+    ({"status": "error", "message": "out of stock"}, False),
+    (core.CircuitOpenError("circuit open"), False),
+])
+def test_failed_buy_keeps_or_releases_order(client, provider, make_key, monkeypatch, order_errors, failure, unknown):
+    monkeypatch.setattr(core, "ORDER_WAIT", 0.3)
+    calls = []
+    def buy(*args):
+        calls.append(args)
+        if isinstance(failure, Exception):
+            raise failure
+        return failure
+    monkeypatch.setattr(core, "mail72h_buy", buy)
+    row = make_key(provider)
+    url = f"/fetch?key={row['input_key']}&quantity=2&order_id={uuid.uuid4().hex}"
+    assert client.get(url).json == []
+    monkeypatch.setattr(core, "mail72h_buy", lambda *a: calls.append(a) or {"status": "success", "data": ["x", "y"]})
+    retry = client.get(url).json
+    if unknown:
+        # Để pending để đối soát: lần gửi lại chỉ trả nhật ký, không mua lần 2
+        assert retry == [] and len(calls) == 1
+        assert "order left pending, buy outcome unknown" in order_errors
+    else:
+        # NCC chắc chắn chưa giao gì: claim được bỏ, lần gửi lại mua như đơn mới
+        assert len(retry) == 2 and len(calls) == 2
+        assert not order_errors
+
+def test_failed_buy_keeps_or_releases_order_async(provider, make_key, monkeypatch):
+    asgi = pytest.importorskip("asgi")
+    async def buy(*args):
+        raise core.RateLimitedError("queue full")
+    monkeypatch.setattr(asgi, "mail72h_buy_async", buy)
+    row = make_key(provider)
+    order_id = uuid.uuid4().hex
+    args = {"key": [row["input_key"]], "quantity": ["2"], "order_id": [order_id]}
+    assert asyncio.run(asgi.fetch(args)) == []
+    assert core.order_claim(row, order_id, 2)  # claim đã được bỏ
+
+def test_stale_pending_order_expires_without_waiting(client, provider, make_key, monkeypatch, order_errors):
+    monkeypatch.setattr(core, "ORDER_WAIT", 5)
+    monkeypatch.setattr(core, "ORDER_PENDING_TTL", 0.2)
+    calls = _count_buys(monkeypatch)
+    row = make_key(provider)
+    order_id = uuid.uuid4().hex
+    # Worker giữ claim rồi chết giữa lúc mua: đơn kẹt ở 'pending'
+    assert core.order_claim(row, order_id, 2)
+    assert core.order_record(row, order_id, [{"product": "a"}], done=False)
+    time.sleep(0.25)
+    t0 = time.monotonic()
+    assert client.get(f"/fetch?key={row['input_key']}&quantity=2&order_id={order_id}").json == [{"product": "a"}]
+    assert time.monotonic() - t0 < 1  # không chờ hết ORDER_WAIT
+    assert not calls
+    assert core.order_state(row, order_id) == ("expired", [{"product": "a"}])
+    assert order_errors.count("stale pending order expired") == 1
+
+def test_inventory_error_releases_claim(client, provider, make_key, monkeypatch):
+    row = make_key(provider)
+    order_id = uuid.uuid4().hex
+    def broken(*a):
+        raise core.sqlite3.OperationalError("database is locked")
+    monkeypatch.setattr(core, "take_inventory", broken)
+    monkeypatch.setitem(core.app.config, "PROPAGATE_EXCEPTIONS", False)  # lỗi -> 500 như production
+    assert client.get(f"/fetch?key={row['input_key']}&quantity=2&order_id={order_id}").status_code == 500
+    assert core.order_state(row, order_id) == (None, [])
+
+def test_asgi_stream_stops_buying_on_disconnect(slow_provider, make_key, chunked, monkeypatch):
+    asgi = pytest.importorskip("asgi")
+    calls = []
+    real = asgi.buy_chunk_async
+    async def buy(*args):
+        calls.append(args)
+        return await real(*args)
+    monkeypatch.setattr(asgi, "buy_chunk_async", buy)
+    row = make_key(slow_provider)
+    order_id = uuid.uuid4().hex
+    scope = {"type": "http", "method": "GET", "path": "/fetch", "headers": [],
+             "query_string": f"key={row['input_key']}&quantity=20&order_id={order_id}".encode()}
+
+    async def go():
+        gone = asyncio.Event()
+        sent = []
+        async def receive():
+            if not sent:
+                return {"type": "http.request", "body": b"", "more_body": False}
+            await gone.wait()
+            return {"type": "http.disconnect"}
+        async def send(msg):
+            # Như uvicorn: send() sau khi client ngắt không báo lỗi
+            sent.append(msg)
+            if msg.get("body", b"").startswith(b"{"):
+                gone.set()  # client ngắt ngay sau phần hàng đầu tiên
+        try:
+            await asyncio.wait_for(asgi.app(scope, receive, send), 10)
+        finally:
+            for c in asgi._clients.values():
+                await c.aclose()
+            asgi._clients.clear()
+        return sent
+    sent = asyncio.run(go())
+
+    # 10 phần x 2: chỉ các phần đã gửi NCC trước lúc ngắt được mua, không mua hết đơn
+    assert len(calls) < 10
+    status, items = core.order_state(row, order_id)
+    assert status == "done"
+    assert len(items) == 2 * len(calls)  # mọi phần đã mua đều vào nhật ký
+    assert {"type": "http.response.body", "body": b""} not in sent  # không gửi tới cuối mảng
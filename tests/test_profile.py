@@ -0,0 +1,21 @@
+"""Profiling lấy mẫu: thư mục .pstats được xoay vòng theo PROFILE_KEEP."""
+import os
+
+import pytest
+
+import app as core
+
+def _dump(route="/stock"):
+    # Như profile_start nhưng luôn lấy mẫu; profile_finish nhả _profile_lock
+    assert core._profile_lock.acquire(blocking=False)
+    prof = core.cProfile.Profile()
+    prof.enable()
+    core.profile_finish(prof, route)
+
+@pytest.mark.parametrize("keep, left", [(3, 3), (1, 1), (0, 1), (-5, 1)])
+def test_profile_rotation_keeps_newest(tmp_path, monkeypatch, keep, left):
+    monkeypatch.setattr(core, "PROFILE_DIR", str(tmp_path))
+    monkeypatch.setattr(core, "PROFILE_KEEP", keep)
+    for _ in range(5):
+        _dump()
+    assert len([f for f in os.listdir(tmp_path) if f.endswith(".pstats")]) == left
@@ -0,0 +1,25 @@
+"""Rate limit theo input_key: /stock/batch dùng chung lượt với /stock, không đi vòng qua giới hạn."""
+import pytest
+
+import app as core
+
+@pytest.fixture
+def key_limit(monkeypatch):
+    # 1 lượt, hồi lại sau 100s: lượt thứ 2 của cùng key phải chờ quá RATE_MAX_WAIT
+    monkeypatch.setattr(core, "RATE_KEY_RPS", 0.01)
+    monkeypatch.setattr(core, "RATE_KEY_BURST", 1.0)
+    monkeypatch.setattr(core, "RATE_MAX_WAIT", 0.5)
+
+def test_batch_takes_per_key_tokens(client, provider, make_key, key_limit):
+    used, fresh = make_key(provider)["input_key"], make_key(provider)["input_key"]
+    assert client.get(f"/stock?key={used}").get_json()["sum"] > 0
+
+    out = client.get(f"/stock/batch?keys={used},{fresh}").get_json()
+    assert out[used] == 0 and out[fresh] > 0
+    # Lượt của fresh đã dùng trong batch: /stock sau đó cũng bị giới hạn
+    assert client.get(f"/stock?key={fresh}").get_json()["sum"] == 0
+
+def test_batch_repeats_are_limited(client, provider, make_key, key_limit):
+    key = make_key(provider)["input_key"]
+    assert client.post("/stock/batch", json={"keys": [key]}).get_json()[key] > 0
+    assert client.post("/stock/batch", json={"keys": [key]}).get_json()[key] == 0